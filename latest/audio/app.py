@@ -1,95 +1,419 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context, g, abort
 from flask_cors import CORS
-from google.cloud import speech
-from google.cloud import storage # New import
 import os
 import traceback
 import sys
 import uuid # New import
+import threading
+import queue
+import time
+import re
+import shutil
+import subprocess
+import tempfile
+import json
+import hashlib
+import base64
 import sqlite3
+import cProfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import vertexai # Added import
-from vertexai.generative_models import GenerativeModel, Part # Added import
+from db import get_db_connection, init_db, NOTES_FTS_COLUMNS
+from metrics import span, render_prometheus, record_llm_sizes, http_request_duration, http_requests_in_flight, llm_time_to_first_chunk, generation_cache_events, transcript_digest_events
+from clients import warm_up_clients
+from singleflight import SingleFlight
+from note_cache import NoteCache
+from resilience import Guard, AIMDLimiter, CircuitBreaker, ServiceUnavailableError, INTERACTIVE, BACKGROUND
+from backends import SPEECH_BACKENDS, STORAGE_BACKENDS, LLM_BACKENDS, create_backend
+from static_assets import StaticAssets, asset_response, etag_matches, is_public_path
+from export_notes import EXPORT_FORMATS, snapshot_bound, iter_export, parquet_available
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 app = Flask(__name__, static_folder='.')
 CORS(app)
-speech_client = speech.SpeechClient()
-storage_client = storage.Client() # New storage client
-GCS_BUCKET_NAME = "audio-upload-bucket-fernado" # Updated GCS bucket name
-
-# Vertex AI and Gemini Model Initialization
-VERTEX_AI_PROJECT_ID = os.environ.get("VERTEX_AI_PROJECT_ID", "macro-dolphin-432908-t4")
-VERTEX_AI_LOCATION = os.environ.get("VERTEX_AI_LOCATION", "us-central1")
-gemini_model = None
-
-try:
-    vertexai.init(project=VERTEX_AI_PROJECT_ID, location=VERTEX_AI_LOCATION)
-    gemini_model = GenerativeModel("gemini-2.5-pro-exp-03-25")
-    print(f"Vertex AI initialized and Gemini model '{gemini_model._model_name}' loaded successfully in project '{VERTEX_AI_PROJECT_ID}' location '{VERTEX_AI_LOCATION}'.")
-except Exception as e:
-    print(f"⚠️ Error initializing Vertex AI or Gemini model: {e}\n{traceback.format_exc()}")
-    gemini_model = None # Ensure model is None if initialization fails
-
-# Database setup
-DATABASE_NAME = 'notes_main.db' # Renamed to avoid conflict with any old db
-DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), DATABASE_NAME)
-
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row # To access columns by name
-    return conn
-
-def init_db():
+# External services (speech-to-text, object storage, LLM) are pluggable, see backends.py.
+# "fake" selects in-process stand-ins for offline development and load testing.
+SPEECH_BACKEND = os.environ.get("SPEECH_BACKEND", os.environ.get("STREAMING_RECOGNIZER", "google")) # "google" or "fake"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "gcs") # "gcs", "fake" or "local" (a directory standing in for the bucket)
+GEMINI_BACKEND = os.environ.get("GEMINI_BACKEND", "vertex") # "vertex" or "fake"
+WARMUP_CLIENTS = os.environ.get("WARMUP_CLIENTS", "0") == "1" # Build the cloud clients in the background at startup
+
+# Cloud clients are built on first use (see clients.py) so importing the app stays cheap
+speech_backend = create_backend(SPEECH_BACKENDS, SPEECH_BACKEND, "speech")
+storage_backend = create_backend(STORAGE_BACKENDS, STORAGE_BACKEND, "storage")
+llm_backend = create_backend(LLM_BACKENDS, GEMINI_BACKEND, "LLM")
+BACKENDS = {"speech": speech_backend, "storage": storage_backend, "gemini": llm_backend}
+
+# Client-side throttling for Gemini and Speech (see resilience.py): adaptive concurrency with priority
+# classes, jittered retries of quota/5xx errors and a circuit breaker that turns outages into fast 503s.
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "16"))
+SPEECH_MAX_CONCURRENCY = int(os.environ.get("SPEECH_MAX_CONCURRENCY", "32"))
+CALL_MAX_ATTEMPTS = int(os.environ.get("CALL_MAX_ATTEMPTS", "4"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5")) # Consecutive retryable failures
+CIRCUIT_RESET_SECONDS = float(os.environ.get("CIRCUIT_RESET_SECONDS", "30"))
+gemini_guard = Guard("gemini", AIMDLimiter("gemini", initial=4, minimum=1, maximum=GEMINI_MAX_CONCURRENCY),
+                     CircuitBreaker("gemini", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS), max_attempts=CALL_MAX_ATTEMPTS)
+speech_guard = Guard("speech", AIMDLimiter("speech", initial=8, minimum=1, maximum=SPEECH_MAX_CONCURRENCY),
+                     CircuitBreaker("speech", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS), max_attempts=CALL_MAX_ATTEMPTS)
+GUARDS = {"gemini": gemini_guard, "speech": speech_guard}
+
+def service_unavailable_response(error):
+    return jsonify({"error": str(error), "retry_after": error.retry_after}), 503, {"Retry-After": str(error.retry_after)}
+
+# Per-request profiling (opt-in): with PROFILING_ENABLED=1, a request carrying ?profile=1 or an
+# "X-Profile: 1" header is run under cProfile and the stats are written to PROFILE_DIR.
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0") == "1"
+# Kept outside latest/, which the catch-all static route serves
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), 'aims-profiles'))
+
+# Generation cache: Gemini output keyed on the prompt template version plus the exact input sections.
+# Bump a section's prompt version whenever its prompt changes so older cached output stops matching.
+PROMPT_VERSIONS = {"assessment": "2", "plan": "2", "summary": "2"}
+GENERATION_CACHE_ENABLED = os.environ.get("GENERATION_CACHE", "1") == "1"
+GENERATION_CACHE_TTL_SECONDS = int(os.environ.get("GENERATION_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+GENERATION_CACHE_MAX_BYTES = int(os.environ.get("GENERATION_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+generation_cache_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+generation_cache_stats_lock = threading.Lock()
+# Concurrent requests for the same note, section and inputs (double-clicks, two open tabs) share one model call
+generation_flight = SingleFlight("generation")
+GENERATION_FLIGHT_WAIT_TIMEOUT_SECONDS = int(os.environ.get("GENERATION_FLIGHT_WAIT_TIMEOUT_SECONDS", "120")) # How long a joining request waits on the in-flight one
+
+# Note cache: /get_note_data bodies are kept in memory (LRU, bounded in bytes) and validated against the note's
+# version on every request; writes made here also invalidate them directly. NOTE_CACHE_MAX_BYTES=0 disables it.
+NOTE_CACHE_MAX_BYTES = int(os.environ.get("NOTE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+note_cache = NoteCache(NOTE_CACHE_MAX_BYTES)
+
+# Speculative pre-generation: when enabled, saving S+O, A or P starts the next section's generation in the background
+SPECULATIVE_GENERATION_ENABLED = os.environ.get("SPECULATIVE_GENERATION", "0") == "1"
+SPECULATIVE_WORKERS = int(os.environ.get("SPECULATIVE_WORKERS", "2"))
+SPECULATIVE_WAIT_TIMEOUT_SECONDS = int(os.environ.get("SPECULATIVE_WAIT_TIMEOUT_SECONDS", "120")) # How long a generate request waits on an in-flight speculative result
+SPECULATIVE_RESULT_TTL_SECONDS = 30 * 60 # Unclaimed speculative results are dropped after this long
+SPECULATIVE_TRIGGERS = {"objective_text": "assessment", "assessment_text": "plan", "plan_text": "summary"}
+speculative_executor = ThreadPoolExecutor(max_workers=SPECULATIVE_WORKERS, thread_name_prefix="speculative")
+speculative_generations = {} # (note_id, section) -> (input cache_key, Future, queued_at)
+speculative_generations_lock = threading.Lock()
+
+# Asynchronous transcription jobs: uploads are spooled to disk and driven by a bounded worker pool
+TRANSCRIPTION_WORKERS = int(os.environ.get("TRANSCRIPTION_WORKERS", "4"))
+# Patient audio: must stay outside latest/, which the catch-all static route serves
+TRANSCRIPTION_SPOOL_DIR = os.environ.get("TRANSCRIPTION_SPOOL_DIR", os.path.join(tempfile.gettempdir(), 'aims-transcription-spool'))
+TRANSCRIPTION_JOB_MAX_WAIT = 60 # Upper bound (seconds) for long-polling a job status
+transcription_executor = ThreadPoolExecutor(max_workers=TRANSCRIPTION_WORKERS, thread_name_prefix="stt-job")
+transcription_job_events = {} # job_id -> threading.Event, set once the job is done or failed
+transcription_job_events_lock = threading.Lock()
+STORED_AUDIO_PREFIX = "storage:" # audio_path of a job whose audio is an object in storage_backend instead of a spool file
+
+# Resumable uploads: the client sends the recording in chunks at increasing offsets, each one is streamed on to
+# object storage as its own part object, and the parts are composed into one object when the last chunk arrives.
+# A retry after a dropped connection asks for the current offset and resends only what is missing.
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024))) # Suggested to clients
+UPLOAD_MAX_CHUNK_BYTES = int(os.environ.get("UPLOAD_MAX_CHUNK_BYTES", str(16 * 1024 * 1024))) # Bounds server memory per request
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+UPLOAD_SESSION_TTL_SECONDS = int(os.environ.get("UPLOAD_SESSION_TTL_SECONDS", str(24 * 3600))) # Unfinished uploads are dropped after this long
+UPLOAD_READ_SIZE = 64 * 1024
+UPLOAD_CHECKSUM_ALGORITHMS = ("sha256", "sha1", "md5")
+
+# Segmented transcription: long recordings are split at silences and the segments recognized in parallel.
+# Requires an ffmpeg binary; without it every recording goes through the single GCS long-running path.
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+TRANSCRIBE_SEGMENTATION_ENABLED = os.environ.get("TRANSCRIBE_SEGMENTATION", "1") == "1"
+TRANSCRIBE_SEGMENT_FANOUT = int(os.environ.get("TRANSCRIBE_SEGMENT_FANOUT", "8"))
+TRANSCRIBE_SEGMENT_MIN_RECORDING_SECONDS = float(os.environ.get("TRANSCRIBE_SEGMENT_MIN_RECORDING_SECONDS", "90"))
+TRANSCRIBE_SEGMENT_TARGET_SECONDS = 45.0 # Preferred segment length; cuts snap to the nearest silence
+TRANSCRIBE_SEGMENT_MAX_SECONDS = 55.0 # Synchronous recognize() accepts at most one minute of audio
+TRANSCRIBE_SEGMENT_MIN_SECONDS = 15.0 # Never cut at a silence sooner than this after the segment start
+TRANSCRIBE_SEGMENT_OVERLAP_SECONDS = 1.5 # Overlap used when no silence is found and a word may be split
+SILENCE_NOISE_THRESHOLD = "-35dB"
+SILENCE_MIN_DURATION = 0.4
+
+# Audio normalization: uploads are re-encoded to the compact format recognition actually needs
+NORMALIZED_SAMPLE_RATE = 16000
+NORMALIZED_CHANNELS = 1
+AUDIO_PIPE_CHUNK_SIZE = 256 * 1024 # Bytes copied per read while streaming ffmpeg output
+
+# Streaming transcription: audio chunks are fed to the speech backend while the recording is still going
+STREAMING_SESSION_IDLE_TIMEOUT = 120 # Seconds without a chunk before a session is abandoned
+STREAMING_FINISH_TIMEOUT = 30 # Seconds /finish waits for the recognizer to flush final results
+STREAMING_REAP_INTERVAL = 30 # Seconds between sweeps for abandoned sessions
+STREAMING_MAX_QUEUED_CHUNKS = 64 # Chunks buffered ahead of the recognizer (about a minute of audio from the page)
+STREAMING_CHUNK_PUT_TIMEOUT = 10 # Seconds a chunk waits for room in a full buffer before it is rejected
+streaming_sessions = {} # stream_id -> StreamingTranscriptionSession
+streaming_sessions_lock = threading.Lock()
+
+@app.before_request
+def start_request_instrumentation():
+    g.request_started = time.perf_counter()
+    http_requests_in_flight.inc()
+    if PROFILING_ENABLED and (request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def finish_request_profile(response):
+    g.response_status = response.status_code
+    profiler = g.pop('profiler', None)
+    if profiler:
+        # Streamed bodies are produced after this point, so only their setup is included in the profile
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        endpoint = (request.endpoint or "unmatched").replace('/', '_')
+        profile_path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{uuid.uuid4().hex[:8]}.prof")
+        profiler.dump_stats(profile_path)
+        response.headers['X-Profile-File'] = profile_path
+        print(f"🔬 Profile for {request.method} {request.path} written to {profile_path}")
+    return response
+
+@app.teardown_request
+def finish_request_instrumentation(exc):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    http_requests_in_flight.dec()
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    status = g.get('response_status', 500)
+    http_request_duration.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method, status=str(status))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/readyz', methods=['GET'])
+def readiness_endpoint():
+    # Not ready while any backend is in its failure backoff. With WARMUP_CLIENTS=1 the app also waits
+    # for the warm-up to finish; otherwise a client that hasn't been needed yet counts as ready.
+    backends = {name: backend.status() for name, backend in BACKENDS.items()}
+    for name, guard in GUARDS.items():
+        backends[name]["throttle"] = guard.status()
+        if guard.breaker.status()["state"] == "open":
+            backends[name]["state"] = "failed"
+    acceptable_states = ("ready",) if WARMUP_CLIENTS else ("ready", "not_initialized", "initializing")
+    ready = all(status["state"] in acceptable_states for status in backends.values())
     try:
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS notes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                subjective_text TEXT,
-                objective_text TEXT,
-                assessment_text TEXT,
-                plan_text TEXT,
-                summary_text TEXT, -- Added for summary
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        # Check if updated_at trigger exists, if not, create it
-        cursor.execute('''
-            SELECT name FROM sqlite_master WHERE type='trigger' AND name='update_notes_updated_at';
-        ''')
-        if cursor.fetchone() is None:
-            cursor.execute('''
-                CREATE TRIGGER update_notes_updated_at
-                AFTER UPDATE ON notes
-                FOR EACH ROW
-                BEGIN
-                    UPDATE notes SET updated_at = CURRENT_TIMESTAMP WHERE id = OLD.id;
-                END;
-            ''')
-        conn.commit()
-        print(f"Database '{DATABASE_NAME}' initialized successfully at {DATABASE_PATH}")
-    except Exception as e:
-        print(f"Error initializing database: {e}\n{traceback.format_exc()}")
-    finally:
-        if conn:
+        try:
+            conn.execute("SELECT 1").fetchone()
+        finally:
             conn.close()
+        backends["database"] = {"state": "ready"}
+    except Exception as e:
+        backends["database"] = {"state": "failed", "last_error": str(e)}
+        ready = False
+    return jsonify({"ready": ready, "backends": backends}), 200 if ready else 503
+
+# Pages and assets under latest/ go through the static pipeline (static_assets.py): fingerprinted, precompressed
+# assets with immutable caching, and ETag-revalidated pages. Anything it doesn't handle is sent as before, as long as it
+# is a page or frontend asset: latest/audio/ also holds this app's code and the notes database (with its -wal/-shm files).
+STATIC_PIPELINE_ENABLED = os.environ.get("STATIC_PIPELINE", "1") == "1"
+static_assets = StaticAssets() if STATIC_PIPELINE_ENABLED else None
+
+def serve_static(path):
+    if not is_public_path(path):
+        abort(404)
+    asset = static_assets.get(path) if static_assets else None
+    if asset is None:
+        return send_from_directory('../', path)
+    return asset_response(asset, request)
 
 @app.route('/')
 def serve_index():
-    return send_from_directory('../', 'index.html')
+    return serve_static('index.html')
 
 @app.route('/<path:path>')
 def serve_file(path):
-    return send_from_directory('../', path)
+    return serve_static(path)
+
+def transcribe_audio_file(file, filename, audio_format=None, priority=INTERACTIVE):
+    # Uploads the audio to object storage, runs long-running recognition and always removes the blob afterwards.
+    # audio_format is the (sample_rate, channels) of normalized FLAC input; None means the raw browser upload.
+    uploaded_uri = None
+    blob_name = None
+    try:
+        # Generate a unique filename for the upload
+        blob_name = f"audio_uploads/{uuid.uuid4()}-{filename}"
+
+        # Rewind the file stream before uploading, just in case it was read before
+        file.seek(0)
+        with span("gcs_upload"):
+            uploaded_uri = storage_backend.upload(blob_name, file)
+        print(f"Uploaded audio to storage: {uploaded_uri}")
+
+        # Long-running recognition reads the uploaded object; allow up to 10 minutes for long recordings
+        with span("stt_long_running"):
+            return speech_guard.call(lambda: speech_backend.recognize_long_running(uploaded_uri, audio_format, timeout=600), priority)
+    finally:
+        # Clean up the uploaded file
+        if uploaded_uri:
+            try:
+                with span("gcs_delete"):
+                    storage_backend.delete(blob_name)
+                print(f"Deleted uploaded file: {uploaded_uri}")
+            except Exception as e_del:
+                print(f"Error deleting uploaded file {uploaded_uri}: {e_del}\n{traceback.format_exc()}")
+
+def ffmpeg_available():
+    return shutil.which(FFMPEG_BINARY) is not None
+
+def probe_audio_silences(audio_path):
+    # Single decode pass with silencedetect; returns (duration_seconds, [(silence_start, silence_end), ...])
+    cmd = [FFMPEG_BINARY, "-hide_banner", "-i", audio_path,
+           "-af", f"silencedetect=noise={SILENCE_NOISE_THRESHOLD}:d={SILENCE_MIN_DURATION}",
+           "-f", "null", "-"]
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=300)
+    log = proc.stderr.decode('utf-8', errors='ignore')
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not decode audio: {log[-500:]}")
+
+    # Browser WebM often has no duration header, so use the last progress "time=" as the decoded length
+    times = re.findall(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)", log)
+    if not times:
+        raise RuntimeError("ffmpeg did not report a decoded duration.")
+    hours, minutes, seconds = times[-1]
+    duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    silences = []
+    silence_start = None
+    for kind, value in re.findall(r"silence_(start|end): (-?\d+(?:\.\d+)?)", log):
+        if kind == "start":
+            silence_start = max(float(value), 0.0)
+        elif silence_start is not None:
+            silences.append((silence_start, float(value)))
+            silence_start = None
+    if silence_start is not None:
+        silences.append((silence_start, duration))
+    return duration, silences
+
+def plan_audio_segments(duration, silences):
+    # Greedy plan of (start, end, overlaps_previous) segments. Cuts go in the middle of the silence closest
+    # to the target length; if a window has no silence it is cut hard and the next segment overlaps it.
+    segments = []
+    start = 0.0
+    overlaps_previous = False
+    while duration - start > TRANSCRIBE_SEGMENT_MAX_SECONDS:
+        window_start = start + TRANSCRIBE_SEGMENT_MIN_SECONDS
+        window_end = start + TRANSCRIBE_SEGMENT_MAX_SECONDS
+        candidates = [(s + e) / 2 for s, e in silences if window_start <= (s + e) / 2 <= window_end]
+        if candidates:
+            cut = min(candidates, key=lambda c: abs(c - (start + TRANSCRIBE_SEGMENT_TARGET_SECONDS)))
+            segments.append((start, cut, overlaps_previous))
+            start, overlaps_previous = cut, False
+        else:
+            segments.append((start, window_end, overlaps_previous))
+            start, overlaps_previous = window_end - TRANSCRIBE_SEGMENT_OVERLAP_SECONDS, True
+    segments.append((start, duration, overlaps_previous))
+    return segments
+
+def extract_audio_segment(audio_path, start, end):
+    # Decode one segment to mono 16 kHz FLAC in memory (a 55s segment is roughly 1 MB)
+    cmd = [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error",
+           "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", "-i", audio_path,
+           "-ac", "1", "-ar", "16000", "-c:a", "flac", "-f", "flac", "pipe:1"]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=120)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not extract segment {start:.1f}-{end:.1f}s: {proc.stderr.decode('utf-8', errors='ignore')[-500:]}")
+    return proc.stdout
+
+def transcribe_audio_segment(audio_path, start, end, priority=INTERACTIVE):
+    with span("audio_extract_segment"):
+        content = extract_audio_segment(audio_path, start, end)
+    with span("stt_recognize_segment"):
+        return speech_guard.call(lambda: speech_backend.recognize(content, (16000, 1)), priority)
+
+def normalize_word(word):
+    return re.sub(r"[^\w']", "", word).lower()
+
+def merge_segment_transcripts(parts):
+    # parts: [(transcript, overlaps_previous)] in recording order. Where a segment overlaps the previous one,
+    # drop the longest run of leading words that repeats the previous segment's trailing words.
+    merged = []
+    for transcript, overlaps_previous in parts:
+        words = transcript.split()
+        if overlaps_previous and merged:
+            max_run = min(len(merged), len(words), 12)
+            for run in range(max_run, 0, -1):
+                if [normalize_word(w) for w in merged[-run:]] == [normalize_word(w) for w in words[:run]]:
+                    words = words[run:]
+                    break
+        merged.extend(words)
+    return "".join([word + " " for word in merged]).strip()
+
+def transcribe_audio_segmented(audio_path, duration, silences, priority=INTERACTIVE):
+    segments = plan_audio_segments(duration, silences)
+    print(f"✂️ Transcribing {duration:.1f}s of audio as {len(segments)} segments (fan-out {TRANSCRIBE_SEGMENT_FANOUT}).")
+    with ThreadPoolExecutor(max_workers=TRANSCRIBE_SEGMENT_FANOUT, thread_name_prefix="stt-segment") as pool:
+        futures = [pool.submit(transcribe_audio_segment, audio_path, start, end, priority) for start, end, _ in segments]
+        # Results are collected in submission order, so stitching keeps the recording order
+        transcripts = [future.result() for future in futures]
+    return merge_segment_transcripts([(text, overlaps) for text, (_, _, overlaps) in zip(transcripts, segments)])
+
+def parse_flac_streaminfo(header):
+    # Reads (sample_rate, channels) from the STREAMINFO block that starts every FLAC stream
+    if len(header) < 22 or header[:4] != b"fLaC" or header[4] & 0x7F != 0:
+        raise ValueError("Output is not a FLAC stream with a leading STREAMINFO block.")
+    sample_rate = (header[18] << 12) | (header[19] << 4) | (header[20] >> 4)
+    channels = ((header[20] >> 1) & 0x07) + 1
+    return sample_rate, channels
+
+def normalize_audio_file(audio_path, dst):
+    # Decode, downmix and resample to mono 16 kHz FLAC, streaming ffmpeg's output into dst chunk by chunk
+    # so neither the source nor the result is ever held in memory. Returns the real (sample_rate, channels).
+    cmd = [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-i", audio_path, "-vn",
+           "-ac", str(NORMALIZED_CHANNELS), "-ar", str(NORMALIZED_SAMPLE_RATE),
+           "-c:a", "flac", "-f", "flac", "pipe:1"]
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr_chunks = []
+    stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()), daemon=True)
+    stderr_reader.start()
+    header = b""
+    try:
+        while True:
+            data = proc.stdout.read(AUDIO_PIPE_CHUNK_SIZE)
+            if not data:
+                break
+            if len(header) < 42:
+                header += data[:42 - len(header)]
+            dst.write(data)
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait(timeout=300)
+        stderr_reader.join()
+    if returncode != 0:
+        error_output = b"".join(stderr_chunks).decode('utf-8', errors='ignore')
+        raise RuntimeError(f"ffmpeg could not normalize audio: {error_output[-500:]}")
+    return parse_flac_streaminfo(header)
+
+def transcribe_audio_path(audio_path, filename, priority=INTERACTIVE):
+    # With ffmpeg the upload is normalized to mono 16 kHz FLAC first; long recordings are then segmented and
+    # recognized in parallel, short ones go through a single GCS operation. Without ffmpeg the raw file is used.
+    if not ffmpeg_available():
+        with open(audio_path, 'rb') as audio_file:
+            return transcribe_audio_file(audio_file, filename, priority=priority)
+
+    normalized = tempfile.NamedTemporaryFile(prefix="normalized-", suffix=".flac", delete=False)
+    try:
+        with normalized:
+            with span("audio_normalize"):
+                audio_format = normalize_audio_file(audio_path, normalized)
+        print(f"🎚️ Normalized {filename}: {os.path.getsize(audio_path)} -> {os.path.getsize(normalized.name)} bytes "
+              f"({audio_format[0]} Hz, {audio_format[1]} channel(s)).")
+
+        if TRANSCRIBE_SEGMENTATION_ENABLED:
+            try:
+                with span("audio_probe"):
+                    duration, silences = probe_audio_silences(normalized.name)
+            except Exception as e:
+                print(f"⚠️ Could not analyse audio for segmentation, using single-shot transcription: {e}")
+            else:
+                if duration >= TRANSCRIBE_SEGMENT_MIN_RECORDING_SECONDS:
+                    return transcribe_audio_segmented(normalized.name, duration, silences, priority)
+
+        with open(normalized.name, 'rb') as audio_file:
+            return transcribe_audio_file(audio_file, f"{os.path.splitext(filename)[0]}.flac", audio_format=audio_format, priority=priority)
+    finally:
+        os.remove(normalized.name)
 
 @app.route('/transcribe', methods=['POST'])
 def transcribe():
-    gcs_uri = None
-    blob_name = None
     try:
         if 'file' not in request.files:
             return jsonify({"error": "No file provided."}), 400
@@ -98,54 +422,627 @@ def transcribe():
         if file.filename == '':
             return jsonify({"error": "Empty filename."}), 400
 
-        # Generate a unique filename for GCS
-        blob_name = f"audio_uploads/{uuid.uuid4()}-{file.filename}"
-        
-        # Upload to GCS
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob(blob_name)
-        
-        # Rewind the file stream before uploading, just in case it was read before
-        file.seek(0)
-        blob.upload_from_file(file)
-        
-        gcs_uri = f"gs://{GCS_BUCKET_NAME}/{blob_name}"
-        print(f"Uploaded audio to GCS: {gcs_uri}")
-
-        audio = speech.RecognitionAudio(uri=gcs_uri)
-        config = speech.RecognitionConfig(
-            language_code="en-US",
-            model="medical_conversation",
-            enable_automatic_punctuation=True,
-            audio_channel_count=2 # Specify audio channel count
-        )
-        
-        # Use long_running_recognize for GCS files
-        operation = speech_client.long_running_recognize(config=config, audio=audio)
-        print("Waiting for long-running transcription operation to complete...")
-        
-        # Set a timeout for the operation (e.g., 10 minutes = 600 seconds)
-        # Adjust timeout as needed based on expected audio length
-        response = operation.result(timeout=600)
-        
-        transcript_text = "".join([result.alternatives[0].transcript + " " for result in response.results]).strip()
-        print(f"📝 Google STT transcript for /transcribe (GCS): {transcript_text}")
+        # Spool to disk so long recordings can be segmented and transcribed in parallel
+        spool = tempfile.NamedTemporaryFile(prefix="transcribe-", delete=False)
+        try:
+            file.save(spool)
+            spool.close()
+            transcript_text = transcribe_audio_path(spool.name, file.filename)
+        finally:
+            spool.close()
+            os.remove(spool.name)
+        print(f"📝 Google STT transcript for /transcribe: {transcript_text}")
         return jsonify({"text": transcript_text})
 
+    except ServiceUnavailableError as e:
+        print(f"⏳ Transcription rejected: {e}")
+        return service_unavailable_response(e)
     except Exception as e:
         # Log the full traceback for better debugging
         print(f"Error during transcription: {e}\n{traceback.format_exc()}")
         return jsonify({"error": f"Transcription error: {str(e)}"}), 500
+
+def set_transcription_job_state(job_id, status, transcript_text=None, error=None):
+    conn = get_db_connection()
+    try:
+        conn.execute("UPDATE transcription_jobs SET status = ?, transcript_text = ?, error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                     (status, transcript_text, error, job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def transcribe_stored_audio(object_name, filename, priority=INTERACTIVE):
+    # Audio that is already an object in storage (a finished resumable upload). Without ffmpeg it is recognized
+    # where it is; otherwise it is streamed to a spool file first, to be normalized and segmented.
+    if not ffmpeg_available():
+        with span("stt_long_running"):
+            return speech_guard.call(lambda: speech_backend.recognize_long_running(storage_backend.uri(object_name), timeout=600), priority)
+    spool = tempfile.NamedTemporaryFile(prefix="stored-", delete=False)
+    try:
+        with spool:
+            with span("gcs_download"):
+                storage_backend.download(object_name, spool)
+        return transcribe_audio_path(spool.name, filename, priority)
+    finally:
+        os.remove(spool.name)
+
+def stored_audio_object(audio_path):
+    return audio_path[len(STORED_AUDIO_PREFIX):] if audio_path and audio_path.startswith(STORED_AUDIO_PREFIX) else None
+
+def run_transcription_job(job_id, audio_path, filename):
+    object_name = stored_audio_object(audio_path)
+    try:
+        set_transcription_job_state(job_id, 'running')
+        print(f"🎙️ Transcription job {job_id} started ({filename}).")
+        if object_name:
+            transcript_text = transcribe_stored_audio(object_name, filename, priority=BACKGROUND)
+        else:
+            transcript_text = transcribe_audio_path(audio_path, filename, priority=BACKGROUND)
+        set_transcription_job_state(job_id, 'done', transcript_text=transcript_text)
+        print(f"📝 Transcription job {job_id} finished: {transcript_text[:200]}")
+    except Exception as e:
+        print(f"🚨 Transcription job {job_id} failed: {e}\n{traceback.format_exc()}")
+        try:
+            set_transcription_job_state(job_id, 'failed', error=f"Transcription error: {str(e)}")
+        except Exception as e_state:
+            print(f"🚨 Could not record failure for transcription job {job_id}: {e_state}")
+    finally:
+        # The spooled (or stored) audio is only needed until the job reaches a terminal state
+        try:
+            if object_name:
+                storage_backend.delete(object_name)
+            elif os.path.exists(audio_path):
+                os.remove(audio_path)
+        except Exception as e_rm:
+            print(f"⚠️ Could not remove audio {audio_path}: {e_rm}")
+        with transcription_job_events_lock:
+            event = transcription_job_events.pop(job_id, None)
+        if event:
+            event.set()
+
+def submit_transcription_job(job_id, audio_path, filename):
+    with transcription_job_events_lock:
+        transcription_job_events.setdefault(job_id, threading.Event())
+    transcription_executor.submit(run_transcription_job, job_id, audio_path, filename)
+
+def resume_transcription_jobs():
+    # Re-queue jobs that were queued or running when the process last stopped
+    conn = get_db_connection()
+    try:
+        jobs = conn.execute("SELECT id, audio_path, filename FROM transcription_jobs WHERE status IN ('queued', 'running') ORDER BY created_at").fetchall()
+    finally:
+        conn.close()
+    for job in jobs:
+        # Stored audio is not checked here (that would be a storage call per job at startup); a job whose
+        # object is gone fails when it runs
+        if stored_audio_object(job['audio_path']) or (job['audio_path'] and os.path.exists(job['audio_path'])):
+            set_transcription_job_state(job['id'], 'queued')
+            submit_transcription_job(job['id'], job['audio_path'], job['filename'])
+            print(f"🔁 Resumed transcription job {job['id']}.")
+        else:
+            set_transcription_job_state(job['id'], 'failed', error="Spooled audio was lost before transcription completed.")
+    return len(jobs)
+
+def transcription_job_to_dict(job):
+    return {
+        "job_id": job['id'],
+        "note_id": job['note_id'],
+        "status": job['status'],
+        "text": job['transcript_text'],
+        "error": job['error'],
+        "created_at": job['created_at'],
+        "updated_at": job['updated_at'],
+    }
+
+@app.route('/transcription_jobs', methods=['POST'])
+def create_transcription_job():
+    try:
+        if 'file' not in request.files:
+            return jsonify({"error": "No file provided."}), 400
+
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({"error": "Empty filename."}), 400
+
+        job_id = str(uuid.uuid4())
+        filename = os.path.basename(file.filename)
+        os.makedirs(TRANSCRIPTION_SPOOL_DIR, exist_ok=True)
+        audio_path = os.path.join(TRANSCRIPTION_SPOOL_DIR, job_id)
+        file.save(audio_path)
+
+        conn = get_db_connection()
+        try:
+            conn.execute("INSERT INTO transcription_jobs (id, note_id, status, filename, audio_path) VALUES (?, ?, 'queued', ?, ?)",
+                         (job_id, request.form.get('note_id'), filename, audio_path))
+            conn.commit()
+        finally:
+            conn.close()
+
+        submit_transcription_job(job_id, audio_path, filename)
+        print(f"📥 Transcription job {job_id} queued ({filename}).")
+        return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/transcription_jobs/{job_id}"}), 202
+    except Exception as e:
+        print(f"🚨 Error queueing transcription job: {e}\n{traceback.format_exc()}")
+        return jsonify({"error": f"Failed to queue transcription: {str(e)}"}), 500
+
+@app.route('/transcription_jobs/<job_id>', methods=['GET'])
+def get_transcription_job(job_id):
+    try:
+        # Optional long-poll: ?wait=N blocks up to N seconds until the job finishes
+        wait_seconds = min(max(request.args.get('wait', 0, type=float), 0), TRANSCRIPTION_JOB_MAX_WAIT)
+        if wait_seconds:
+            with transcription_job_events_lock:
+                event = transcription_job_events.get(job_id)
+            if event:
+                event.wait(wait_seconds)
+
+        conn = get_db_connection()
+        try:
+            job = conn.execute("SELECT * FROM transcription_jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if not job:
+            return jsonify({"error": "Transcription job not found."}), 404
+        return jsonify(transcription_job_to_dict(job)), 200
+    except Exception as e:
+        print(f"🚨 Error fetching transcription job {job_id}: {e}\n{traceback.format_exc()}")
+        return jsonify({"error": f"Failed to fetch transcription job: {str(e)}"}), 500
+
+class UploadChunkReader:
+    # File object over one chunk of the request body: hands storage at most `size` bytes and hashes them on the way
+    def __init__(self, stream, size, algorithms):
+        self.stream = stream
+        self.remaining = size
+        self.hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+
+    def read(self, size=-1):
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        pieces = []
+        while size > 0:
+            data = self.stream.read(min(size, UPLOAD_READ_SIZE))
+            if not data:
+                raise IOError(f"Upload chunk ended {self.remaining} bytes early (client disconnected?).")
+            for digest in self.hashes.values():
+                digest.update(data)
+            pieces.append(data)
+            size -= len(data)
+            self.remaining -= len(data)
+        return b"".join(pieces)
+
+def parse_upload_checksum(header):
+    # "Upload-Checksum: sha256 <base64 digest>" -> (algorithm, digest bytes); None when the header is absent
+    if not header:
+        return None
+    algorithm, _, encoded = header.strip().partition(" ")
+    algorithm = algorithm.lower()
+    if algorithm not in UPLOAD_CHECKSUM_ALGORITHMS:
+        raise ValueError(f"Unsupported checksum algorithm '{algorithm}' (use {', '.join(UPLOAD_CHECKSUM_ALGORITHMS)}).")
+    try:
+        return algorithm, base64.b64decode(encoded.strip(), validate=True)
+    except ValueError:
+        raise ValueError("Upload-Checksum digest is not valid base64.")
+
+def audio_upload_to_dict(upload):
+    result = {
+        "upload_id": upload['id'],
+        "note_id": upload['note_id'],
+        "filename": upload['filename'],
+        "size": upload['total_size'],
+        "offset": upload['received_bytes'],
+        "status": upload['status'],
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "max_chunk_size": UPLOAD_MAX_CHUNK_BYTES,
+        "upload_url": f"/uploads/{upload['id']}",
+    }
+    if upload['job_id']:
+        result["job_id"] = upload['job_id']
+        result["status_url"] = f"/transcription_jobs/{upload['job_id']}"
+    return result
+
+def audio_upload_response(upload, status_code=200):
+    response = jsonify(audio_upload_to_dict(upload))
+    response.status_code = status_code
+    response.headers["Upload-Offset"] = str(upload['received_bytes'])
+    response.headers["Upload-Length"] = str(upload['total_size'])
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+def fetch_audio_upload(upload_id):
+    conn = get_db_connection()
+    try:
+        return conn.execute("SELECT * FROM audio_uploads WHERE id = ?", (upload_id,)).fetchone()
+    finally:
+        conn.close()
+
+def delete_stored_objects(object_names):
+    for object_name in object_names:
+        try:
+            storage_backend.delete(object_name)
+        except Exception as e:
+            print(f"⚠️ Could not delete stored object {object_name}: {e}")
+
+def finish_audio_upload(upload_id):
+    # Composes the parts of a fully received upload into one object and queues it for transcription.
+    # The receiving -> composing transition makes this safe to call again (e.g. a retried last chunk).
+    conn = get_db_connection()
+    try:
+        claimed = conn.execute("UPDATE audio_uploads SET status = 'composing', updated_at = CURRENT_TIMESTAMP "
+                               "WHERE id = ? AND status = 'receiving' AND received_bytes = total_size", (upload_id,)).rowcount
+        conn.commit()
+        if not claimed:
+            return fetch_audio_upload(upload_id)
+        upload = conn.execute("SELECT * FROM audio_uploads WHERE id = ?", (upload_id,)).fetchone()
+        part_names = [row['object_name'] for row in conn.execute(
+            "SELECT object_name FROM audio_upload_parts WHERE upload_id = ? ORDER BY offset", (upload_id,)).fetchall()]
     finally:
-        # Clean up the GCS file
-        if gcs_uri and blob_name:
+        conn.close()
+
+    object_name = f"audio_uploads/{upload_id}/audio"
+    try:
+        with span("gcs_compose"):
+            storage_backend.compose(object_name, part_names)
+        job_id = str(uuid.uuid4())
+        conn = get_db_connection()
+        try:
+            conn.execute("INSERT INTO transcription_jobs (id, note_id, status, filename, audio_path) VALUES (?, ?, 'queued', ?, ?)",
+                         (job_id, upload['note_id'], upload['filename'], STORED_AUDIO_PREFIX + object_name))
+            conn.execute("UPDATE audio_uploads SET status = 'completed', job_id = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (job_id, upload_id))
+            conn.execute("DELETE FROM audio_upload_parts WHERE upload_id = ?", (upload_id,))
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception:
+        # Back to receiving, so the client can ask for completion again
+        conn = get_db_connection()
+        try:
+            conn.execute("UPDATE audio_uploads SET status = 'receiving', updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'composing'", (upload_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        raise
+
+    delete_stored_objects(part_names)
+    submit_transcription_job(job_id, STORED_AUDIO_PREFIX + object_name, upload['filename'])
+    print(f"📥 Upload {upload_id} complete ({upload['total_size']} bytes in {len(part_names)} parts); transcription job {job_id} queued.")
+    return fetch_audio_upload(upload_id)
+
+def unrecord_upload_part(upload_id, offset, size, object_name):
+    # Undoes a recorded chunk while the upload is still receiving and at its end; True if it was removed
+    conn = get_db_connection()
+    try:
+        removed = conn.execute("UPDATE audio_uploads SET received_bytes = ?, updated_at = CURRENT_TIMESTAMP "
+                               "WHERE id = ? AND status = 'receiving' AND received_bytes = ?",
+                               (offset, upload_id, offset + size)).rowcount
+        if removed:
+            conn.execute("DELETE FROM audio_upload_parts WHERE upload_id = ? AND object_name = ?", (upload_id, object_name))
+        conn.commit()
+        return bool(removed)
+    finally:
+        conn.close()
+
+def expire_audio_uploads():
+    # Drops uploads that stopped receiving chunks UPLOAD_SESSION_TTL_SECONDS ago, with their part objects
+    conn = get_db_connection()
+    try:
+        expired = [row['id'] for row in conn.execute(
+            "SELECT id FROM audio_uploads WHERE status = 'receiving' AND updated_at < datetime('now', ?)",
+            (f"-{UPLOAD_SESSION_TTL_SECONDS} seconds",)).fetchall()]
+        if not expired:
+            return 0
+        placeholders = ", ".join("?" for _ in expired)
+        part_names = [row['object_name'] for row in conn.execute(
+            f"SELECT object_name FROM audio_upload_parts WHERE upload_id IN ({placeholders})", expired).fetchall()]
+        conn.execute(f"UPDATE audio_uploads SET status = 'expired', updated_at = CURRENT_TIMESTAMP WHERE id IN ({placeholders})", expired)
+        conn.execute(f"DELETE FROM audio_upload_parts WHERE upload_id IN ({placeholders})", expired)
+        conn.commit()
+    finally:
+        conn.close()
+    delete_stored_objects(part_names)
+    print(f"🧹 Expired {len(expired)} unfinished upload(s).")
+    return len(expired)
+
+def resume_audio_uploads():
+    # An upload that was being composed when the process stopped has all its parts; finish it now
+    conn = get_db_connection()
+    try:
+        conn.execute("UPDATE audio_uploads SET status = 'receiving' WHERE status = 'composing'")
+        conn.commit()
+        pending = [row['id'] for row in conn.execute(
+            "SELECT id FROM audio_uploads WHERE status = 'receiving' AND received_bytes = total_size").fetchall()]
+    finally:
+        conn.close()
+    for upload_id in pending:
+        try:
+            finish_audio_upload(upload_id)
+        except Exception as e:
+            print(f"🚨 Could not finish upload {upload_id}: {e}\n{traceback.format_exc()}")
+    expire_audio_uploads()
+    return len(pending)
+
+@app.route('/uploads', methods=['POST'])
+def create_audio_upload():
+    try:
+        data = request.get_json(silent=True) or {}
+        total_size = data.get('size')
+        if not isinstance(total_size, int) or isinstance(total_size, bool) or total_size <= 0:
+            return jsonify({"error": "'size' (total bytes, a positive integer) is required."}), 400
+        if total_size > UPLOAD_MAX_BYTES:
+            return jsonify({"error": f"Upload is larger than the {UPLOAD_MAX_BYTES} byte limit."}), 413
+        filename = os.path.basename(str(data.get('filename') or 'recording'))
+
+        expire_audio_uploads() # Cheap (indexed) when nothing is due
+        upload_id = str(uuid.uuid4())
+        conn = get_db_connection()
+        try:
+            conn.execute("INSERT INTO audio_uploads (id, note_id, filename, total_size) VALUES (?, ?, ?, ?)",
+                         (upload_id, data.get('note_id'), filename, total_size))
+            conn.commit()
+        finally:
+            conn.close()
+        print(f"📤 Upload {upload_id} started ({filename}, {total_size} bytes).")
+        response = audio_upload_response(fetch_audio_upload(upload_id), 201)
+        response.headers["Location"] = f"/uploads/{upload_id}"
+        return response
+    except Exception as e:
+        print(f"🚨 Error creating upload: {e}\n{traceback.format_exc()}")
+        return jsonify({"error": f"Failed to create upload: {str(e)}"}), 500
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_audio_upload(upload_id):
+    # Also answers HEAD: a client resuming after a dropped connection reads Upload-Offset and sends from there
+    try:
+        upload = fetch_audio_upload(upload_id)
+        if not upload:
+            return jsonify({"error": "Upload not found."}), 404
+        return audio_upload_response(upload)
+    except Exception as e:
+        print(f"🚨 Error fetching upload {upload_id}: {e}\n{traceback.format_exc()}")
+        return jsonify({"error": f"Failed to fetch upload: {str(e)}"}), 500
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def upload_audio_chunk(upload_id):
+    # Body: the bytes starting at the Upload-Offset header. An optional "Upload-Checksum: <algorithm> <base64>"
+    # is verified before the chunk counts. A chunk at the wrong offset gets a 409 with the offset to resume from.
+    part_name = None
+    try:
+        upload = fetch_audio_upload(upload_id)
+        if not upload:
+            return jsonify({"error": "Upload not found."}), 404
+        if upload['status'] != 'receiving':
+            return audio_upload_response(upload, 409)
+        try:
+            offset = int(request.headers.get("Upload-Offset", ""))
+        except ValueError:
+            return jsonify({"error": "Upload-Offset header (an integer) is required."}), 400
+        if offset != upload['received_bytes']:
+            return audio_upload_response(upload, 409)
+        size = request.content_length
+        if size is None:
+            return jsonify({"error": "Content-Length is required."}), 411
+        if size <= 0 or size > UPLOAD_MAX_CHUNK_BYTES:
+            return jsonify({"error": f"Chunks must be between 1 and {UPLOAD_MAX_CHUNK_BYTES} bytes."}), 413
+        if offset + size > upload['total_size']:
+            return jsonify({"error": "Chunk runs past the declared upload size."}), 400
+        try:
+            checksum = parse_upload_checksum(request.headers.get("Upload-Checksum"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Streamed on to storage as it is read; a concurrent retry of the same chunk writes its own part object
+        reader = UploadChunkReader(request.stream, size, {"sha256", checksum[0] if checksum else "sha256"})
+        part_name = f"audio_uploads/{upload_id}/parts/{offset:015d}-{uuid.uuid4().hex[:8]}"
+        with span("gcs_upload_part"):
+            storage_backend.upload(part_name, reader, size=size)
+        if checksum and reader.hashes[checksum[0]].digest() != checksum[1]:
+            print(f"⚠️ Upload {upload_id}: checksum mismatch for the chunk at offset {offset}.")
+            return jsonify({"error": "Checksum mismatch; resend the chunk.", "offset": offset}), 400
+
+        conn = get_db_connection()
+        try:
+            # Only one of two racing copies of a chunk moves the offset on; the other is discarded
+            claimed = conn.execute("UPDATE audio_uploads SET received_bytes = ?, updated_at = CURRENT_TIMESTAMP "
+                                   "WHERE id = ? AND status = 'receiving' AND received_bytes = ?",
+                                   (offset + size, upload_id, offset)).rowcount
+            if claimed:
+                conn.execute("INSERT INTO audio_upload_parts (upload_id, offset, size, sha256, object_name) VALUES (?, ?, ?, ?, ?)",
+                             (upload_id, offset, size, reader.hashes["sha256"].hexdigest(), part_name))
+            conn.commit()
+        finally:
+            conn.close()
+        if not claimed:
+            return audio_upload_response(fetch_audio_upload(upload_id), 409)
+        recorded_part, part_name = part_name, None # Recorded; it now belongs to the upload
+
+        if offset + size == upload['total_size']:
             try:
-                bucket = storage_client.bucket(GCS_BUCKET_NAME)
-                blob = bucket.blob(blob_name)
-                blob.delete()
-                print(f"Deleted GCS file: {gcs_uri}")
-            except Exception as e_del:
-                print(f"Error deleting GCS file {gcs_uri}: {e_del}\n{traceback.format_exc()}")
+                return audio_upload_response(finish_audio_upload(upload_id), 202)
+            except Exception:
+                # Take the last chunk back out, so a plain retry of it composes again instead of getting a 409
+                if unrecord_upload_part(upload_id, offset, size, recorded_part):
+                    part_name = recorded_part
+                raise
+        return audio_upload_response(fetch_audio_upload(upload_id))
+    except Exception as e:
+        print(f"🚨 Error receiving chunk for upload {upload_id}: {e}\n{traceback.format_exc()}")
+        return jsonify({"error": f"Failed to store upload chunk: {str(e)}"}), 500
+    finally:
+        # A part that was written but not recorded (bad checksum, lost race, failed request) is removed again
+        if part_name:
+            delete_stored_objects([part_name])
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_audio_upload(upload_id):
+    # Retries the hand-off to transcription if composing failed after the last chunk was stored
+    try:
+        upload = fetch_audio_upload(upload_id)
+        if not upload:
+            return jsonify({"error": "Upload not found."}), 404
+        if upload['status'] == 'receiving' and upload['received_bytes'] < upload['total_size']:
+            return audio_upload_response(upload, 409)
+        return audio_upload_response(finish_audio_upload(upload_id), 202)
+    except Exception as e:
+        print(f"🚨 Error completing upload {upload_id}: {e}\n{traceback.format_exc()}")
+        return jsonify({"error": f"Failed to complete upload: {str(e)}"}), 500
+
+class StreamingTranscriptionSession:
+    def __init__(self, stream_id, speech_backend):
+        self.stream_id = stream_id
+        self.speech_backend = speech_backend
+        self.chunks = queue.Queue(maxsize=STREAMING_MAX_QUEUED_CHUNKS)
+        self.next_seq = 0
+        self.final_parts = []
+        self.interim_text = ""
+        self.error = None
+        self.closed = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.push_lock = threading.Lock() # Serializes pushes; held while waiting for buffer room, so separate from lock
+        self.last_activity = time.time()
+        self.thread = threading.Thread(target=self._run, name=f"stt-stream-{stream_id[:8]}", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _audio_chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    def _run(self):
+        try:
+            for transcript, is_final in self.speech_backend.streaming_recognize(self._audio_chunks()):
+                with self.lock:
+                    if is_final:
+                        self.final_parts.append(transcript + " ")
+                        self.interim_text = ""
+                    else:
+                        self.interim_text = transcript
+        except Exception as e:
+            print(f"🚨 Streaming recognition failed for stream {self.stream_id}: {e}\n{traceback.format_exc()}")
+            with self.lock:
+                self.error = f"Streaming transcription error: {str(e)}"
+        finally:
+            self.done.set()
+
+    def push(self, seq, chunk):
+        with self.push_lock:
+            with self.lock:
+                if self.closed:
+                    raise ValueError("Stream already finished.")
+                if self.done.is_set():
+                    # The recognizer stopped (usually with an error); nothing would read this audio
+                    raise ValueError(self.error or "Streaming recognition has stopped.")
+                if seq != self.next_seq:
+                    raise ValueError(f"Out-of-order chunk: expected seq {self.next_seq}, got {seq}.")
+            if chunk:
+                try:
+                    self.chunks.put(chunk, timeout=STREAMING_CHUNK_PUT_TIMEOUT)
+                except queue.Full:
+                    raise ValueError("Streaming recognition is not keeping up with the audio.")
+            with self.lock:
+                self.next_seq += 1
+                self.last_activity = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.done.is_set():
+            return # The recognizer has stopped and won't read the end marker
+        try:
+            self.chunks.put(None, timeout=STREAMING_FINISH_TIMEOUT)
+        except queue.Full:
+            print(f"⚠️ Streaming session {self.stream_id}: recognizer did not drain its buffer; end marker dropped.")
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "stream_id": self.stream_id,
+                "text": "".join(self.final_parts).strip(),
+                "interim": self.interim_text,
+                "next_seq": self.next_seq,
+                "done": self.done.is_set(),
+                "error": self.error,
+            }
+
+def reap_idle_streaming_sessions():
+    now = time.time()
+    with streaming_sessions_lock:
+        stale = [sid for sid, sess in streaming_sessions.items() if now - sess.last_activity > STREAMING_SESSION_IDLE_TIMEOUT]
+        for sid in stale:
+            streaming_sessions.pop(sid).close()
+    for sid in stale:
+        print(f"⌛ Streaming session {sid} abandoned after {STREAMING_SESSION_IDLE_TIMEOUT}s without audio.")
+
+def reap_streaming_sessions_periodically():
+    # Abandoned sessions would otherwise keep their recognizer threads until the next session starts
+    while True:
+        time.sleep(STREAMING_REAP_INTERVAL)
+        try:
+            reap_idle_streaming_sessions()
+        except Exception as e:
+            print(f"🚨 Reaping idle streaming sessions failed: {e}\n{traceback.format_exc()}")
+
+def get_streaming_session(stream_id):
+    with streaming_sessions_lock:
+        return streaming_sessions.get(stream_id)
+
+@app.route('/stream_transcribe', methods=['POST'])
+def start_stream_transcription():
+    try:
+        reap_idle_streaming_sessions()
+        stream_id = str(uuid.uuid4())
+        session = StreamingTranscriptionSession(stream_id, speech_backend)
+        with streaming_sessions_lock:
+            streaming_sessions[stream_id] = session
+        session.start()
+        print(f"🎙️ Streaming transcription session {stream_id} started ({speech_backend.kind}).")
+        return jsonify({"stream_id": stream_id}), 201
+    except Exception as e:
+        print(f"🚨 Error starting streaming transcription: {e}\n{traceback.format_exc()}")
+        return jsonify({"error": f"Failed to start streaming transcription: {str(e)}"}), 500
+
+@app.route('/stream_transcribe/<stream_id>/chunk', methods=['POST'])
+def push_stream_chunk(stream_id):
+    session = get_streaming_session(stream_id)
+    if not session:
+        return jsonify({"error": "Streaming session not found."}), 404
+    seq = request.args.get('seq', type=int)
+    if seq is None:
+        return jsonify({"error": "Missing seq."}), 400
+    chunk = request.get_data()
+    try:
+        session.push(seq, chunk)
+    except ValueError as e:
+        return jsonify({"error": str(e), **session.snapshot()}), 409
+    # Each chunk response carries the latest interim/final text so the page needs no separate poll
+    return jsonify(session.snapshot()), 200
+
+@app.route('/stream_transcribe/<stream_id>', methods=['GET'])
+def get_stream_transcription(stream_id):
+    session = get_streaming_session(stream_id)
+    if not session:
+        return jsonify({"error": "Streaming session not found."}), 404
+    return jsonify(session.snapshot()), 200
+
+@app.route('/stream_transcribe/<stream_id>/finish', methods=['POST'])
+def finish_stream_transcription(stream_id):
+    session = get_streaming_session(stream_id)
+    if not session:
+        return jsonify({"error": "Streaming session not found."}), 404
+    session.close()
+    if not session.done.wait(STREAMING_FINISH_TIMEOUT):
+        return jsonify({"error": "Timed out waiting for final transcript.", **session.snapshot()}), 504
+    with streaming_sessions_lock:
+        streaming_sessions.pop(stream_id, None)
+    result = session.snapshot()
+    if result["error"]:
+        return jsonify(result), 502
+    print(f"📝 Streaming transcript for {stream_id}: {result['text']}")
+    return jsonify(result), 200
 
 @app.route('/create_note_session', methods=['POST'])
 def create_note_session():
@@ -163,25 +1060,175 @@ def create_note_session():
     except Exception as e:
         return jsonify({"error": f"Failed to create note session: {e}\n{traceback.format_exc()}"}), 500
 
-# Function to generate assessment using Gemini
-def generate_assessment_from_notes(subjective_text, objective_text):
-    if not gemini_model:
-        print("⚠️ Gemini model not available. Skipping assessment generation.")
+def count_generation_cache(stat, amount=1):
+    with generation_cache_stats_lock:
+        generation_cache_stats[stat] += amount
+    generation_cache_events.inc(amount, event=stat)
+
+def generation_cache_key(section, *input_sections):
+    # The digest settings decide whether the prompt carries the Subjective text or its digest, so they are part of the key
+    digest_settings = [TRANSCRIPT_DIGEST_ENABLED, SUBJECTIVE_TOKEN_BUDGET, DIGEST_PROMPT_VERSION]
+    payload = json.dumps([section, PROMPT_VERSIONS[section], digest_settings, *[text or "" for text in input_sections]])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get_cached_generation(cache_key):
+    if not GENERATION_CACHE_ENABLED:
+        return None
+    conn = get_db_connection()
+    try:
+        now = time.time()
+        row = conn.execute("SELECT response_text, created_at FROM generation_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+        if row and now - row['created_at'] <= GENERATION_CACHE_TTL_SECONDS:
+            conn.execute("UPDATE generation_cache SET last_accessed_at = ? WHERE cache_key = ?", (now, cache_key))
+            conn.commit()
+            count_generation_cache("hits")
+            return row['response_text']
+        count_generation_cache("misses")
+        return None
+    except Exception as e:
+        print(f"⚠️ Generation cache lookup failed: {e}")
         return None
+    finally:
+        conn.close()
 
-    kb_prompt_assessment_section = """## ASSESSMENT
----
+def store_cached_generation(cache_key, section, response_text):
+    if not GENERATION_CACHE_ENABLED or not response_text:
+        return
+    conn = get_db_connection()
+    try:
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO generation_cache (cache_key, section, prompt_version, response_text, size_bytes, created_at, last_accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (cache_key, section, PROMPT_VERSIONS[section], response_text, len(response_text.encode('utf-8')), now, now))
+        # Evict expired entries, then least recently used ones until the cache fits its byte budget
+        evicted = conn.execute("DELETE FROM generation_cache WHERE created_at < ?", (now - GENERATION_CACHE_TTL_SECONDS,)).rowcount
+        evicted += conn.execute('''
+            DELETE FROM generation_cache WHERE cache_key IN (
+                SELECT cache_key FROM (
+                    SELECT cache_key, SUM(size_bytes) OVER (ORDER BY last_accessed_at DESC, cache_key) AS running_bytes
+                    FROM generation_cache
+                ) WHERE running_bytes > ?
+            )
+        ''', (GENERATION_CACHE_MAX_BYTES,)).rowcount
+        conn.commit()
+        count_generation_cache("stores")
+        if evicted:
+            count_generation_cache("evictions", evicted)
+    except Exception as e:
+        print(f"⚠️ Generation cache store failed: {e}")
+    finally:
+        conn.close()
 
-### Diagnosis / Impression:
-{Summarize the patient’s condition(s) as concluded from the subjective and objective data. Include both primary and secondary diagnoses.}
+@app.route('/api/generation_cache/stats', methods=['GET'])
+def generation_cache_stats_api():
+    try:
+        conn = get_db_connection()
+        try:
+            row = conn.execute("SELECT COUNT(*) AS entries, COALESCE(SUM(size_bytes), 0) AS size_bytes FROM generation_cache").fetchone()
+        finally:
+            conn.close()
+        with generation_cache_stats_lock:
+            stats = dict(generation_cache_stats)
+        stats.update({"entries": row['entries'], "size_bytes": row['size_bytes'], "max_bytes": GENERATION_CACHE_MAX_BYTES,
+                      "ttl_seconds": GENERATION_CACHE_TTL_SECONDS, "enabled": GENERATION_CACHE_ENABLED,
+                      "single_flight": generation_flight.snapshot()})
+        return jsonify(stats), 200
+    except Exception as e:
+        return jsonify({"error": f"Failed to read generation cache stats: {e}"}), 500
+
+# Token budget: prompt sizes are estimated in tokens (about four characters each for English clinical text).
+# A Subjective section over SUBJECTIVE_TOKEN_BUDGET, typically a long pasted transcript, is condensed once into a
+# digest that is stored in note_digests and used in its place by the assessment, plan and summary prompts.
+CHARS_PER_TOKEN = 4
+SUBJECTIVE_TOKEN_BUDGET = int(os.environ.get("SUBJECTIVE_TOKEN_BUDGET", "3000"))
+TRANSCRIPT_DIGEST_ENABLED = os.environ.get("TRANSCRIPT_DIGEST", "1") == "1"
+DIGEST_PROMPT_VERSION = "1"
+digest_flight = SingleFlight("digest")
+
+def estimate_tokens(text):
+    return (len(text or "") + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def build_digest_prompt(subjective_text):
+    return f"""You are an AI medical assistant. Below is the SUBJECTIVE part of a patient encounter, often a verbatim transcript.
+Write a CLINICAL DIGEST of it that a clinician could rely on instead of the full text:
+- Keep every clinically relevant fact: chief complaint, history of present illness with onset, duration, timing and severity, associated symptoms, pertinent negatives, past medical and surgical history, medications with doses, allergies, family and social history, and the patient's concerns and goals.
+- Copy numbers, doses, dates and medication names exactly. Attribute statements to the patient or clinician when it matters.
+- Leave out small talk, repetition and filler. Do not add, infer or interpret anything that is not stated.
+- Use short headed sections and bullet points.
+
+TRANSCRIPT
+---
+{subjective_text}
 
-### Differential Diagnosis (DDx):
-{If a definitive diagnosis is not established, list possible diagnoses in order of likelihood, with rationale for each.}"""
+Now, write only the clinical digest.
+"""
 
-    prompt = f"""You are an AI medical assistant. Your task is to generate the ASSESSMENT section of a medical SOAP note.
-Use the provided Subjective and Objective information to create a concise and clinically relevant Assessment.
-The Assessment should strictly follow this format:
-{kb_prompt_assessment_section}
+def get_subjective_digest(subjective_text, priority=INTERACTIVE, note_id=None):
+    # The digest to use in place of an over-budget Subjective section, or None to use the section as is
+    if not TRANSCRIPT_DIGEST_ENABLED or estimate_tokens(subjective_text) <= SUBJECTIVE_TOKEN_BUDGET:
+        return None
+    source_hash = hashlib.sha256(f"{DIGEST_PROMPT_VERSION}\n{subjective_text}".encode('utf-8')).hexdigest()
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT digest_text FROM note_digests WHERE source_hash = ?", (source_hash,)).fetchone()
+    finally:
+        conn.close()
+    if row:
+        transcript_digest_events.inc(event="reused")
+        return row['digest_text']
+    # The three sections of one note often ask at once; only one of them condenses the transcript
+    return digest_flight.do(source_hash, lambda: create_subjective_digest(subjective_text, source_hash, priority, note_id))
+
+def create_subjective_digest(subjective_text, source_hash, priority, note_id):
+    if not llm_backend.available():
+        return None
+    prompt = build_digest_prompt(subjective_text)
+    try:
+        print(f"🗜️ Condensing a {estimate_tokens(subjective_text)}-token Subjective section (budget {SUBJECTIVE_TOKEN_BUDGET})...")
+        with span("gemini_generate", section="digest"):
+            digest_text = (gemini_guard.call(lambda: llm_backend.generate(prompt), priority) or "").strip()
+        record_llm_sizes("digest", prompt, digest_text)
+    except ServiceUnavailableError:
+        raise
+    except Exception as e:
+        print(f"⚠️ Subjective digest failed, using the full text: {e}\n{traceback.format_exc()}")
+        transcript_digest_events.inc(event="failed")
+        return None
+    source_tokens, digest_tokens = estimate_tokens(subjective_text), estimate_tokens(digest_text)
+    if not digest_text or digest_tokens >= source_tokens:
+        print("⚠️ Subjective digest was empty or no shorter than the original; using the full text.")
+        transcript_digest_events.inc(event="failed")
+        return None
+    conn = get_db_connection()
+    try:
+        if note_id is not None:
+            conn.execute("DELETE FROM note_digests WHERE note_id = ?", (note_id,)) # Digests of the note's earlier Subjective text
+        conn.execute('''
+            INSERT OR REPLACE INTO note_digests (source_hash, note_id, digest_text, source_tokens, digest_tokens, prompt_version, model)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (source_hash, note_id, digest_text, source_tokens, digest_tokens, DIGEST_PROMPT_VERSION, llm_backend.model_name))
+        conn.commit()
+    except Exception as e:
+        print(f"⚠️ Storing the Subjective digest failed: {e}")
+    finally:
+        conn.close()
+    transcript_digest_events.inc(event="created")
+    print(f"✅ Subjective condensed from ~{source_tokens} to ~{digest_tokens} tokens.")
+    return digest_text
+
+def build_section_prompt(section, input_sections, priority=INTERACTIVE, note_id=None):
+    # input_sections start with the Subjective text (see SECTION_INPUT_FIELDS)
+    subjective_text, *other_sections = input_sections
+    digest_text = get_subjective_digest(subjective_text, priority, note_id)
+    if digest_text:
+        subjective_text = f"(Clinical digest of a longer transcript.)\n{digest_text}"
+    return SECTION_PROMPT_BUILDERS[section](subjective_text, *other_sections)
+
+# Prompt builders and output checks shared by the blocking and streaming generation paths.
+# All three prompts open with the same encounter context (plan and summary also share the Assessment after it)
+# and put their section-specific instructions last, so the model's prefix cache can reuse the common part.
+def build_encounter_context(subjective_text, objective_text):
+    return f"""You are an AI medical assistant helping a clinician write the medical SOAP note for one patient encounter.
+The encounter documented so far:
 
 SUBJECTIVE
 ---
@@ -190,38 +1237,30 @@ SUBJECTIVE
 OBJECTIVE
 ---
 {objective_text}
+"""
+
+def build_assessment_prompt(subjective_text, objective_text):
+    kb_prompt_assessment_section = """## ASSESSMENT
+---
+
+### Diagnosis / Impression:
+{Summarize the patient’s condition(s) as concluded from the subjective and objective data. Include both primary and secondary diagnoses.}
+
+### Differential Diagnosis (DDx):
+{If a definitive diagnosis is not established, list possible diagnoses in order of likelihood, with rationale for each.}"""
+
+    return f"""{build_encounter_context(subjective_text, objective_text)}
+Your task is to generate the ASSESSMENT section of this SOAP note.
+Use the Subjective and Objective information above to create a concise and clinically relevant Assessment.
+The Assessment should strictly follow this format:
+{kb_prompt_assessment_section}
 
 Now, please generate *only* the ASSESSMENT section based on the above information and the guidelines provided.
 Do not include "ASSESSMENT" heading in your response, start directly with "### Diagnosis / Impression:".
 """
-    try:
-        print(f"🧠 Generating assessment for S: '{subjective_text[:100]}...', O: '{objective_text[:100]}...'")
-        response = gemini_model.generate_content(prompt)
-        if response and response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
-            generated_text = response.candidates[0].content.parts[0].text.strip()
-            print(f"✅ Gemini generated assessment: {generated_text[:200]}...")
-            # Basic validation: check if it looks like an assessment
-            if "Diagnosis / Impression:" in generated_text or "Differential Diagnosis (DDx):" in generated_text:
-                return generated_text
-            else:
-                print(f"⚠️ Gemini response did not seem to contain a valid assessment structure: {generated_text[:200]}...")
-                return None
-        else:
-            print(f"⚠️ Gemini response was empty or malformed: {response}")
-            return None
-    except Exception as e:
-        print(f"🚨 Error calling Gemini API or processing response: {e}\n{traceback.format_exc()}")
-        return None
-
-# Function to generate plan using Gemini
-def generate_plan_from_soap_notes(subjective_text, objective_text, assessment_text):
-    global gemini_model # Ensure gemini_model is accessible
-    if not gemini_model:
-        print("⚠️ Gemini model not available for plan generation.")
-        return None
 
-    kb_prompt_prefix_plan = """You are an AI medical assistant. Based on the provided Subjective, Objective, and Assessment sections of a SOAP note, generate the PLAN section.
-The PLAN section should include:
+def build_plan_prompt(subjective_text, objective_text, assessment_text):
+    kb_prompt_plan_section = """The PLAN section should include:
 1. Diagnostics / Tests Ordered: List any additional diagnostic tests ordered and the rationale.
 2. Medications / Therapy: Document any medications prescribed, changes to existing meds, or therapies initiated.
 3. Referrals / Consults: Include any specialist referrals or consultations.
@@ -244,79 +1283,267 @@ PLAN
 [Your generated patient education/counseling here]
 
 ### Follow-Up Instructions:
-[Your generated follow-up instructions here]
-
-Here is the patient's information:
-"""
+[Your generated follow-up instructions here]"""
 
-    full_prompt = f"""{kb_prompt_prefix_plan}
-SUBJECTIVE
+    return f"""{build_encounter_context(subjective_text, objective_text)}
+ASSESSMENT
 ---
-{subjective_text}
+{assessment_text}
 
-OBJECTIVE
----
-{objective_text}
+Your task is to generate the PLAN section of this SOAP note.
+{kb_prompt_plan_section}
+
+Now, please generate only the PLAN section based on ALL the above information (Subjective, Objective, and Assessment) and the guidelines provided.
+"""
 
+def build_summary_prompt(subjective_text, objective_text, assessment_text, plan_text):
+    return f"""{build_encounter_context(subjective_text, objective_text)}
 ASSESSMENT
 ---
 {assessment_text}
 
-Now, please generate only the PLAN section based on ALL the above information (Subjective, Objective, and Assessment) and the guidelines provided.
+PLAN
+---
+{plan_text}
+
+Now, please generate a concise clinical summary of this entire encounter (Subjective, Objective, Assessment, and Plan).
 """
+
+def is_valid_assessment(generated_text):
+    # Basic validation: check if it looks like an assessment
+    return "Diagnosis / Impression:" in generated_text or "Differential Diagnosis (DDx):" in generated_text
+
+def looks_like_plan(generated_plan):
+    return "PLAN" in generated_plan.upper() or any(kw in generated_plan.upper() for kw in ["DIAGNOSTICS", "MEDICATIONS", "THERAPY", "REFERRALS", "EDUCATION", "FOLLOW-UP"])
+
+# Function to generate assessment using Gemini
+def generate_assessment_from_notes(subjective_text, objective_text, use_cache=True, priority=INTERACTIVE, note_id=None):
+    cache_key = generation_cache_key("assessment", subjective_text, objective_text)
+    cached_text = get_cached_generation(cache_key) if use_cache else None
+    if cached_text is not None:
+        print("⚡ Assessment served from generation cache.")
+        return cached_text
+
+    if not llm_backend.available():
+        print("⚠️ Gemini model not available. Skipping assessment generation.")
+        return None
+
+    try:
+        prompt = build_section_prompt("assessment", [subjective_text, objective_text], priority, note_id)
+        print(f"🧠 Generating assessment for S: '{subjective_text[:100]}...', O: '{objective_text[:100]}...'")
+        with span("gemini_generate", section="assessment"):
+            response_text = gemini_guard.call(lambda: llm_backend.generate(prompt), priority)
+        record_llm_sizes("assessment", prompt, response_text)
+        if response_text is not None:
+            generated_text = response_text.strip()
+            print(f"✅ Gemini generated assessment: {generated_text[:200]}...")
+            if is_valid_assessment(generated_text):
+                store_cached_generation(cache_key, "assessment", generated_text)
+                return generated_text
+            else:
+                print(f"⚠️ Gemini response did not seem to contain a valid assessment structure: {generated_text[:200]}...")
+                return None
+        else:
+            print("⚠️ Gemini response was empty or malformed.")
+            return None
+    except ServiceUnavailableError:
+        raise # Surfaced to the client as a 503 with Retry-After
+    except Exception as e:
+        print(f"🚨 Error calling Gemini API or processing response: {e}\n{traceback.format_exc()}")
+        return None
+
+# Function to generate plan using Gemini
+def generate_plan_from_soap_notes(subjective_text, objective_text, assessment_text, use_cache=True, priority=INTERACTIVE, note_id=None):
+    cache_key = generation_cache_key("plan", subjective_text, objective_text, assessment_text)
+    cached_text = get_cached_generation(cache_key) if use_cache else None
+    if cached_text is not None:
+        print("⚡ Plan served from generation cache.")
+        return cached_text
+
+    if not llm_backend.available():
+        print("⚠️ Gemini model not available for plan generation.")
+        return None
+
     try:
+        full_prompt = build_section_prompt("plan", [subjective_text, objective_text, assessment_text], priority, note_id)
         print(f"🤖 Sending prompt to Gemini for PLAN generation (Note ID context)...")
-        response = gemini_model.generate_content(full_prompt)
-        generated_plan = ""
-        if response.candidates and response.candidates[0].content.parts:
-            generated_plan = response.candidates[0].content.parts[0].text.strip()
+        with span("gemini_generate", section="plan"):
+            generated_plan = (gemini_guard.call(lambda: llm_backend.generate(full_prompt), priority) or "").strip()
+        record_llm_sizes("plan", full_prompt, generated_plan)
         
         # Basic check if the response seems like a plan
-        if "PLAN" not in generated_plan.upper() and not any(kw in generated_plan.upper() for kw in ["DIAGNOSTICS", "MEDICATIONS", "THERAPY", "REFERRALS", "EDUCATION", "FOLLOW-UP"]):
+        if not looks_like_plan(generated_plan):
             print(f"⚠️ Gemini response might not be a valid plan: {generated_plan[:200]}...")
         
         print(f"✅ Gemini generated plan (Note ID context): {generated_plan[:200]}...")
+        store_cached_generation(cache_key, "plan", generated_plan)
         return generated_plan
+    except ServiceUnavailableError:
+        raise
     except Exception as e:
         print(f"Error calling Gemini API for plan generation: {e}\\n{traceback.format_exc()}")
         return None
 
 # Function to generate summary using Gemini
-def generate_summary_from_soap_note(subjective_text, objective_text, assessment_text, plan_text):
-    global gemini_model # Ensure gemini_model is accessible
-    if not gemini_model:
+def generate_summary_from_soap_note(subjective_text, objective_text, assessment_text, plan_text, use_cache=True, priority=INTERACTIVE, note_id=None):
+    cache_key = generation_cache_key("summary", subjective_text, objective_text, assessment_text, plan_text)
+    cached_text = get_cached_generation(cache_key) if use_cache else None
+    if cached_text is not None:
+        print("⚡ Summary served from generation cache.")
+        return cached_text
+
+    if not llm_backend.available():
         print("Gemini model not available for summary generation.")
         return None
 
-    prompt = f"""You are an AI medical assistant. Based on the complete SOAP note provided below (Subjective, Objective, Assessment, and Plan), generate a concise clinical summary of the patient encounter.
-
-SUBJECTIVE:
-{subjective_text}
-
-OBJECTIVE:
-{objective_text}
-
-ASSESSMENT:
-{assessment_text}
-
-PLAN:
-{plan_text}
-
-Now, please generate a concise clinical summary of this entire encounter.
-"""
     try:
+        prompt = build_section_prompt("summary", [subjective_text, objective_text, assessment_text, plan_text], priority, note_id)
         print(f"🤖 Sending prompt to Gemini for SUMMARY generation...")
-        response = gemini_model.generate_content(prompt)
-        generated_summary = ""
-        if response.candidates and response.candidates[0].content.parts:
-            generated_summary = response.candidates[0].content.parts[0].text.strip()
+        with span("gemini_generate", section="summary"):
+            generated_summary = (gemini_guard.call(lambda: llm_backend.generate(prompt), priority) or "").strip()
+        record_llm_sizes("summary", prompt, generated_summary)
         
         print(f"✅ Gemini generated summary: {generated_summary[:200]}...") # Log a snippet
+        store_cached_generation(cache_key, "summary", generated_summary)
         return generated_summary
+    except ServiceUnavailableError:
+        raise
     except Exception as e:
         print(f"Error calling Gemini API for summary generation: {e}\\n{traceback.format_exc()}")
         return None
 
+# Streaming (Server-Sent Events) variants of the generate endpoints.
+# Event stream: any number of "delta" events with partial text, then exactly one "done" event with the
+# checked full text or one "generation_error" event ("error" is reserved by the browser's EventSource).
+SECTION_INPUT_FIELDS = {
+    "assessment": ["subjective_text", "objective_text"],
+    "plan": ["subjective_text", "objective_text", "assessment_text"],
+    "summary": ["subjective_text", "objective_text", "assessment_text", "plan_text"],
+}
+SECTION_PROMPT_BUILDERS = {
+    "assessment": build_assessment_prompt,
+    "plan": build_plan_prompt,
+    "summary": build_summary_prompt,
+}
+SECTION_LABELS = {"subjective_text": "Subjective", "objective_text": "Objective", "assessment_text": "Assessment", "plan_text": "Plan"}
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def stream_section_generation(section, input_sections, use_cache=True, note_id=None):
+    cache_key = generation_cache_key(section, *input_sections)
+    cached_text = get_cached_generation(cache_key) if use_cache else None
+    if cached_text is not None:
+        print(f"⚡ {section.capitalize()} streamed from generation cache.")
+        yield sse_event("delta", {"text": cached_text})
+        yield sse_event("done", {f"{section}_text": cached_text, "cached": True})
+        return
+
+    speculative_text = take_speculative_generation(note_id, section, input_sections) if use_cache and note_id else None
+    if speculative_text:
+        yield sse_event("delta", {"text": speculative_text})
+        yield sse_event("done", {f"{section}_text": speculative_text, "cached": True})
+        return
+
+    flight_key = (note_id, section, cache_key, use_cache)
+    flight, leader = generation_flight.acquire(flight_key)
+    if not leader:
+        # An identical generation is already running (another tab or a double-click): wait and reuse its result
+        print(f"🔗 {section.capitalize()} for Note ID {note_id} joined an in-flight generation.")
+        try:
+            shared_text = flight.wait(GENERATION_FLIGHT_WAIT_TIMEOUT_SECONDS)
+        except Exception:
+            shared_text = None
+        if shared_text:
+            yield sse_event("delta", {"text": shared_text})
+            yield sse_event("done", {f"{section}_text": shared_text, "cached": True})
+        else:
+            yield sse_event("generation_error", {"error": f"Could not generate {section}. AI error or invalid response."})
+        return
+
+    generated_text = None
+    try:
+        generated_text = yield from stream_model_generation(section, input_sections, cache_key, note_id)
+    finally:
+        generation_flight.release(flight_key, flight, generated_text)
+
+def stream_model_generation(section, input_sections, cache_key, note_id=None):
+    # Streams the model's output as SSE events; returns the checked text, or None on failure
+    if not llm_backend.available():
+        yield sse_event("generation_error", {"error": f"Could not generate {section}. AI model not available."})
+        return
+
+    parts = []
+    try:
+        prompt = build_section_prompt(section, input_sections, INTERACTIVE, note_id)
+        print(f"🤖 Streaming {section.upper()} generation from Gemini...")
+        started = time.perf_counter()
+        with span("gemini_stream", section=section):
+            for chunk_text in gemini_guard.stream(lambda: llm_backend.generate_stream(prompt), INTERACTIVE):
+                if not parts:
+                    llm_time_to_first_chunk.observe(time.perf_counter() - started, section=section)
+                parts.append(chunk_text)
+                yield sse_event("delta", {"text": chunk_text})
+    except ServiceUnavailableError as e:
+        print(f"⏳ Streamed {section} generation rejected: {e}")
+        yield sse_event("generation_error", {"error": f"Could not generate {section}. {e}", "retry_after": e.retry_after})
+        return
+    except Exception as e:
+        print(f"🚨 Error streaming {section} from Gemini: {e}\n{traceback.format_exc()}")
+        yield sse_event("generation_error", {"error": f"Could not generate {section}. AI error."})
+        return
+
+    # The same structure checks as the blocking endpoints, run once the stream has ended
+    generated_text = "".join(parts).strip()
+    record_llm_sizes(section, prompt, generated_text)
+    if not generated_text or (section == "assessment" and not is_valid_assessment(generated_text)):
+        print(f"⚠️ Streamed {section} failed validation: {generated_text[:200]}...")
+        yield sse_event("generation_error", {"error": f"Could not generate {section}. AI error or invalid response."})
+        return
+    if section == "plan" and not looks_like_plan(generated_text):
+        print(f"⚠️ Gemini response might not be a valid plan: {generated_text[:200]}...")
+    store_cached_generation(cache_key, section, generated_text)
+    print(f"✅ Gemini streamed {section}: {generated_text[:200]}...")
+    yield sse_event("done", {f"{section}_text": generated_text, "cached": False})
+    return generated_text
+
+def stream_section_api(note_id, section):
+    conn = None
+    try:
+        fields = SECTION_INPUT_FIELDS[section]
+        conn = get_db_connection()
+        note_data = conn.execute(f"SELECT {', '.join(fields)} FROM notes WHERE id = ?", (note_id,)).fetchone()
+        if not note_data:
+            return jsonify({"error": "Note not found."}), 404
+        input_sections = [note_data[field] for field in fields]
+        missing_fields = [SECTION_LABELS[field] for field, text in zip(fields, input_sections) if not text or not text.strip()]
+        if missing_fields:
+            print(f"ℹ️ Missing data for Note ID {note_id} for streamed {section} generation. Missing: {', '.join(missing_fields)}")
+            return jsonify({"error": f"Could not generate {section}. Missing data ({', '.join(missing_fields)} is missing or empty)."}), 500
+    except Exception as e:
+        print(f"🚨 Error in /api/generate_{section}/{note_id}/stream: {e}\n{traceback.format_exc()}")
+        return jsonify({"error": f"Server error: {e}"}), 500
+    finally:
+        if conn:
+            conn.close()
+
+    use_cache = request.args.get('refresh') != '1'
+    return Response(stream_with_context(stream_section_generation(section, input_sections, use_cache=use_cache, note_id=note_id)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/generate_assessment/<int:note_id>/stream', methods=['GET'])
+def generate_assessment_stream_api(note_id):
+    return stream_section_api(note_id, "assessment")
+
+@app.route('/api/generate_plan/<int:note_id>/stream', methods=['GET'])
+def generate_plan_stream_api(note_id):
+    return stream_section_api(note_id, "plan")
+
+@app.route('/api/generate_summary/<int:note_id>/stream', methods=['GET'])
+def generate_summary_stream_api(note_id):
+    return stream_section_api(note_id, "summary")
+
 def update_note_field(note_id, data_dict, field_map):
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -336,11 +1563,16 @@ def update_note_field(note_id, data_dict, field_map):
     
     try:
         cursor.execute(sql, tuple(values_to_update))
+        forget_note_generations(conn, [note_id], [column for key, column in field_map.items() if key in data_dict])
         conn.commit()
         if cursor.rowcount == 0:
             conn.close()
             return jsonify({"error": "Note not found or no update made."}), 404
+        note_cache.invalidate([note_id])
         print(f"💾 Note ID {note_id} updated. Fields: {', '.join(field_map.values())}")
+        for key, column_name in field_map.items():
+            if key in data_dict:
+                on_note_section_saved(note_id, column_name)
         return jsonify({"message": f"Note ID {note_id} updated successfully."}), 200
     except Exception as e:
         return jsonify({"error": f"Database error updating note: {e}\n{traceback.format_exc()}"}), 500
@@ -374,7 +1606,9 @@ def update_objective():
         if cursor.rowcount == 0:
             print(f"⚠️ Objective update failed: Note ID {note_id} not found or no update made.")
             return jsonify({"error": "Note not found or no update made for objective text."}), 404
+        note_cache.invalidate([note_id])
         print(f"💾 Objective text for Note ID {note_id} updated successfully.")
+        on_note_section_saved(note_id, "objective_text")
         return jsonify({"message": f"Objective text for Note ID {note_id} updated successfully."}), 200
     except Exception as e:
         print(f"🚨 Database error during objective update for Note ID {note_id}: {e}\n{traceback.format_exc()}")
@@ -403,7 +1637,10 @@ def generate_assessment_api(note_id):
             return jsonify({"error": "Could not generate assessment. Missing S/O data."}), 500
 
         print(f"🤖 Attempting to generate assessment on-demand for note ID {note_id}...")
-        generated_assessment = generate_assessment_from_notes(subjective_text, objective_text)
+        use_cache = request.args.get('refresh') != '1'
+        generated_assessment = take_speculative_generation(note_id, "assessment", [subjective_text, objective_text]) if use_cache else None
+        if generated_assessment is None:
+            generated_assessment = generate_section_coalesced(note_id, "assessment", [subjective_text, objective_text], use_cache)
         
         if generated_assessment:
             print(f"✅ On-demand assessment generated for Note ID {note_id}.")
@@ -412,6 +1649,9 @@ def generate_assessment_api(note_id):
             print(f"⚠️ On-demand assessment generation failed for Note ID {note_id} (AI error or empty response).")
             return jsonify({"error": "Could not generate assessment. AI error."}), 500
 
+    except ServiceUnavailableError as e:
+        print(f"⏳ /api/generate_assessment/{note_id} rejected: {e}")
+        return service_unavailable_response(e)
     except Exception as e:
         print(f"🚨 Error in /api/generate_assessment/{note_id}: {e}\n{traceback.format_exc()}")
         return jsonify({"error": f"Server error: {e}"}), 500
@@ -435,11 +1675,14 @@ def update_assessment():
     try:
         # Save the assessment text
         cursor.execute("UPDATE notes SET assessment_text = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (assessment_text_to_save, note_id))
+        forget_note_generations(conn, [note_id], ["assessment_text"])
         conn.commit()
         if cursor.rowcount == 0:
             print(f"⚠️ Assessment update failed: Note ID {note_id} not found or no update made.")
             return jsonify({"error": "Note not found or no update made for assessment text."}), 404
+        note_cache.invalidate([note_id])
         print(f"💾 Assessment text for Note ID {note_id} updated successfully.")
+        on_note_section_saved(note_id, "assessment_text")
         return jsonify({"message": f"Assessment text for Note ID {note_id} updated successfully."}), 200
 
     except Exception as e:
@@ -474,7 +1717,10 @@ def generate_plan_api(note_id):
             return jsonify({"error": f"Could not generate plan. Missing S/O/A data ({', '.join(missing_fields)} is missing or empty)."}), 500
 
         print(f"🤖 Attempting to generate plan on-demand for note ID {note_id}...")
-        generated_plan_text = generate_plan_from_soap_notes(subjective_text, objective_text, assessment_text)
+        use_cache = request.args.get('refresh') != '1'
+        generated_plan_text = take_speculative_generation(note_id, "plan", [subjective_text, objective_text, assessment_text]) if use_cache else None
+        if generated_plan_text is None:
+            generated_plan_text = generate_section_coalesced(note_id, "plan", [subjective_text, objective_text, assessment_text], use_cache)
         
         if generated_plan_text is not None: # Check for None, as empty string could be a valid (though unlikely) plan
             print(f"✅ On-demand plan generated for Note ID {note_id}.")
@@ -483,6 +1729,9 @@ def generate_plan_api(note_id):
             print(f"⚠️ On-demand plan generation failed for Note ID {note_id} (AI error or empty response).")
             return jsonify({"error": "Could not generate plan. AI error or empty response."}), 500
 
+    except ServiceUnavailableError as e:
+        print(f"⏳ /api/generate_plan/{note_id} rejected: {e}")
+        return service_unavailable_response(e)
     except Exception as e:
         print(f"🚨 Error in /api/generate_plan/{note_id}: {e}\n{traceback.format_exc()}")
         return jsonify({"error": f"Server error: {e}"}), 500
@@ -506,11 +1755,14 @@ def update_plan():
     try:
         # Save the plan text
         cursor.execute("UPDATE notes SET plan_text = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (plan_text_to_save, note_id))
+        forget_note_generations(conn, [note_id], ["plan_text"])
         conn.commit()
         if cursor.rowcount == 0:
             print(f"⚠️ Plan update failed: Note ID {note_id} not found or no update made.")
             return jsonify({"error": "Note not found or no update made for plan text."}), 404
+        note_cache.invalidate([note_id])
         print(f"💾 Plan text for Note ID {note_id} updated successfully.")
+        on_note_section_saved(note_id, "plan_text")
         return jsonify({"message": f"Plan text for Note ID {note_id} updated successfully."}), 200
 
     except Exception as e:
@@ -547,7 +1799,10 @@ def generate_summary_api(note_id):
             return jsonify({"error": f"Could not generate summary. Missing S/O/A/P data ({', '.join(missing_fields)} is missing or empty)."}), 500
 
         print(f"🤖 Attempting to generate summary on-demand for note ID {note_id}...")
-        generated_summary_text = generate_summary_from_soap_note(subjective_text, objective_text, assessment_text, plan_text)
+        use_cache = request.args.get('refresh') != '1'
+        generated_summary_text = take_speculative_generation(note_id, "summary", [subjective_text, objective_text, assessment_text, plan_text]) if use_cache else None
+        if generated_summary_text is None:
+            generated_summary_text = generate_section_coalesced(note_id, "summary", [subjective_text, objective_text, assessment_text, plan_text], use_cache)
         
         if generated_summary_text is not None:
             print(f"✅ On-demand summary generated for Note ID {note_id}.")
@@ -556,29 +1811,684 @@ def generate_summary_api(note_id):
             print(f"⚠️ On-demand summary generation failed for Note ID {note_id} (AI error or empty response).")
             return jsonify({"error": "Could not generate summary. Missing S/O/A/P data or AI error."}), 500
 
+    except ServiceUnavailableError as e:
+        print(f"⏳ /api/generate_summary/{note_id} rejected: {e}")
+        return service_unavailable_response(e)
     except Exception as e:
         print(f"🚨 Error in /api/generate_summary/{note_id}: {e}\n{traceback.format_exc()}")
         return jsonify({"error": f"Server error: {e}"}), 500
     finally:
         if conn:
             conn.close()
-@app.route('/get_note_data/<int:note_id>', methods=['GET'])
-def get_note(note_id):
+# One-shot SOAP pipeline: Assessment -> Plan -> Summary on the server, saving each section as it completes.
+# Progress is persisted per note so a failed run can resume after its last completed stage.
+SOAP_PIPELINE_STAGES = ["assessment", "plan", "summary"]
+SECTION_GENERATORS = {
+    "assessment": generate_assessment_from_notes,
+    "plan": generate_plan_from_soap_notes,
+    "summary": generate_summary_from_soap_note,
+}
+
+def generate_section_coalesced(note_id, section, input_sections, use_cache=True, priority=INTERACTIVE):
+    # Joins an identical in-flight generation (blocking, streamed or pipeline) instead of calling the model again
+    key = (note_id, section, generation_cache_key(section, *input_sections), use_cache)
+    return generation_flight.do(key, lambda: SECTION_GENERATORS[section](*input_sections, use_cache=use_cache, priority=priority, note_id=note_id))
+
+# note_generations bookkeeping: sections the server writes itself are tagged with their prompt version so a
+# prompt change can be backfilled (regenerate_notes.py); a clinician's own save of a section drops the tag.
+def record_note_generations(conn, rows):
+    # rows: (note_id, section, input_hash) tuples, written in the caller's transaction
+    conn.executemany('''
+        INSERT INTO note_generations (note_id, section, prompt_version, input_hash, model, generated_at)
+        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(note_id, section) DO UPDATE SET prompt_version = excluded.prompt_version, input_hash = excluded.input_hash,
+            model = excluded.model, generated_at = CURRENT_TIMESTAMP
+    ''', [(note_id, section, PROMPT_VERSIONS[section], input_hash, llm_backend.model_name) for note_id, section, input_hash in rows])
+
+def forget_note_generations(conn, note_ids, columns):
+    sections = [column[:-len("_text")] for column in columns if column[:-len("_text")] in PROMPT_VERSIONS]
+    if sections:
+        conn.executemany(f"DELETE FROM note_generations WHERE note_id = ? AND section IN ({', '.join('?' * len(sections))})",
+                         [(note_id, *sections) for note_id in note_ids])
+soap_pipelines_running = set() # note_ids with a pipeline in progress
+soap_pipelines_running_lock = threading.Lock()
+
+def get_soap_pipeline_state(note_id):
+    conn = get_db_connection()
     try:
+        return conn.execute("SELECT * FROM soap_pipeline_runs WHERE note_id = ?", (note_id,)).fetchone()
+    finally:
+        conn.close()
+
+def set_soap_pipeline_state(note_id, status, last_completed_stage, error=None):
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            INSERT INTO soap_pipeline_runs (note_id, status, last_completed_stage, error, updated_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(note_id) DO UPDATE SET status = excluded.status, last_completed_stage = excluded.last_completed_stage,
+                error = excluded.error, updated_at = CURRENT_TIMESTAMP
+        ''', (note_id, status, last_completed_stage, error))
+        conn.commit()
+    finally:
+        conn.close()
+
+def run_soap_pipeline(note_id, resume=True):
+    # Yields (event, payload) progress tuples. The note is read once; later stages use the sections
+    # produced earlier in the run instead of re-reading the row.
+    conn = get_db_connection()
+    try:
+        note = conn.execute("SELECT subjective_text, objective_text, assessment_text, plan_text, summary_text FROM notes WHERE id = ?", (note_id,)).fetchone()
+    finally:
+        conn.close()
+    if not note:
+        yield "pipeline_error", {"stage": None, "error": "Note not found."}
+        return
+    sections = dict(note)
+
+    state = get_soap_pipeline_state(note_id) if resume else None
+    last_completed_stage = state['last_completed_stage'] if state and state['status'] != 'completed' else None
+    start_index = SOAP_PIPELINE_STAGES.index(last_completed_stage) + 1 if last_completed_stage else 0
+    for stage in SOAP_PIPELINE_STAGES[:start_index]:
+        yield "stage_skipped", {"stage": stage, f"{stage}_text": sections[f"{stage}_text"]}
+
+    set_soap_pipeline_state(note_id, 'running', last_completed_stage)
+    for stage in SOAP_PIPELINE_STAGES[start_index:]:
+        fields = SECTION_INPUT_FIELDS[stage]
+        missing_fields = [SECTION_LABELS[field] for field in fields if not sections[field] or not sections[field].strip()]
+        if missing_fields:
+            error = f"Could not generate {stage}. Missing data ({', '.join(missing_fields)} is missing or empty)."
+            set_soap_pipeline_state(note_id, 'failed', last_completed_stage, error)
+            yield "pipeline_error", {"stage": stage, "error": error}
+            return
+
+        yield "stage_started", {"stage": stage}
+        started_at = time.time()
+        try:
+            generated_text = generate_section_coalesced(note_id, stage, [sections[field] for field in fields])
+        except ServiceUnavailableError as e:
+            error = f"Could not generate {stage}. {e}"
+            set_soap_pipeline_state(note_id, 'failed', last_completed_stage, error)
+            yield "pipeline_error", {"stage": stage, "error": error, "retry_after": e.retry_after}
+            return
+        if not generated_text:
+            error = f"Could not generate {stage}. AI error or empty response."
+            print(f"⚠️ SOAP pipeline for Note ID {note_id} failed at stage '{stage}'.")
+            set_soap_pipeline_state(note_id, 'failed', last_completed_stage, error)
+            yield "pipeline_error", {"stage": stage, "error": error}
+            return
+
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM notes WHERE id = ?", (note_id,))
-        note = cursor.fetchone()
+        try:
+            conn.execute(f"UPDATE notes SET {stage}_text = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (generated_text, note_id))
+            record_note_generations(conn, [(note_id, stage, generation_cache_key(stage, *[sections[field] for field in fields]))])
+            conn.commit()
+        finally:
+            conn.close()
+        sections[f"{stage}_text"] = generated_text
+        note_cache.invalidate([note_id])
+        invalidate_speculative_generations(note_id, f"{stage}_text")
+        last_completed_stage = stage
+        set_soap_pipeline_state(note_id, 'running', last_completed_stage)
+        print(f"💾 SOAP pipeline saved {stage} for Note ID {note_id} ({time.time() - started_at:.1f}s).")
+        yield "stage_completed", {"stage": stage, f"{stage}_text": generated_text, "seconds": round(time.time() - started_at, 3)}
+
+    set_soap_pipeline_state(note_id, 'completed', last_completed_stage)
+    yield "pipeline_done", {"note_id": note_id}
+
+def soap_pipeline_state_to_dict(state):
+    if not state:
+        return {"status": "not_started", "last_completed_stage": None, "error": None, "updated_at": None}
+    return {"status": state['status'], "last_completed_stage": state['last_completed_stage'], "error": state['error'], "updated_at": state['updated_at']}
+
+@app.route('/api/soap_pipeline/<int:note_id>', methods=['POST'])
+def soap_pipeline_api(note_id):
+    # ?restart=1 ignores earlier progress. Clients that accept text/event-stream get per-stage SSE progress,
+    # everyone else gets one JSON document once the run finishes.
+    resume = request.args.get('restart') != '1'
+    wants_stream = 'text/event-stream' in request.headers.get('Accept', '')
+    with soap_pipelines_running_lock:
+        if note_id in soap_pipelines_running:
+            return jsonify({"error": f"A SOAP pipeline is already running for Note ID {note_id}."}), 409
+        soap_pipelines_running.add(note_id)
+
+    released = [False]
+    def release():
+        # Runs once, from whichever comes first (the run ends or the response is closed), so a late call
+        # can't clear the guard of a pipeline started after this one
+        with soap_pipelines_running_lock:
+            if not released[0]:
+                released[0] = True
+                soap_pipelines_running.discard(note_id)
+
+    def events():
+        try:
+            for event, payload in run_soap_pipeline(note_id, resume=resume):
+                yield event, payload
+        except Exception as e:
+            print(f"🚨 Error in SOAP pipeline for Note ID {note_id}: {e}\n{traceback.format_exc()}")
+            yield "pipeline_error", {"stage": None, "error": f"Server error: {e}"}
+        finally:
+            release()
+
+    if wants_stream:
+        response = Response(stream_with_context(sse_event(event, payload) for event, payload in events()),
+                            mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # A client that disconnects before the body is read never starts events(), so its finally never runs
+        response.call_on_close(release)
+        return response
+
+    stages = []
+    failure = None
+    for event, payload in events():
+        if event in ("stage_completed", "stage_skipped"):
+            stages.append({"status": event.replace("stage_", ""), **payload})
+        elif event == "pipeline_error":
+            failure = payload
+    result = {"note_id": note_id, "stages": stages, **soap_pipeline_state_to_dict(get_soap_pipeline_state(note_id))}
+    if failure:
+        result.update({"error": failure["error"], "failed_stage": failure["stage"]})
+        if failure.get("retry_after"):
+            result["retry_after"] = failure["retry_after"]
+            return jsonify(result), 503, {"Retry-After": str(failure["retry_after"])}
+        return jsonify(result), 404 if failure["error"] == "Note not found." else 500
+    return jsonify(result), 200
+
+@app.route('/api/soap_pipeline/<int:note_id>', methods=['GET'])
+def soap_pipeline_status_api(note_id):
+    try:
+        return jsonify({"note_id": note_id, **soap_pipeline_state_to_dict(get_soap_pipeline_state(note_id))}), 200
+    except Exception as e:
+        return jsonify({"error": f"Failed to read SOAP pipeline state: {e}"}), 500
+
+# Speculative pre-generation (opt-in): saving an upstream section queues the next section's generation in the
+# background, so the matching GET /api/generate_* can return at once. Results are tagged with the hash of the
+# inputs they were generated from; editing an upstream field cancels/invalidates them.
+def prune_speculative_generations():
+    cutoff = time.time() - SPECULATIVE_RESULT_TTL_SECONDS
+    with speculative_generations_lock:
+        for key in [key for key, entry in speculative_generations.items() if entry[2] < cutoff]:
+            speculative_generations.pop(key)[1].cancel()
+
+def invalidate_speculative_generations(note_id, changed_field):
+    with speculative_generations_lock:
+        for section, fields in SECTION_INPUT_FIELDS.items():
+            if changed_field in fields:
+                entry = speculative_generations.pop((note_id, section), None)
+                if entry:
+                    entry[1].cancel() # Only stops it if it hasn't started; a running result is simply dropped
+                    print(f"🗑️ Speculative {section} for Note ID {note_id} invalidated by a change to {changed_field}.")
+
+def schedule_speculative_generation(note_id, section):
+    fields = SECTION_INPUT_FIELDS[section]
+    conn = get_db_connection()
+    try:
+        note = conn.execute(f"SELECT {', '.join(fields)} FROM notes WHERE id = ?", (note_id,)).fetchone()
+    finally:
         conn.close()
-        if note:
-            return jsonify(dict(note))
+    if not note or any(not note[field] or not note[field].strip() for field in fields):
+        return
+    input_sections = [note[field] for field in fields]
+    cache_key = generation_cache_key(section, *input_sections)
+    prune_speculative_generations()
+    with speculative_generations_lock:
+        existing = speculative_generations.get((note_id, section))
+        if existing and existing[0] == cache_key:
+            return
+        if existing:
+            existing[1].cancel()
+        future = speculative_executor.submit(SECTION_GENERATORS[section], *input_sections, priority=BACKGROUND, note_id=note_id)
+        speculative_generations[(note_id, section)] = (cache_key, future, time.time())
+    print(f"🔮 Speculative {section} generation queued for Note ID {note_id}.")
+
+def take_speculative_generation(note_id, section, input_sections):
+    # Returns the speculative result for exactly these inputs (waiting for it if still running), else None
+    if not SPECULATIVE_GENERATION_ENABLED:
+        return None
+    cache_key = generation_cache_key(section, *input_sections)
+    with speculative_generations_lock:
+        entry = speculative_generations.get((note_id, section))
+        if entry and entry[0] != cache_key:
+            speculative_generations.pop((note_id, section))[1].cancel()
+            entry = None
+    if not entry:
+        return None
+    try:
+        generated_text = entry[1].result(timeout=SPECULATIVE_WAIT_TIMEOUT_SECONDS)
+    except Exception as e:
+        print(f"⚠️ Speculative {section} for Note ID {note_id} unavailable ({type(e).__name__}); generating now.")
+        return None
+    if generated_text:
+        print(f"⚡ Serving speculative {section} for Note ID {note_id}.")
+    return generated_text
+
+def on_note_section_saved(note_id, column_name):
+    if not SPECULATIVE_GENERATION_ENABLED:
+        return
+    try:
+        invalidate_speculative_generations(note_id, column_name)
+        next_section = SPECULATIVE_TRIGGERS.get(column_name)
+        if next_section:
+            schedule_speculative_generation(note_id, next_section)
+    except Exception as e:
+        print(f"⚠️ Could not schedule speculative generation for Note ID {note_id}: {e}\n{traceback.format_exc()}")
+
+# Batch note APIs for clinic-day imports, EHR sync and offline catch-up: many notes per request, written in a
+# single transaction. Items are validated individually and each reports its own status; a database error
+# rolls the whole batch back.
+NOTE_TEXT_FIELDS = ["subjective_text", "objective_text", "assessment_text", "plan_text", "summary_text"]
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "1000"))
+SQLITE_MAX_IN_PARAMS = 500 # Ids per "IN (...)" lookup, safely under SQLite's bound-parameter limit
+
+def read_batch_items(key):
+    # Returns (items, None) or (None, error_response)
+    data = request.get_json(silent=True) or {}
+    items = data.get(key)
+    if not isinstance(items, list) or not items:
+        return None, (jsonify({"error": f"Expected a non-empty '{key}' list."}), 400)
+    if len(items) > BATCH_MAX_ITEMS:
+        return None, (jsonify({"error": f"Too many items: {len(items)} (max {BATCH_MAX_ITEMS} per request)."}), 413)
+    return items, None
+
+def validate_note_fields(item, require_fields):
+    # Returns (fields, error) for one batch item; client_ref and note_id are bookkeeping, not note fields
+    if not isinstance(item, dict):
+        return None, "Item must be an object."
+    unknown = [key for key in item if key not in NOTE_TEXT_FIELDS and key not in ("note_id", "client_ref")]
+    if unknown:
+        return None, f"Unknown field(s): {', '.join(unknown)}."
+    fields = {key: item[key] for key in NOTE_TEXT_FIELDS if key in item}
+    if any(value is not None and not isinstance(value, str) for value in fields.values()):
+        return None, "Section values must be strings."
+    if require_fields and not fields:
+        return None, "No valid fields provided for update."
+    return fields, None
+
+def fetch_existing_note_ids(conn, note_ids):
+    existing = set()
+    note_ids = list(note_ids)
+    for start in range(0, len(note_ids), SQLITE_MAX_IN_PARAMS):
+        chunk = note_ids[start:start + SQLITE_MAX_IN_PARAMS]
+        rows = conn.execute(f"SELECT id FROM notes WHERE id IN ({', '.join('?' * len(chunk))})", chunk).fetchall()
+        existing.update(row['id'] for row in rows)
+    return existing
+
+def batch_status_code(results, success_status, success_code):
+    # success_code when every item succeeded, 207 (Multi-Status) when only some did
+    return success_code if all(result["status"] == success_status for result in results) else 207
+
+@app.route('/api/notes/batch_create', methods=['POST'])
+def batch_create_notes():
+    items, error_response = read_batch_items('notes')
+    if error_response:
+        return error_response
+    results = []
+    rows = []
+    for index, item in enumerate(items):
+        fields, error = validate_note_fields(item, require_fields=False)
+        result = {"index": index, "client_ref": item.get("client_ref") if isinstance(item, dict) else None}
+        if error:
+            result.update({"status": "invalid", "error": error})
         else:
+            rows.append((result, tuple(fields.get(field) or "" for field in NOTE_TEXT_FIELDS)))
+        results.append(result)
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        if rows:
+            # The write lock is held from BEGIN IMMEDIATE, so the AUTOINCREMENT ids of this insert are consecutive
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(f"INSERT INTO notes ({', '.join(NOTE_TEXT_FIELDS)}) VALUES ({', '.join('?' * len(NOTE_TEXT_FIELDS))})",
+                             [values for _, values in rows])
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            conn.commit()
+            for offset, (result, _) in enumerate(rows):
+                result.update({"status": "created", "note_id": last_id - len(rows) + 1 + offset})
+        print(f"✨ Batch created {len(rows)} note(s) ({len(results) - len(rows)} invalid).")
+        return jsonify({"results": results, "created": len(rows)}), batch_status_code(results, "created", 201)
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(f"🚨 Batch note creation failed: {e}\n{traceback.format_exc()}")
+        return jsonify({"error": f"Database error during batch create: {e}"}), 500
+    finally:
+        if conn:
+            conn.close()
+
+@app.route('/api/notes/batch_get', methods=['POST'])
+def batch_get_notes():
+    # Body: {"note_ids": [...], "fields": [...optional subset of the note's columns...]}
+    note_ids, error_response = read_batch_items('note_ids')
+    if error_response:
+        return error_response
+    fields = (request.get_json(silent=True) or {}).get('fields') or ["id", *NOTE_TEXT_FIELDS, "created_at", "updated_at"]
+    unknown = [field for field in fields if field not in ("id", *NOTE_TEXT_FIELDS, "created_at", "updated_at")]
+    if unknown:
+        return jsonify({"error": f"Unknown field(s): {', '.join(map(str, unknown))}."}), 400
+    columns = ", ".join(["id", *[field for field in fields if field != "id"]])
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        def valid_note_id(note_id):
+            return isinstance(note_id, int) and not isinstance(note_id, bool)
+        notes = {}
+        unique_ids = list(dict.fromkeys(note_id for note_id in note_ids if valid_note_id(note_id)))
+        for start in range(0, len(unique_ids), SQLITE_MAX_IN_PARAMS):
+            chunk = unique_ids[start:start + SQLITE_MAX_IN_PARAMS]
+            for row in conn.execute(f"SELECT {columns} FROM notes WHERE id IN ({', '.join('?' * len(chunk))})", chunk):
+                notes[row['id']] = {field: row[field] for field in fields}
+        results = []
+        for note_id in note_ids:
+            if not valid_note_id(note_id):
+                results.append({"note_id": note_id, "status": "invalid", "error": "note_id must be an integer."})
+            elif note_id in notes:
+                results.append({"note_id": note_id, "status": "ok", "note": notes[note_id]})
+            else:
+                results.append({"note_id": note_id, "status": "not_found"})
+        return jsonify({"results": results}), batch_status_code(results, "ok", 200)
+    except Exception as e:
+        print(f"🚨 Batch note fetch failed: {e}\n{traceback.format_exc()}")
+        return jsonify({"error": f"Database error during batch fetch: {e}"}), 500
+    finally:
+        if conn:
+            conn.close()
+
+@app.route('/api/notes/batch_update', methods=['POST'])
+def batch_update_notes():
+    # Body: {"updates": [{"note_id": 1, "subjective_text": "...", "objective_text": "..."}, ...]}
+    items, error_response = read_batch_items('updates')
+    if error_response:
+        return error_response
+    results = []
+    pending = [] # (result, note_id, fields)
+    for index, item in enumerate(items):
+        fields, error = validate_note_fields(item, require_fields=True)
+        note_id = item.get("note_id") if isinstance(item, dict) else None
+        result = {"index": index, "note_id": note_id}
+        if not error and (not isinstance(note_id, int) or isinstance(note_id, bool)):
+            error = "Missing or invalid note_id."
+        if error:
+            result.update({"status": "invalid", "error": error})
+        else:
+            pending.append((result, note_id, fields))
+        results.append(result)
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        updated = []
+        if pending:
+            conn.execute("BEGIN IMMEDIATE")
+            existing = fetch_existing_note_ids(conn, {note_id for _, note_id, _ in pending})
+            # A note updated by several items gets their fields merged in item order, so the last item wins
+            merged = {} # note_id -> {column: value}
+            for result, note_id, fields in pending:
+                if note_id not in existing:
+                    result.update({"status": "not_found", "error": "Note not found."})
+                    continue
+                merged.setdefault(note_id, {}).update(fields)
+                result.update({"status": "updated", "fields": sorted(fields)})
+                updated.append((note_id, tuple(sorted(fields))))
+            # Notes touching the same set of columns share one statement, so each group is a single executemany
+            groups = {}
+            for note_id, fields in merged.items():
+                columns = tuple(sorted(fields))
+                groups.setdefault(columns, []).append(tuple(fields[column] for column in columns) + (note_id,))
+            for columns, params in groups.items():
+                conn.executemany(f"UPDATE notes SET {', '.join(f'{column} = ?' for column in columns)}, updated_at = CURRENT_TIMESTAMP WHERE id = ?", params)
+                forget_note_generations(conn, [values[-1] for values in params], columns)
+            conn.commit()
+        note_cache.invalidate([note_id for note_id, _ in updated])
+        # Speculative results built from the old text are dropped; new ones are not scheduled for bulk writes
+        for note_id, columns in updated:
+            for column in columns:
+                invalidate_speculative_generations(note_id, column)
+        print(f"💾 Batch updated {len(updated)} note(s) ({len(results) - len(updated)} not updated).")
+        return jsonify({"results": results, "updated": len(updated)}), batch_status_code(results, "updated", 200)
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(f"🚨 Batch note update failed: {e}\n{traceback.format_exc()}")
+        return jsonify({"error": f"Database error during batch update: {e}"}), 500
+    finally:
+        if conn:
+            conn.close()
+
+# Note listing and full-text search. Pages are fetched with an opaque cursor (keyset pagination on
+# (updated_at, id)) instead of OFFSET, so a later page costs the same as the first however many notes there are.
+# Relevance-ranked search is the exception: bm25 scores shift whenever the indexed notes change, so a cursor on
+# the score could skip or repeat rows. Its cursor holds an offset instead; every match is scored to rank
+# the page anyway, so the offset costs little more.
+NOTES_PAGE_DEFAULT = 20
+NOTES_PAGE_MAX = 100
+NOTE_PREVIEW_CHARS = 200
+SEARCH_MAX_TERMS = 16
+SEARCH_COLUMN_WEIGHTS = [1.0, 1.0, 2.0, 2.0, 1.5] # bm25 weights in NOTES_FTS_COLUMNS order; matches in the assessment/plan rank higher
+SEARCH_SNIPPET_TOKENS = 12
+SEARCH_SNIPPET_MARKERS = ("[", "]") # Around each matched term in a snippet; the text itself is not HTML-escaped
+NOTE_LIST_COLUMNS = f"n.id, n.created_at, n.updated_at, substr(n.subjective_text, 1, {NOTE_PREVIEW_CHARS}) AS subjective_preview, substr(n.summary_text, 1, {NOTE_PREVIEW_CHARS}) AS summary_preview"
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip("=")
+
+def decode_cursor(kind):
+    # Returns the position stored in the request's cursor (None for the first page); raises ValueError if it is malformed
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Malformed cursor.")
+    if not isinstance(values, list) or not values or values[0] != kind:
+        raise ValueError("Cursor does not belong to this listing.")
+    if kind == "relevance":
+        if len(values) != 2 or not isinstance(values[1], int) or values[1] < 0:
+            raise ValueError("Cursor does not belong to this listing.")
+        return values[1]
+    if len(values) != 3 or not isinstance(values[2], int):
+        raise ValueError("Cursor does not belong to this listing.")
+    return values[1], values[2]
+
+def read_page_limit():
+    return max(1, min(NOTES_PAGE_MAX, request.args.get('limit', NOTES_PAGE_DEFAULT, type=int)))
+
+def build_search_query(text):
+    # Every word must match (implicit AND) and the last one also matches as a prefix, for search-as-you-type.
+    # Words are quoted so user input can never be parsed as FTS5 query syntax.
+    terms = re.findall(r"\w+", text or "")[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    return " ".join([f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"*'])
+
+def split_page(rows, limit, cursor_for):
+    # rows were fetched with LIMIT limit + 1; the extra row only tells whether there is a next page
+    page = rows[:limit]
+    return page, cursor_for(page[-1]) if len(rows) > limit else None
+
+@app.route('/api/notes', methods=['GET'])
+def list_notes():
+    # Most recently updated first
+    try:
+        position = decode_cursor("recent")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    limit = read_page_limit()
+    conn = get_db_connection()
+    try:
+        sql = f"SELECT {NOTE_LIST_COLUMNS} FROM notes n"
+        params = []
+        if position:
+            sql += " WHERE (n.updated_at, n.id) < (?, ?)"
+            params += position
+        rows = [dict(row) for row in conn.execute(sql + " ORDER BY n.updated_at DESC, n.id DESC LIMIT ?", (*params, limit + 1))]
+        notes, next_cursor = split_page(rows, limit, lambda row: encode_cursor(["recent", row["updated_at"], row["id"]]))
+        return jsonify({"notes": notes, "next_cursor": next_cursor})
+    except Exception as e:
+        return jsonify({"error": f"Failed to list notes: {e}\n{traceback.format_exc()}"}), 500
+    finally:
+        conn.close()
+
+@app.route('/api/notes/search', methods=['GET'])
+def search_notes():
+    # ?q=words&sort=relevance|recent. Each hit carries a snippet of its best-matching section.
+    query = build_search_query(request.args.get('q'))
+    if not query:
+        return jsonify({"error": "Missing search query 'q'."}), 400
+    sort = request.args.get('sort', 'relevance')
+    if sort not in ("relevance", "recent"):
+        return jsonify({"error": "sort must be 'relevance' or 'recent'."}), 400
+    try:
+        position = decode_cursor(sort)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    limit = read_page_limit()
+    bm25 = f"bm25(notes_fts, {', '.join(str(weight) for weight in SEARCH_COLUMN_WEIGHTS)})"
+    conn = get_db_connection()
+    try:
+        # The page is chosen first; snippets are then only built for the rows on it
+        if sort == "relevance":
+            offset = position or 0
+            sql = (f"SELECT {NOTE_LIST_COLUMNS}, {bm25} AS score FROM notes_fts JOIN notes n ON n.id = notes_fts.rowid WHERE notes_fts MATCH ?"
+                   " ORDER BY score, n.id LIMIT ? OFFSET ?")
+            params = (query, limit + 1, offset)
+            cursor_for = lambda row: encode_cursor(["relevance", offset + limit])
+        else:
+            sql = f"SELECT {NOTE_LIST_COLUMNS}, {bm25} AS score FROM notes_fts JOIN notes n ON n.id = notes_fts.rowid WHERE notes_fts MATCH ?"
+            if position:
+                sql += " AND (n.updated_at, n.id) < (?, ?)"
+            sql += " ORDER BY n.updated_at DESC, n.id DESC LIMIT ?"
+            params = (query, *(position or ()), limit + 1)
+            cursor_for = lambda row: encode_cursor(["recent", row["updated_at"], row["id"]])
+        rows = [dict(row) for row in conn.execute(sql, params)]
+        notes, next_cursor = split_page(rows, limit, cursor_for)
+        page_ids = [note["id"] for note in notes]
+        snippets = {}
+        if page_ids:
+            open_marker, close_marker = SEARCH_SNIPPET_MARKERS
+            snippet_rows = conn.execute(f"SELECT rowid, snippet(notes_fts, -1, ?, ?, '…', {SEARCH_SNIPPET_TOKENS}) FROM notes_fts "
+                                        f"WHERE notes_fts MATCH ? AND rowid IN ({', '.join('?' * len(page_ids))})",
+                                        (open_marker, close_marker, query, *page_ids))
+            snippets = {row[0]: row[1] for row in snippet_rows}
+        for note in notes:
+            note["snippet"] = snippets.get(note["id"], "")
+            note["score"] = round(-note["score"], 4) # bm25 is lower-is-better; report higher-is-better
+        return jsonify({"query": request.args.get('q'), "sort": sort, "notes": notes, "next_cursor": next_cursor})
+    except sqlite3.OperationalError as e:
+        if "notes_fts" in str(e):
+            return jsonify({"error": "Full-text search is not available on this server."}), 503
+        return jsonify({"error": f"Failed to search notes: {e}\n{traceback.format_exc()}"}), 500
+    except Exception as e:
+        return jsonify({"error": f"Failed to search notes: {e}\n{traceback.format_exc()}"}), 500
+    finally:
+        conn.close()
+
+@app.route('/api/notes/export', methods=['GET'])
+def export_notes_api():
+    # Streams the notes changed after ?cursor= (all notes without one) as gzipped JSONL or, with ?format=parquet, Parquet.
+    # X-Export-Cursor is the cursor for the next incremental export; it is known before the body starts.
+    export_format = request.args.get('format', 'jsonl')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of: {', '.join(EXPORT_FORMATS)}."}), 400
+    if export_format == "parquet" and not parquet_available():
+        return jsonify({"error": "Parquet export is not available on this server (pyarrow is not installed)."}), 501
+    try:
+        after = decode_cursor("export")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    conn = get_db_connection()
+    try:
+        until = snapshot_bound(conn, after)
+    except Exception as e:
+        return jsonify({"error": f"Failed to start export: {e}\n{traceback.format_exc()}"}), 500
+    finally:
+        conn.close()
+    next_position = until or after
+    stats = {"rows": 0, "bytes": 0}
+    print(f"📤 Exporting notes as {export_format} after {after or 'the beginning'} up to {until}.")
+    headers = {
+        "Content-Disposition": f"attachment; filename=notes-{time.strftime('%Y%m%d-%H%M%S')}.{EXPORT_FORMATS[export_format]['extension']}",
+        "X-Export-Cursor": encode_cursor(["export", *next_position]) if next_position else "",
+        "Cache-Control": "no-store",
+    }
+    return Response(stream_with_context(iter_export(export_format, after, until, stats)),
+                    content_type=EXPORT_FORMATS[export_format]["content_type"], headers=headers)
+
+NOTE_DATA_FIELDS = ["id"] + NOTE_TEXT_FIELDS + ["created_at", "updated_at"]
+
+def note_etag(note_id, version, projection):
+    # Changes with the note's version and with the set of fields in the body
+    fields_tag = hashlib.sha256(projection.encode('utf-8')).hexdigest()[:8] if projection else "all"
+    return f'"note-{note_id}-v{version}-{fields_tag}"'
+
+def note_data_response(body, etag, status=200):
+    # no-cache: browsers keep the body but revalidate it with If-None-Match on every page load
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if status == 304:
+        return Response(status=304, headers=headers)
+    return Response(body, status=status, headers=headers, mimetype="application/json")
+
+@app.route('/get_note_data/<int:note_id>', methods=['GET'])
+def get_note(note_id):
+    # Optional ?fields=subjective_text,updated_at returns only those fields. An unchanged note costs one small
+    # version lookup: 304 for a matching If-None-Match, otherwise the body from the note cache.
+    try:
+        fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+        unknown = [field for field in fields if field not in NOTE_DATA_FIELDS]
+        if unknown:
+            return jsonify({"error": f"Unknown field(s): {', '.join(unknown)}. Choose from {', '.join(NOTE_DATA_FIELDS)}."}), 400
+        projection = ",".join(field for field in NOTE_DATA_FIELDS if field in fields)
+
+        conn = get_db_connection()
+        try:
+            row = conn.execute("SELECT COALESCE((SELECT version FROM note_versions WHERE note_id = notes.id), 0) AS version "
+                               "FROM notes WHERE id = ?", (note_id,)).fetchone()
+            if not row:
+                return jsonify({"error": "Note not found"}), 404
+            version = row['version']
+            etag = note_etag(note_id, version, projection)
+            if etag_matches(request.headers.get('If-None-Match'), etag):
+                return note_data_response(None, etag, 304)
+            body = note_cache.get(note_id, version, projection)
+            if body is not None:
+                return note_data_response(body, etag)
+
+            # Note and version in one statement, so the cached body is never newer or older than its version
+            note = conn.execute("SELECT notes.*, COALESCE((SELECT version FROM note_versions WHERE note_id = notes.id), 0) AS version "
+                                "FROM notes WHERE id = ?", (note_id,)).fetchone()
+        finally:
+            conn.close()
+        if not note:
             return jsonify({"error": "Note not found"}), 404
+        data = {field: note[field] for field in (projection.split(",") if projection else NOTE_DATA_FIELDS)}
+        body = app.json.dumps(data).encode('utf-8')
+        note_cache.put(note_id, note['version'], projection, body)
+        return note_data_response(body, note_etag(note_id, note['version'], projection))
     except Exception as e:
         return jsonify({"error": f"Failed to fetch note: {e}\n{traceback.format_exc()}"}), 500
 
+@app.route('/api/note_cache/stats', methods=['GET'])
+def note_cache_stats_api():
+    return jsonify(note_cache.snapshot()), 200
+
+def start_background_services():
+    # Run once by the process that serves requests, before it starts (see also serve.py)
+    resume_transcription_jobs()
+    resume_audio_uploads()
+    threading.Thread(target=reap_streaming_sessions_periodically, name="stt-stream-reaper", daemon=True).start()
+    if WARMUP_CLIENTS:
+        warm_up_clients([backend.holder for backend in BACKENDS.values() if backend.holder])
+
 if __name__ == '__main__':
     init_db()
+    if static_assets:
+        static_assets.auto_reload = True # Debug server: pick up edited pages and styles without a restart
+    # The debug reloader runs this block twice; only the serving child process should resume jobs
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_services()
     if not os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"):
         print("⚠️ WARNING: GOOGLE_APPLICATION_CREDENTIALS environment variable not set.")
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
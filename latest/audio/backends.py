@@ -0,0 +1,396 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from clients import LazyClient
+
+# Pluggable backends for the external services the app depends on: speech-to-text, object storage and
+# the LLM. The Google implementations wrap the lazily built cloud clients; the fakes run in-process with
+# configurable latency and error rates, so the server can be run and load-tested without cloud access.
+GCS_BUCKET_NAME = "audio-upload-bucket-fernado" # Updated GCS bucket name
+VERTEX_AI_PROJECT_ID = os.environ.get("VERTEX_AI_PROJECT_ID", "macro-dolphin-432908-t4")
+VERTEX_AI_LOCATION = os.environ.get("VERTEX_AI_LOCATION", "us-central1")
+GEMINI_MODEL_NAME = "gemini-2.5-pro-exp-03-25"
+
+# Fake backend tuning. Each call sleeps for its latency (+/- 50% jitter) and then fails with the given probability.
+FAKE_GEMINI_CHUNK_DELAY = float(os.environ.get("FAKE_GEMINI_CHUNK_DELAY", "0.05")) # Seconds between fake stream chunks
+FAKE_SPEECH_LATENCY_SECONDS = float(os.environ.get("FAKE_SPEECH_LATENCY_SECONDS", "0"))
+FAKE_SPEECH_ERROR_RATE = float(os.environ.get("FAKE_SPEECH_ERROR_RATE", "0"))
+FAKE_STORAGE_LATENCY_SECONDS = float(os.environ.get("FAKE_STORAGE_LATENCY_SECONDS", "0"))
+FAKE_STORAGE_ERROR_RATE = float(os.environ.get("FAKE_STORAGE_ERROR_RATE", "0"))
+FAKE_LLM_LATENCY_SECONDS = float(os.environ.get("FAKE_LLM_LATENCY_SECONDS", "0"))
+FAKE_LLM_ERROR_RATE = float(os.environ.get("FAKE_LLM_ERROR_RATE", "0"))
+
+# Holds uploaded recordings, so it must stay outside latest/ (served over HTTP)
+LOCAL_STORAGE_DIR = os.environ.get("LOCAL_STORAGE_DIR", os.path.join(tempfile.gettempdir(), "aims-local-storage"))
+GCS_COMPOSE_MAX_SOURCES = 32 # Limit of a single GCS compose request
+STORAGE_COPY_CHUNK_SIZE = 1024 * 1024
+
+class BackendError(RuntimeError):
+    # A transient failure reported by a backend (the fakes raise it for injected errors)
+    pass
+
+def simulate_call(name, latency, error_rate):
+    if latency > 0:
+        time.sleep(latency * random.uniform(0.5, 1.5))
+    if error_rate > 0 and random.random() < error_rate:
+        raise BackendError(f"Injected {name} failure")
+
+def extract_response_text(response):
+    # Text of the first candidate, or None for an empty/malformed (or blocked) response
+    if response and response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+        return response.candidates[0].content.parts[0].text
+    return None
+
+class Backend:
+    kind = None
+    holder = None # LazyClient for cloud backends, None for in-process fakes
+
+    def available(self):
+        return self.holder is None or self.holder.get_or_none() is not None
+
+    def status(self):
+        status = self.holder.status() if self.holder else {"state": "ready"}
+        return {"backend": self.kind, **status}
+
+# Speech-to-text. audio_format is the (sample_rate, channels) of normalized FLAC audio;
+# None means the raw browser upload, passed through as recorded.
+class SpeechToTextBackend(Backend):
+    def recognize_long_running(self, uri, audio_format=None, timeout=600):
+        raise NotImplementedError
+
+    def recognize(self, content, audio_format):
+        raise NotImplementedError
+
+    def streaming_recognize(self, audio_chunks):
+        # Consumes an iterator of audio byte chunks and yields (transcript, is_final) tuples as results arrive
+        raise NotImplementedError
+
+class ObjectStorageBackend(Backend):
+    def upload(self, name, fileobj, size=None):
+        # Returns the URI the speech backend reads the object from. size, when known, lets the backend
+        # stream fileobj without buffering it first.
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def compose(self, name, part_names):
+        # Concatenates the part objects, in order, into one new object and returns its URI.
+        # The parts are left in place.
+        raise NotImplementedError
+
+    def download(self, name, fileobj):
+        # Streams the object into fileobj
+        raise NotImplementedError
+
+    def uri(self, name):
+        raise NotImplementedError
+
+class LLMBackend(Backend):
+    model_name = None
+
+    def generate(self, prompt):
+        # Full response text, or None for an empty/blocked response
+        raise NotImplementedError
+
+    def generate_stream(self, prompt):
+        # Yields the response text in chunks as they arrive
+        raise NotImplementedError
+
+def create_speech_client():
+    from google.cloud import speech
+    return speech.SpeechClient()
+
+def create_storage_client():
+    from google.cloud import storage
+    return storage.Client()
+
+def create_gemini_model():
+    import vertexai
+    from vertexai.generative_models import GenerativeModel
+    vertexai.init(project=VERTEX_AI_PROJECT_ID, location=VERTEX_AI_LOCATION)
+    model = GenerativeModel(GEMINI_MODEL_NAME)
+    print(f"Vertex AI initialized and Gemini model '{model._model_name}' loaded successfully in project '{VERTEX_AI_PROJECT_ID}' location '{VERTEX_AI_LOCATION}'.")
+    return model
+
+class GoogleSpeechBackend(SpeechToTextBackend):
+    kind = "google"
+
+    def __init__(self):
+        self.holder = LazyClient("speech", create_speech_client)
+
+    def _config(self, audio_format):
+        from google.cloud import speech
+        if audio_format:
+            sample_rate, channels = audio_format
+            return speech.RecognitionConfig(
+                encoding=speech.RecognitionConfig.AudioEncoding.FLAC,
+                sample_rate_hertz=sample_rate,
+                audio_channel_count=channels,
+                language_code="en-US",
+                model="medical_conversation",
+                enable_automatic_punctuation=True,
+            )
+        # Without ffmpeg the upload is passed through unchanged, as recorded by the browser
+        return speech.RecognitionConfig(
+            language_code="en-US",
+            model="medical_conversation",
+            enable_automatic_punctuation=True,
+            audio_channel_count=2 # Specify audio channel count
+        )
+
+    def recognize_long_running(self, uri, audio_format=None, timeout=600):
+        from google.cloud import speech
+        operation = self.holder.get().long_running_recognize(config=self._config(audio_format), audio=speech.RecognitionAudio(uri=uri))
+        print("Waiting for long-running transcription operation to complete...")
+        response = operation.result(timeout=timeout)
+        return "".join([result.alternatives[0].transcript + " " for result in response.results]).strip()
+
+    def recognize(self, content, audio_format):
+        from google.cloud import speech
+        response = self.holder.get().recognize(config=self._config(audio_format), audio=speech.RecognitionAudio(content=content))
+        return "".join([result.alternatives[0].transcript + " " for result in response.results]).strip()
+
+    def streaming_recognize(self, audio_chunks):
+        # Browser MediaRecorder output: WebM/Opus at 48 kHz. Note that Google caps a single
+        # stream at roughly five minutes; the client falls back to a transcription job past that.
+        from google.cloud import speech
+        streaming_config = speech.StreamingRecognitionConfig(
+            config=speech.RecognitionConfig(
+                encoding=speech.RecognitionConfig.AudioEncoding.WEBM_OPUS,
+                sample_rate_hertz=48000,
+                language_code="en-US",
+                model="medical_conversation",
+                enable_automatic_punctuation=True,
+            ),
+            interim_results=True,
+        )
+        requests = (speech.StreamingRecognizeRequest(audio_content=chunk) for chunk in audio_chunks)
+        for response in self.holder.get().streaming_recognize(config=streaming_config, requests=requests):
+            for result in response.results:
+                if result.alternatives:
+                    yield result.alternatives[0].transcript, result.is_final
+
+class FakeSpeechBackend(SpeechToTextBackend):
+    # Batch recognition returns a short canned transcript. Streaming treats every chunk as UTF-8 text,
+    # reported once as an interim result and then as a final result.
+    kind = "fake"
+
+    def recognize_long_running(self, uri, audio_format=None, timeout=600):
+        simulate_call("speech", FAKE_SPEECH_LATENCY_SECONDS, FAKE_SPEECH_ERROR_RATE)
+        return "Patient reports a dry cough for three days with mild fever and no shortness of breath."
+
+    def recognize(self, content, audio_format):
+        simulate_call("speech", FAKE_SPEECH_LATENCY_SECONDS, FAKE_SPEECH_ERROR_RATE)
+        return f"Fake segment transcript of {len(content)} bytes."
+
+    def streaming_recognize(self, audio_chunks):
+        for chunk in audio_chunks:
+            text = chunk.decode('utf-8', errors='ignore').strip()
+            if text:
+                simulate_call("speech", FAKE_SPEECH_LATENCY_SECONDS, FAKE_SPEECH_ERROR_RATE)
+                yield text, False
+                yield text, True
+
+class GCSStorageBackend(ObjectStorageBackend):
+    kind = "gcs"
+
+    def __init__(self, bucket_name=GCS_BUCKET_NAME):
+        self.bucket_name = bucket_name
+        self.holder = LazyClient("storage", create_storage_client)
+
+    def upload(self, name, fileobj, size=None):
+        self.holder.get().bucket(self.bucket_name).blob(name).upload_from_file(fileobj, size=size)
+        return self.uri(name)
+
+    def delete(self, name):
+        self.holder.get().bucket(self.bucket_name).blob(name).delete()
+
+    def compose(self, name, part_names):
+        # Server-side concatenation, no bytes pass through the app. A compose request takes at most 32 sources,
+        # so longer lists are composed in rounds through intermediate objects.
+        bucket = self.holder.get().bucket(self.bucket_name)
+        sources = list(part_names)
+        intermediates = []
+        try:
+            while len(sources) > GCS_COMPOSE_MAX_SOURCES:
+                next_sources = []
+                for start in range(0, len(sources), GCS_COMPOSE_MAX_SOURCES):
+                    group = sources[start:start + GCS_COMPOSE_MAX_SOURCES]
+                    if len(group) == 1:
+                        next_sources.append(group[0])
+                        continue
+                    intermediate = f"{name}.compose-{len(intermediates)}"
+                    bucket.blob(intermediate).compose([bucket.blob(source) for source in group])
+                    intermediates.append(intermediate)
+                    next_sources.append(intermediate)
+                sources = next_sources
+            bucket.blob(name).compose([bucket.blob(source) for source in sources])
+        finally:
+            for intermediate in intermediates:
+                bucket.blob(intermediate).delete()
+        return self.uri(name)
+
+    def download(self, name, fileobj):
+        self.holder.get().bucket(self.bucket_name).blob(name).download_to_file(fileobj)
+
+    def uri(self, name):
+        return f"gs://{self.bucket_name}/{name}"
+
+class FakeStorageBackend(ObjectStorageBackend):
+    # Keeps objects in memory
+    kind = "fake"
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def upload(self, name, fileobj, size=None):
+        data = fileobj.read() if size is None else fileobj.read(size)
+        simulate_call("storage", FAKE_STORAGE_LATENCY_SECONDS, FAKE_STORAGE_ERROR_RATE)
+        with self.lock:
+            self.objects[name] = data
+        return self.uri(name)
+
+    def delete(self, name):
+        simulate_call("storage", FAKE_STORAGE_LATENCY_SECONDS, FAKE_STORAGE_ERROR_RATE)
+        with self.lock:
+            self.objects.pop(name, None)
+
+    def compose(self, name, part_names):
+        simulate_call("storage", FAKE_STORAGE_LATENCY_SECONDS, FAKE_STORAGE_ERROR_RATE)
+        with self.lock:
+            self.objects[name] = b"".join(self.objects[part] for part in part_names)
+        return self.uri(name)
+
+    def download(self, name, fileobj):
+        simulate_call("storage", FAKE_STORAGE_LATENCY_SECONDS, FAKE_STORAGE_ERROR_RATE)
+        with self.lock:
+            data = self.objects[name]
+        fileobj.write(data)
+
+    def uri(self, name):
+        return f"mem://{name}"
+
+class LocalStorageBackend(ObjectStorageBackend):
+    # Stand-in for the bucket on the local filesystem (LOCAL_STORAGE_DIR), for development and tests
+    kind = "local"
+
+    def __init__(self, root=LOCAL_STORAGE_DIR):
+        self.root = os.path.abspath(root)
+
+    def _path(self, name):
+        path = os.path.abspath(os.path.join(self.root, *name.split("/")))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Object name escapes the storage directory: {name}")
+        return path
+
+    def upload(self, name, fileobj, size=None):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name, so a failed upload never leaves a partial object behind
+        temp_path = f"{path}.partial"
+        try:
+            with open(temp_path, "wb") as f:
+                remaining = size
+                while remaining is None or remaining > 0:
+                    data = fileobj.read(STORAGE_COPY_CHUNK_SIZE if remaining is None else min(STORAGE_COPY_CHUNK_SIZE, remaining))
+                    if not data:
+                        break
+                    f.write(data)
+                    if remaining is not None:
+                        remaining -= len(data)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return self.uri(name)
+
+    def delete(self, name):
+        path = self._path(name)
+        os.remove(path)
+        # Object names are flat in a bucket; drop the directories they left empty
+        directory = os.path.dirname(path)
+        while directory != self.root and not os.listdir(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+    def compose(self, name, part_names):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.partial"
+        try:
+            with open(temp_path, "wb") as f:
+                for part in part_names:
+                    with open(self._path(part), "rb") as src:
+                        shutil.copyfileobj(src, f, STORAGE_COPY_CHUNK_SIZE)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return self.uri(name)
+
+    def download(self, name, fileobj):
+        with open(self._path(name), "rb") as src:
+            shutil.copyfileobj(src, fileobj, STORAGE_COPY_CHUNK_SIZE)
+
+    def uri(self, name):
+        return f"file://{self._path(name)}"
+
+class VertexLLMBackend(LLMBackend):
+    kind = "vertex"
+    model_name = GEMINI_MODEL_NAME
+
+    def __init__(self):
+        self.holder = LazyClient("gemini", create_gemini_model)
+
+    def generate(self, prompt):
+        return extract_response_text(self.holder.get().generate_content(prompt))
+
+    def generate_stream(self, prompt):
+        for chunk in self.holder.get().generate_content(prompt, stream=True):
+            chunk_text = extract_response_text(chunk)
+            if chunk_text:
+                yield chunk_text
+
+class FakeLLMBackend(LLMBackend):
+    # Returns canned, well-formed sections, optionally streamed in small chunks
+    kind = "fake"
+    model_name = "fake-gemini"
+
+    def _canned_text(self, prompt):
+        if "CLINICAL DIGEST" in prompt:
+            return "### Presenting Complaint:\n- Fake condensed transcript."
+        if "ASSESSMENT section" in prompt:
+            return "### Diagnosis / Impression:\nFake primary diagnosis.\n\n### Differential Diagnosis (DDx):\n1. Fake differential."
+        if "PLAN section" in prompt:
+            return ("### Diagnostics / Tests Ordered:\nNone.\n\n### Medications / Therapy:\nNone.\n\n### Referrals / Consults:\nNone.\n\n"
+                    "### Patient Education & Counseling:\nReassurance.\n\n### Follow-Up Instructions:\nReturn in 2 weeks.")
+        return "Fake clinical summary of the encounter."
+
+    def generate(self, prompt):
+        simulate_call("llm", FAKE_LLM_LATENCY_SECONDS, FAKE_LLM_ERROR_RATE)
+        return self._canned_text(prompt)
+
+    def generate_stream(self, prompt):
+        simulate_call("llm", FAKE_LLM_LATENCY_SECONDS, FAKE_LLM_ERROR_RATE)
+        text = self._canned_text(prompt)
+        for start in range(0, len(text), 16):
+            time.sleep(FAKE_GEMINI_CHUNK_DELAY)
+            yield text[start:start + 16]
+
+SPEECH_BACKENDS = {"google": GoogleSpeechBackend, "fake": FakeSpeechBackend}
+STORAGE_BACKENDS = {"gcs": GCSStorageBackend, "fake": FakeStorageBackend, "local": LocalStorageBackend}
+LLM_BACKENDS = {"vertex": VertexLLMBackend, "fake": FakeLLMBackend}
+
+def create_backend(registry, kind, service):
+    backend_cls = registry.get(kind)
+    if not backend_cls:
+        raise ValueError(f"Unknown {service} backend '{kind}' (choose from {', '.join(registry)}).")
+    if kind in ("fake", "local"):
+        print(f"🧪 Using the {kind} {service} backend.")
+    return backend_cls()
@@ -0,0 +1,103 @@
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+import db
+
+# Read/write throughput benchmark for the notes database access layer.
+#
+# Compares the original access pattern (a fresh sqlite3.connect per request on a
+# rollback-journal database) against the pooled, WAL-mode connections from db.py,
+# using the same mix of note reads and section updates on throwaway copies.
+#
+#     python latest/audio/bench_db.py --threads 8 --seconds 10 --write-ratio 0.3
+
+SECTION_TEXT = "Patient reports intermittent chest pain radiating to the left arm. " * 60 # ~4 KB, like a real section
+
+def seed_database(path, note_count, journal_mode):
+    db.DATABASE_PATH = path
+    db.init_db()
+    db.close_pool()
+    conn = sqlite3.connect(path)
+    conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+    conn.executemany("INSERT INTO notes (subjective_text, objective_text, assessment_text, plan_text, summary_text) VALUES (?, ?, ?, ?, ?)",
+                     [(SECTION_TEXT, SECTION_TEXT, SECTION_TEXT, SECTION_TEXT, "")] * note_count)
+    conn.commit()
+    conn.close()
+
+def legacy_connection(path):
+    # What get_db_connection() used to do on every request
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def run_operation(conn, note_count, write):
+    note_id = random.randint(1, note_count)
+    if write:
+        conn.execute("UPDATE notes SET objective_text = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (SECTION_TEXT + str(time.time()), note_id))
+        conn.commit()
+    else:
+        dict(conn.execute("SELECT * FROM notes WHERE id = ?", (note_id,)).fetchone())
+
+def run_benchmark(mode, path, threads, seconds, note_count, write_ratio):
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    counts_lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        local = {"reads": 0, "writes": 0, "errors": 0}
+        while time.perf_counter() < deadline:
+            write = random.random() < write_ratio
+            conn = legacy_connection(path) if mode == "legacy" else db.get_db_connection()
+            try:
+                run_operation(conn, note_count, write)
+                local["writes" if write else "reads"] += 1
+            except sqlite3.OperationalError:
+                local["errors"] += 1 # "database is locked"
+            finally:
+                conn.close()
+        with counts_lock:
+            for key, value in local.items():
+                counts[key] += value
+
+    db.DATABASE_PATH = path
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    db.close_pool()
+    return {key: value / elapsed for key, value in counts.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Read/write throughput benchmark for the notes database access layer.")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--notes", type=int, default=1000)
+    parser.add_argument("--write-ratio", type=float, default=0.3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = {}
+        for mode, journal_mode in (("legacy", "DELETE"), ("pooled", "WAL")):
+            path = os.path.join(workdir, f"{mode}.db")
+            seed_database(path, args.notes, journal_mode)
+            results[mode] = run_benchmark(mode, path, args.threads, args.seconds, args.notes, args.write_ratio)
+
+    print(f"{args.threads} threads, {args.seconds:.0f}s per mode, {args.notes} notes, {args.write_ratio:.0%} writes")
+    print(f"{'mode':<8} {'reads/s':>10} {'writes/s':>10} {'locked/s':>10}")
+    for mode, rates in results.items():
+        print(f"{mode:<8} {rates['reads']:>10.0f} {rates['writes']:>10.0f} {rates['errors']:>10.1f}")
+    legacy_total = results["legacy"]["reads"] + results["legacy"]["writes"]
+    pooled_total = results["pooled"]["reads"] + results["pooled"]["writes"]
+    if legacy_total:
+        print(f"pooled/legacy throughput: {pooled_total / legacy_total:.1f}x")
+
+if __name__ == "__main__":
+    main()
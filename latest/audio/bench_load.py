@@ -0,0 +1,165 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+# End-to-end load benchmark for the Flask app, run against the in-process fake backends.
+#
+# Each virtual user repeatedly walks one encounter through the workflow the pages drive:
+# create a session, transcribe a recording, save Subjective and Objective, generate and
+# save the Assessment and Plan, then generate the Summary. Requests go through Flask's
+# test client, so the numbers measure the server's own overhead plus the simulated
+# backend latency. Latency percentiles and request rates are reported per endpoint.
+#
+#     python latest/audio/bench_load.py --users 16 --seconds 30 --llm-latency 0.8 --stt-latency 1.5
+
+ENCOUNTER_SUBJECTIVE = "Patient reports a dry cough for three days with mild fever and no shortness of breath. "
+ENCOUNTER_OBJECTIVE = "Temp 38.1 C, HR 92, RR 16, SpO2 98% on room air. Chest clear to auscultation bilaterally."
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark for the Flask app, run against the in-process fake backends.")
+    parser.add_argument("--users", type=int, default=8, help="concurrent virtual users")
+    parser.add_argument("--seconds", type=float, default=20.0, help="how long to keep starting encounters")
+    parser.add_argument("--stt-latency", type=float, default=0.5, help="mean fake speech-to-text latency (s)")
+    parser.add_argument("--storage-latency", type=float, default=0.05, help="mean fake storage latency (s)")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="mean fake LLM latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability that any fake backend call fails")
+    parser.add_argument("--stream", action="store_true", help="generate sections through the SSE endpoints")
+    parser.add_argument("--audio", help="audio file to upload (default: a small dummy payload, with ffmpeg disabled)")
+    parser.add_argument("--verbose", action="store_true", help="show the app's own log output")
+    return parser.parse_args()
+
+def configure_environment(args, workdir):
+    # Must run before app is imported: the backends and database path are read at import time
+    os.environ.update({
+        "SPEECH_BACKEND": "fake",
+        "STORAGE_BACKEND": "fake",
+        "GEMINI_BACKEND": "fake",
+        "FAKE_GEMINI_CHUNK_DELAY": "0",
+        "FAKE_SPEECH_LATENCY_SECONDS": str(args.stt_latency),
+        "FAKE_STORAGE_LATENCY_SECONDS": str(args.storage_latency),
+        "FAKE_LLM_LATENCY_SECONDS": str(args.llm_latency),
+        "FAKE_SPEECH_ERROR_RATE": str(args.error_rate),
+        "FAKE_STORAGE_ERROR_RATE": str(args.error_rate),
+        "FAKE_LLM_ERROR_RATE": str(args.error_rate),
+        "NOTES_DATABASE_PATH": os.path.join(workdir, "bench_notes.db"),
+    })
+    if not args.audio:
+        os.environ["FFMPEG_BINARY"] = os.path.join(workdir, "no-ffmpeg") # Dummy audio can't be decoded
+
+def app_output(verbose):
+    # The app logs every request; keep that out of the report unless asked for
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+class Recorder:
+    def __init__(self):
+        self.samples = {} # endpoint -> [seconds, ...]
+        self.errors = {} # endpoint -> count
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+def run_encounter(client, recorder, audio_bytes, audio_name, stream):
+    def call(endpoint, method, url, **kwargs):
+        started = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        body = response.get_data() # Drains streamed (SSE) responses too
+        ok = response.status_code < 400 and b"generation_error" not in body
+        recorder.record(endpoint, time.perf_counter() - started, ok)
+        return response if ok else None
+
+    response = call("POST /create_note_session", "POST", "/create_note_session")
+    if not response:
+        return False
+    note_id = response.get_json()["note_id"]
+    response = call("POST /transcribe", "POST", "/transcribe",
+                    data={"file": (io.BytesIO(audio_bytes), audio_name)}, content_type="multipart/form-data")
+    transcript = response.get_json().get("text", "") if response else ""
+    # Unique text per encounter so the generation cache never short-circuits the model
+    subjective = f"{ENCOUNTER_SUBJECTIVE}{transcript} (encounter {uuid.uuid4()})"
+    call("POST /update_note_subjective", "POST", "/update_note_subjective", json={"note_id": note_id, "subjective_text": subjective})
+    call("POST /update_note_objective", "POST", "/update_note_objective", json={"note_id": note_id, "objective_text": ENCOUNTER_OBJECTIVE})
+
+    for section in ("assessment", "plan", "summary"):
+        suffix = "/stream" if stream else ""
+        response = call(f"GET /api/generate_{section}/<id>{suffix}", "GET", f"/api/generate_{section}/{note_id}{suffix}")
+        if not response:
+            return False
+        if section == "summary":
+            break
+        if stream:
+            text = f"{section} text streamed for note {note_id}"
+        else:
+            text = response.get_json()[f"{section}_text"]
+        call(f"POST /update_note_{section}", "POST", f"/update_note_{section}", json={"note_id": note_id, f"{section}_text": text})
+    return True
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_environment(args, workdir)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        with app_output(args.verbose):
+            import app as aims
+            import db
+            aims.init_db()
+
+        if args.audio:
+            with open(args.audio, "rb") as f:
+                audio_bytes = f.read()
+            audio_name = os.path.basename(args.audio)
+        else:
+            audio_bytes, audio_name = os.urandom(64 * 1024), "recording.webm"
+
+        recorder = Recorder()
+        encounters = {"completed": 0, "failed": 0}
+        encounters_lock = threading.Lock()
+        deadline = time.perf_counter() + args.seconds
+
+        def user():
+            client = aims.app.test_client()
+            while time.perf_counter() < deadline:
+                completed = run_encounter(client, recorder, audio_bytes, audio_name, args.stream)
+                with encounters_lock:
+                    encounters["completed" if completed else "failed"] += 1
+
+        workers = [threading.Thread(target=user) for _ in range(args.users)]
+        with app_output(args.verbose):
+            started = time.perf_counter()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            db.close_pool()
+
+    print(f"{args.users} users, {elapsed:.1f}s, latency stt={args.stt_latency}s storage={args.storage_latency}s "
+          f"llm={args.llm_latency}s, error rate {args.error_rate:.0%}{', SSE generation' if args.stream else ''}")
+    print(f"encounters: {encounters['completed']} completed, {encounters['failed']} failed "
+          f"({encounters['completed'] / elapsed:.2f}/s)")
+    print(f"{'endpoint':<42} {'count':>6} {'err':>5} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    total = 0
+    for endpoint, samples in recorder.samples.items():
+        samples = sorted(samples)
+        total += len(samples)
+        print(f"{endpoint:<42} {len(samples):>6} {recorder.errors.get(endpoint, 0):>5} {len(samples) / elapsed:>7.1f} "
+              f"{percentile(samples, 0.50) * 1000:>8.1f} {percentile(samples, 0.95) * 1000:>8.1f} {percentile(samples, 0.99) * 1000:>8.1f}")
+    print(f"{'total':<42} {total:>6} {sum(recorder.errors.values()):>5} {total / elapsed:>7.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import threading
+import time
+import traceback
+
+# Lazily constructed, thread-safe holders for the cloud clients (Speech, Storage, Gemini).
+# Nothing is built at import time; the first caller pays for credential discovery and setup,
+# concurrent callers wait on the same attempt, and a failed attempt is retried on a later call
+# once its backoff has elapsed instead of leaving the backend dead for the life of the process.
+INIT_RETRY_INITIAL_SECONDS = 5
+INIT_RETRY_MAX_SECONDS = 300
+
+class BackendUnavailableError(RuntimeError):
+    pass
+
+class LazyClient:
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.lock = threading.Lock() # State fields below
+        self.init_lock = threading.Lock() # Held while the factory runs
+        self.client = None
+        self.state = "not_initialized" # not_initialized -> initializing -> ready | failed
+        self.last_error = None
+        self.attempts = 0
+        self.retry_at = 0.0
+        self.init_seconds = None
+
+    def get(self):
+        client = self.client
+        if client is not None:
+            return client
+        # init_lock serializes construction; self.lock only guards the state fields, so status() never
+        # waits on a slow factory (credential discovery, vertexai.init)
+        with self.init_lock:
+            with self.lock:
+                if self.client is not None:
+                    return self.client
+                if self.state == "failed" and time.time() < self.retry_at:
+                    raise BackendUnavailableError(f"{self.name} client unavailable (retrying in {self.retry_at - time.time():.0f}s): {self.last_error}")
+                self.state = "initializing"
+                self.attempts += 1
+                attempt = self.attempts
+            started = time.perf_counter()
+            try:
+                client = self.factory()
+            except Exception as e:
+                backoff = min(INIT_RETRY_INITIAL_SECONDS * 2 ** (attempt - 1), INIT_RETRY_MAX_SECONDS)
+                with self.lock:
+                    self.state = "failed"
+                    self.last_error = str(e)
+                    self.retry_at = time.time() + backoff
+                print(f"⚠️ Error initializing {self.name} client (attempt {attempt}, retry in {backoff}s): {e}\n{traceback.format_exc()}")
+                raise BackendUnavailableError(f"{self.name} client unavailable: {e}") from e
+            init_seconds = time.perf_counter() - started
+            with self.lock:
+                self.init_seconds = init_seconds
+                self.client = client
+                self.state = "ready"
+                self.last_error = None
+            print(f"✅ {self.name} client initialized in {init_seconds:.2f}s.")
+            return client
+
+    def get_or_none(self):
+        try:
+            return self.get()
+        except BackendUnavailableError:
+            return None
+
+    def status(self):
+        with self.lock:
+            status = {"state": self.state, "attempts": self.attempts, "last_error": self.last_error}
+            if self.init_seconds is not None:
+                status["init_seconds"] = round(self.init_seconds, 3)
+            if self.state == "failed":
+                status["retry_in_seconds"] = max(0, round(self.retry_at - time.time(), 1))
+            return status
+
+def warm_up_clients(holders):
+    # Builds every holder on a daemon thread so the first real request doesn't pay for it.
+    # Failed holders are retried on their own backoff until all of them are ready.
+    def run():
+        pending = list(holders)
+        while pending:
+            for holder in list(pending):
+                if holder.get_or_none() is not None:
+                    pending.remove(holder)
+            if pending:
+                time.sleep(max(1.0, min(holder.retry_at for holder in pending) - time.time()))
+
+    thread = threading.Thread(target=run, name="client-warmup", daemon=True)
+    thread.start()
+    return thread
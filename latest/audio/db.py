@@ -0,0 +1,306 @@
+import os
+import queue
+import sqlite3
+import threading
+import traceback
+
+from metrics import span
+
+# Database setup
+DATABASE_NAME = 'notes_main.db' # Renamed to avoid conflict with any old db
+DATABASE_PATH = os.environ.get("NOTES_DATABASE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), DATABASE_NAME))
+
+# Connection pool: connections are opened once, tuned, and reused across requests instead of a
+# connect/close per request. Each connection is used by one thread at a time (check_same_thread=False
+# only lets it move between threads), and the statement cache of a reused connection means repeated
+# queries skip SQL compilation.
+DB_POOL_MAX_IDLE = int(os.environ.get("DB_POOL_MAX_IDLE", "16")) # Idle connections kept for reuse
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHED_STATEMENTS = 256
+DB_PRAGMAS = [
+    "PRAGMA synchronous = NORMAL", # Safe with WAL: a crash can only lose the last transactions, not corrupt
+    "PRAGMA cache_size = -16384", # 16 MiB page cache per connection
+    "PRAGMA mmap_size = 268435456", # Map up to 256 MiB of the database file
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+]
+_idle_connections = queue.LifoQueue()
+_wal_enabled = set() # database paths already switched to WAL by this process
+_wal_lock = threading.Lock()
+
+class PooledConnection:
+    # Wrapper returned by get_db_connection(). It behaves like sqlite3.Connection, but close() rolls back
+    # anything uncommitted and hands the connection back to the pool; closing twice is harmless.
+    def __init__(self, conn):
+        self._conn = conn
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self):
+        return InstrumentedCursor(self._conn.cursor())
+
+    def execute(self, sql, parameters=()):
+        with span("db_query", statement=statement_kind(sql)):
+            return self._conn.execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with span("db_query", statement=statement_kind(sql)):
+            return self._conn.executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        with span("db_query", statement="COMMIT"):
+            self._conn.commit()
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return self._conn.__exit__(exc_type, exc_value, tb)
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        release_connection(self._conn)
+
+class InstrumentedCursor:
+    # sqlite3.Cursor wrapper that times execute()/executemany() as db_query spans
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, sql, parameters=()):
+        with span("db_query", statement=statement_kind(sql)):
+            self._cursor.execute(sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        with span("db_query", statement=statement_kind(sql)):
+            self._cursor.executemany(sql, seq_of_parameters)
+        return self
+
+def statement_kind(sql):
+    # First SQL keyword (SELECT, UPDATE, ...) keeps the metric's label set small
+    words = sql.split(None, 1)
+    return words[0].upper() if words else "EMPTY"
+
+def open_connection(database_path=None):
+    database_path = database_path or DATABASE_PATH
+    conn = sqlite3.connect(database_path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           cached_statements=DB_CACHED_STATEMENTS)
+    conn.row_factory = sqlite3.Row # To access columns by name
+    with _wal_lock:
+        if database_path not in _wal_enabled:
+            # WAL lets readers run alongside a writer; the mode is stored in the database file itself
+            conn.execute("PRAGMA journal_mode = WAL")
+            _wal_enabled.add(database_path)
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def release_connection(conn):
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        if _idle_connections.qsize() < DB_POOL_MAX_IDLE:
+            _idle_connections.put(conn)
+            return
+    except sqlite3.Error:
+        pass
+    conn.close()
+
+def get_db_connection():
+    try:
+        conn = _idle_connections.get_nowait()
+    except queue.Empty:
+        conn = open_connection()
+    return PooledConnection(conn)
+
+def close_pool():
+    # Closes every idle connection (e.g. before deleting or replacing the database file)
+    while True:
+        try:
+            _idle_connections.get_nowait().close()
+        except queue.Empty:
+            return
+
+# Full-text search: an external-content FTS5 index over the note sections, kept in sync by triggers.
+# The update trigger only fires for the text columns, so updated_at bumps don't touch the index.
+NOTES_FTS_COLUMNS = ["subjective_text", "objective_text", "assessment_text", "plan_text", "summary_text"]
+
+def init_search_index(cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='notes_fts'")
+    if cursor.fetchone() is not None:
+        return
+    columns = ", ".join(NOTES_FTS_COLUMNS)
+    new_values = ", ".join(f"new.{column}" for column in NOTES_FTS_COLUMNS)
+    old_values = ", ".join(f"old.{column}" for column in NOTES_FTS_COLUMNS)
+    try:
+        cursor.execute(f"CREATE VIRTUAL TABLE notes_fts USING fts5({columns}, content='notes', content_rowid='id', tokenize='porter unicode61')")
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ Full-text search disabled: this SQLite build has no FTS5 ({e}).")
+        return
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, {columns}) VALUES (new.id, {new_values});
+        END;
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+        END;
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF {columns} ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO notes_fts (rowid, {columns}) VALUES (new.id, {new_values});
+        END;
+    ''')
+    # Index the notes that existed before search was added
+    cursor.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+    print("🔎 Built the notes full-text search index.")
+
+def init_db():
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS notes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                subjective_text TEXT,
+                objective_text TEXT,
+                assessment_text TEXT,
+                plan_text TEXT,
+                summary_text TEXT, -- Added for summary
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Check if updated_at trigger exists, if not, create it
+        cursor.execute('''
+            SELECT name FROM sqlite_master WHERE type='trigger' AND name='update_notes_updated_at';
+        ''')
+        if cursor.fetchone() is None:
+            cursor.execute('''
+                CREATE TRIGGER update_notes_updated_at
+                AFTER UPDATE ON notes
+                FOR EACH ROW
+                BEGIN
+                    UPDATE notes SET updated_at = CURRENT_TIMESTAMP WHERE id = OLD.id;
+                END;
+            ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS transcription_jobs (
+                id TEXT PRIMARY KEY,
+                note_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'queued', -- queued, running, done, failed
+                filename TEXT,
+                audio_path TEXT,
+                transcript_text TEXT,
+                error TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS generation_cache (
+                cache_key TEXT PRIMARY KEY,
+                section TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                response_text TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL, -- Unix timestamps, used for TTL and LRU eviction
+                last_accessed_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_generation_cache_last_accessed ON generation_cache (last_accessed_at)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS soap_pipeline_runs (
+                note_id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL, -- running, failed, completed
+                last_completed_stage TEXT, -- assessment, plan or summary
+                error TEXT,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Which prompt version produced a section that the server wrote itself (SOAP pipeline, batch regeneration).
+        # A clinician's own save of that section removes its row.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS note_generations (
+                note_id INTEGER NOT NULL,
+                section TEXT NOT NULL, -- assessment, plan or summary
+                prompt_version TEXT NOT NULL,
+                input_hash TEXT NOT NULL, -- generation cache key of the inputs it was generated from
+                model TEXT,
+                generated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (note_id, section)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_note_generations_version ON note_generations (section, prompt_version)")
+        # Condensed stand-ins for over-budget Subjective sections, keyed by a hash of the text they condense
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS note_digests (
+                source_hash TEXT PRIMARY KEY,
+                note_id INTEGER,
+                digest_text TEXT NOT NULL,
+                source_tokens INTEGER NOT NULL, -- estimated
+                digest_tokens INTEGER NOT NULL,
+                prompt_version TEXT NOT NULL,
+                model TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_note_digests_note_id ON note_digests (note_id)")
+        # Resumable audio uploads: one row per upload session, one per chunk already written to object storage
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS audio_uploads (
+                id TEXT PRIMARY KEY,
+                note_id INTEGER,
+                filename TEXT,
+                total_size INTEGER NOT NULL,
+                received_bytes INTEGER NOT NULL DEFAULT 0, -- offset the next chunk must start at
+                status TEXT NOT NULL DEFAULT 'receiving', -- receiving, composing, completed, expired
+                job_id TEXT, -- transcription job created when the upload completed
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_audio_uploads_status ON audio_uploads (status, updated_at)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS audio_upload_parts (
+                upload_id TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                object_name TEXT NOT NULL,
+                PRIMARY KEY (upload_id, offset)
+            )
+        ''')
+        # Per-note change counter behind the ETag of /get_note_data. Triggers bump it on every write, from whichever
+        # process (updated_at has only second resolution). Notes written before this table existed are at version 0.
+        cursor.execute("CREATE TABLE IF NOT EXISTS note_versions (note_id INTEGER PRIMARY KEY, version INTEGER NOT NULL)")
+        for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS notes_version_{event.lower()} AFTER {event} ON notes BEGIN
+                    INSERT INTO note_versions (note_id, version) VALUES ({row}.id, 1)
+                    ON CONFLICT (note_id) DO UPDATE SET version = version + 1;
+                END
+            ''')
+        # Note listing pages through notes newest-first by (updated_at, id)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notes_updated_at ON notes (updated_at, id)")
+        init_search_index(cursor)
+        conn.commit()
+        print(f"Database '{DATABASE_NAME}' initialized successfully at {DATABASE_PATH}")
+    except Exception as e:
+        print(f"Error initializing database: {e}\n{traceback.format_exc()}")
+    finally:
+        if conn:
+            conn.close()
@@ -0,0 +1,186 @@
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import zlib
+
+import db
+
+# Streaming bulk export of the notes table as gzip-compressed JSONL or Parquet.
+#
+# Notes are read in (updated_at, id) order, one keyset page at a time, so memory use stays
+# flat whatever the table size, and each page is written out before the next is read.
+# An export covers the notes changed after a cursor and up to a snapshot bound taken when
+# it starts. The bound excludes the current second, because updated_at only has second
+# resolution and rows could still be committed with that timestamp. Save the returned
+# cursor and pass it to the next run, and a nightly sync only moves the rows that changed.
+# Parquet needs the optional `pyarrow` package.
+#
+#     python latest/audio/export_notes.py --out notes.jsonl.gz --state export_state.json
+#     python latest/audio/export_notes.py --format parquet --out notes.parquet --full
+
+EXPORT_COLUMNS = ["id", "subjective_text", "objective_text", "assessment_text", "plan_text", "summary_text", "created_at", "updated_at"]
+EXPORT_FORMATS = {
+    "jsonl": {"extension": "jsonl.gz", "content_type": "application/gzip"},
+    "parquet": {"extension": "parquet", "content_type": "application/vnd.apache.parquet"},
+}
+EXPORT_PAGE_SIZE = 2000
+PARQUET_COMPRESSION = "zstd"
+
+def snapshot_bound(conn, after=None, lag_seconds=0):
+    # The last (updated_at, id) the export will include: the newest row updated before the current second
+    # (minus lag_seconds). Returns None when nothing changed after the cursor.
+    row = conn.execute("SELECT updated_at, id FROM notes WHERE updated_at < datetime('now', ?) ORDER BY updated_at DESC, id DESC LIMIT 1",
+                       (f"-{int(lag_seconds)} seconds",)).fetchone()
+    if row is None or (after is not None and (row[0], row[1]) <= tuple(after)):
+        return None
+    return row[0], row[1]
+
+def iter_note_pages(after, until, page_size=EXPORT_PAGE_SIZE):
+    # Keyset pages of rows with after < (updated_at, id) <= until. Each page is a short read of its own,
+    # so a long export never holds a read transaction open (which would stop WAL checkpoints).
+    columns = ", ".join(EXPORT_COLUMNS)
+    position = tuple(after) if after else None
+    while True:
+        conn = db.get_db_connection()
+        try:
+            if position:
+                rows = conn.execute(f"SELECT {columns} FROM notes WHERE (updated_at, id) > (?, ?) AND (updated_at, id) <= (?, ?) "
+                                    f"ORDER BY updated_at, id LIMIT ?", (*position, *until, page_size)).fetchall()
+            else:
+                rows = conn.execute(f"SELECT {columns} FROM notes WHERE (updated_at, id) <= (?, ?) ORDER BY updated_at, id LIMIT ?",
+                                    (*until, page_size)).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return
+        yield [tuple(row) for row in rows]
+        if len(rows) < page_size:
+            return
+        position = (rows[-1]["updated_at"], rows[-1]["id"])
+
+def iter_jsonl_gzip(pages, stats):
+    # One JSON object per line, gzip-compressed on the fly; yields compressed bytes as they become available
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits 31: gzip container
+    for page in pages:
+        text = "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n" for row in page)
+        stats["rows"] += len(page)
+        chunk = compressor.compress(text.encode("utf-8"))
+        if chunk:
+            stats["bytes"] += len(chunk)
+            yield chunk
+    chunk = compressor.flush()
+    stats["bytes"] += len(chunk)
+    yield chunk
+
+class ChunkSink(io.RawIOBase):
+    # Write-only file object that hands pyarrow's output back to a generator
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def iter_parquet(pages, stats):
+    # One Parquet row group per page; each is yielded as soon as it has been encoded
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([("id", pa.int64())] + [(column, pa.string()) for column in EXPORT_COLUMNS[1:]])
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression=PARQUET_COMPRESSION)
+    try:
+        for page in pages:
+            columns = list(zip(*page))
+            writer.write_table(pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+            stats["rows"] += len(page)
+            data = sink.drain()
+            if data:
+                stats["bytes"] += len(data)
+                yield data
+    finally:
+        writer.close()
+    data = sink.drain()
+    stats["bytes"] += len(data)
+    yield data
+
+def parquet_available():
+    try:
+        import pyarrow.parquet # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def iter_export(export_format, after, until, stats, page_size=EXPORT_PAGE_SIZE):
+    pages = iter_note_pages(after, until, page_size) if until else iter(())
+    if export_format == "parquet":
+        return iter_parquet(pages, stats)
+    return iter_jsonl_gzip(pages, stats)
+
+def load_state(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        state = json.load(f)
+    return state["updated_at"], state["id"]
+
+def save_state(path, cursor, stats):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"updated_at": cursor[0], "id": cursor[1], "rows": stats["rows"], "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S")}, f, indent=2)
+    os.replace(temp_path, path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming bulk export of the notes table as gzip-compressed JSONL or Parquet.")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="jsonl")
+    parser.add_argument("--out", required=True, help="output file (written to a temporary name and renamed when complete)")
+    parser.add_argument("--state", help="JSON file holding the sync cursor: read before the export, updated after it succeeds")
+    parser.add_argument("--full", action="store_true", help="export every note, ignoring the cursor in --state")
+    parser.add_argument("--lag", type=int, default=0, help="also leave out rows updated in the last N seconds")
+    parser.add_argument("--page-size", type=int, default=EXPORT_PAGE_SIZE, help="rows read and written per step")
+    parser.add_argument("--database", default=db.DATABASE_PATH, help="notes database (default: NOTES_DATABASE_PATH or the app's default)")
+    args = parser.parse_args()
+    if args.format == "parquet" and not parquet_available():
+        parser.error("Parquet export needs pyarrow: pip install pyarrow")
+
+    db.DATABASE_PATH = args.database
+    after = None if args.full else load_state(args.state)
+    conn = db.get_db_connection()
+    try:
+        until = snapshot_bound(conn, after, args.lag)
+    finally:
+        conn.close()
+    if until is None and after is not None:
+        print(f"No notes changed since {after[0]} (id {after[1]}); nothing to export.", file=sys.stderr)
+        return
+
+    stats = {"rows": 0, "bytes": 0}
+    started = time.perf_counter()
+    temp_path = f"{args.out}.partial"
+    with open(temp_path, "wb") as f:
+        for chunk in iter_export(args.format, after, until, stats, args.page_size):
+            f.write(chunk)
+    os.replace(temp_path, args.out)
+    elapsed = time.perf_counter() - started
+    if args.state and until:
+        save_state(args.state, until, stats)
+    print(f"Exported {stats['rows']} notes ({stats['bytes'] / 1e6:.1f} MB {args.format}) to {args.out} in {elapsed:.2f}s "
+          f"({stats['rows'] / elapsed if elapsed else 0:.0f} rows/s)" + (f"; cursor now {until[0]} (id {until[1]})." if until else "."), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
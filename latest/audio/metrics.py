@@ -0,0 +1,138 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Minimal in-process metrics with Prometheus text exposition (served by app.py at /metrics).
+# Every metric keeps one series per distinct label set.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + (list(extra) if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in items) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self.series = {} # sorted label tuple -> value
+        with _registry_lock:
+            _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for labels, value in sorted(self.series.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.series[tuple(sorted(labels.items()))] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            state = self.series.get(key)
+            if state is None:
+                state = self.series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, state in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, state["counts"]):
+                    lines.append(f"{self.name}_bucket{_format_labels(labels, [('le', _format_value(bound))])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(labels, [('le', '+Inf')])} {state['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(state['sum'])}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {state['count']}")
+        return lines
+
+def render_prometheus():
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+span_duration = Histogram("aims_span_duration_seconds", "Duration of instrumented operations (external calls, DB queries).")
+span_in_flight = Gauge("aims_span_in_flight", "Instrumented operations currently in progress.")
+span_errors = Counter("aims_span_errors_total", "Instrumented operations that raised an exception.")
+http_request_duration = Histogram("aims_http_request_duration_seconds", "HTTP request handling time (until the response is returned).")
+http_requests_in_flight = Gauge("aims_http_requests_in_flight", "HTTP requests currently being handled.")
+llm_prompt_bytes = Counter("aims_llm_prompt_bytes_total", "Bytes of prompt text sent to the language model.")
+llm_response_bytes = Counter("aims_llm_response_bytes_total", "Bytes of generated text received from the language model.")
+llm_time_to_first_chunk = Histogram("aims_llm_time_to_first_chunk_seconds", "Time until the first streamed chunk arrives from the language model.")
+generation_cache_events = Counter("aims_generation_cache_events_total", "Generation cache hits, misses, stores and evictions.")
+transcript_digest_events = Counter("aims_transcript_digest_events_total", "Over-budget Subjective sections condensed (created), served from a stored digest (reused) or sent in full (failed).")
+llm_prompt_size = Histogram("aims_llm_prompt_size_bytes", "Size of individual prompts sent to the language model.", buckets=SIZE_BUCKETS)
+
+@contextmanager
+def span(name, **labels):
+    # Times a block into aims_span_duration_seconds{span=name,...} and tracks it as in flight meanwhile
+    labels = {"span": name, **labels}
+    span_in_flight.inc(**labels)
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        span_errors.inc(**labels)
+        raise
+    finally:
+        span_duration.observe(time.perf_counter() - started, **labels)
+        span_in_flight.dec(**labels)
+
+def record_llm_sizes(section, prompt, response_text):
+    prompt_size = len(prompt.encode('utf-8'))
+    llm_prompt_bytes.inc(prompt_size, section=section)
+    llm_prompt_size.observe(prompt_size, section=section)
+    if response_text:
+        llm_response_bytes.inc(len(response_text.encode('utf-8')), section=section)
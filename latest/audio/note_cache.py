@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+
+from metrics import Counter
+
+# In-process read-through cache for /get_note_data: serialized note bodies, least recently used first out,
+# bounded by their total size in bytes. Entries are tagged with the note's version (see note_versions in
+# db.py), so a body is only served while the note is unchanged, even when another process wrote to it.
+note_cache_events = Counter("aims_note_cache_events_total", "Note cache hits, misses, stores, evictions and invalidations.")
+
+class NoteCacheEntry:
+    def __init__(self, version):
+        self.version = version
+        self.bodies = {} # field projection -> serialized JSON bytes
+        self.size = 0
+
+class NoteCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # note_id -> NoteCacheEntry, least recently used first
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, note_id, version, projection):
+        with self.lock:
+            entry = self.entries.get(note_id)
+            body = entry.bodies.get(projection) if entry and entry.version == version else None
+            if body is None:
+                self.stats["misses"] += 1
+            else:
+                self.entries.move_to_end(note_id)
+                self.stats["hits"] += 1
+        note_cache_events.inc(event="hit" if body is not None else "miss")
+        return body
+
+    def put(self, note_id, version, projection, body):
+        if len(body) > self.max_bytes:
+            return
+        evicted = 0
+        with self.lock:
+            entry = self.entries.get(note_id)
+            if entry is not None and entry.version > version:
+                return # A newer version was stored meanwhile
+            if entry is None or entry.version != version:
+                if entry is not None:
+                    self.size -= entry.size
+                entry = self.entries[note_id] = NoteCacheEntry(version)
+            previous = entry.bodies.get(projection)
+            if previous is not None:
+                entry.size -= len(previous)
+                self.size -= len(previous)
+            entry.bodies[projection] = body
+            entry.size += len(body)
+            self.size += len(body)
+            self.entries.move_to_end(note_id)
+            self.stats["stores"] += 1
+            while self.size > self.max_bytes and self.entries:
+                _, oldest = self.entries.popitem(last=False)
+                self.size -= oldest.size
+                evicted += 1
+            self.stats["evictions"] += evicted
+        note_cache_events.inc(event="store")
+        if evicted:
+            note_cache_events.inc(evicted, event="eviction")
+
+    def invalidate(self, note_ids):
+        # Write-through: called after a write to these notes commits
+        removed = 0
+        with self.lock:
+            for note_id in note_ids:
+                entry = self.entries.pop(int(note_id), None)
+                if entry is not None:
+                    self.size -= entry.size
+                    removed += 1
+            self.stats["invalidations"] += removed
+        if removed:
+            note_cache_events.inc(removed, event="invalidation")
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, "notes": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes}
@@ -0,0 +1,324 @@
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+from resilience import BATCH, ServiceUnavailableError
+
+# Offline batch (re)generation of a generated note section across the notes table.
+#
+# Streams candidate notes in id order, generates the section on a bounded worker pool
+# (at BATCH priority, under an optional requests-per-second limit) and writes the results
+# back in batched transactions. A write only lands if the note's inputs and the section
+# itself are unchanged since they were read, so clinician edits made meanwhile win.
+# Progress is checkpointed after every batch of finished notes (failed ones included) and
+# at least every few seconds; re-running with the same checkpoint resumes.
+#
+# Candidates:
+#   --missing            the section is empty (e.g. backfilling summaries for old notes)
+#   --stale              the section was generated with an older prompt version (PROMPT_VERSIONS)
+#   --include-untracked  with --stale, also notes whose section has no generation record
+#                        (written before records were kept, or by hand) - use with care
+#
+#     python latest/audio/regenerate_notes.py --section summary --missing --workers 4 --rate 2
+#     python latest/audio/regenerate_notes.py --section plan --stale --checkpoint plan.ckpt.json
+
+GENERATED_SECTIONS = ["assessment", "plan", "summary"]
+CHECKPOINT_INTERVAL_SECONDS = 10
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline batch (re)generation of a generated note section across the notes table.")
+    parser.add_argument("--section", required=True, choices=GENERATED_SECTIONS, help="section to (re)generate")
+    parser.add_argument("--missing", action="store_true", help="select notes where the section is empty")
+    parser.add_argument("--stale", action="store_true", help="select notes generated with an older prompt version")
+    parser.add_argument("--include-untracked", action="store_true", help="with --stale, also select sections with no generation record")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent generations")
+    parser.add_argument("--rate", type=float, default=0.0, help="max generations started per second (0 = unlimited)")
+    parser.add_argument("--batch-size", type=int, default=50, help="results written per transaction")
+    parser.add_argument("--limit", type=int, default=0, help="stop after this many candidates (0 = all)")
+    parser.add_argument("--checkpoint", help="JSON file to record progress in and resume from")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint and start over")
+    parser.add_argument("--max-attempts", type=int, default=5, help="attempts per note while the model is unavailable")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the generation cache")
+    parser.add_argument("--dry-run", action="store_true", help="only count the candidates")
+    parser.add_argument("--database", help="notes database (default: NOTES_DATABASE_PATH or the app's default)")
+    parser.add_argument("--verbose", action="store_true", help="show the app's own log output")
+    args = parser.parse_args()
+    if not (args.missing or args.stale):
+        parser.error("choose the candidates with --missing and/or --stale")
+    if args.include_untracked and not args.stale:
+        parser.error("--include-untracked only applies with --stale")
+    return args
+
+def app_output(verbose):
+    # The generators log every call; keep that out of the progress report unless asked for
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+class RateLimiter:
+    # Token bucket shared by the workers: at most `rate` starts per second, bursts of one second's worth
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = max(1.0, rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class Checkpoint:
+    # watermark: every candidate with id <= watermark has been handled; failed: ids to retry on the next run
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.watermark = 0
+        self.failed = []
+        self.counts = {"written": 0, "conflicts": 0, "failed": 0}
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("key") != self.key:
+            raise SystemExit(f"Checkpoint {self.path} belongs to a different run ({state.get('key')}); use --restart to discard it.")
+        self.watermark = state["watermark"]
+        self.failed = state["failed"]
+        self.counts = state["counts"]
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"key": self.key, "watermark": self.watermark, "failed": self.failed, "counts": self.counts,
+                       "saved_at": time.strftime("%Y-%m-%dT%H:%M:%S")}, f, indent=2)
+        os.replace(temp_path, self.path) # Atomic, so a crash never leaves a half-written checkpoint
+
+def candidate_filter(aims, args):
+    # SQL condition (over notes n LEFT JOIN note_generations g) plus its parameters
+    target = f"{args.section}_text"
+    inputs = " AND ".join(f"TRIM(IFNULL(n.{field}, '')) != ''" for field in aims.SECTION_INPUT_FIELDS[args.section])
+    selections, params = [], []
+    if args.missing:
+        selections.append(f"TRIM(IFNULL(n.{target}, '')) = ''")
+    if args.stale:
+        selections.append("(g.prompt_version IS NOT NULL AND g.prompt_version != ?)")
+        params.append(aims.PROMPT_VERSIONS[args.section])
+        if args.include_untracked:
+            selections.append(f"(g.note_id IS NULL AND TRIM(IFNULL(n.{target}, '')) != '')")
+    return f"{inputs} AND ({' OR '.join(selections)})", params
+
+def select_sql(aims, args, where):
+    columns = ", ".join(f"n.{field}" for field in [*aims.SECTION_INPUT_FIELDS[args.section], f"{args.section}_text"])
+    return (f"SELECT n.id, {columns} FROM notes n LEFT JOIN note_generations g ON g.note_id = n.id AND g.section = ? "
+            f"WHERE {where}")
+
+def count_candidates(aims, args, after_id):
+    condition, params = candidate_filter(aims, args)
+    conn = aims.get_db_connection()
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM notes n LEFT JOIN note_generations g ON g.note_id = n.id AND g.section = ? "
+                            f"WHERE n.id > ? AND {condition}", (args.section, after_id, *params)).fetchone()[0]
+    finally:
+        conn.close()
+
+def matching_candidate_ids(aims, args, note_ids):
+    # The ids among note_ids that are still candidates (a clinician may have filled the section in meanwhile)
+    condition, params = candidate_filter(aims, args)
+    note_ids = sorted(set(note_ids))
+    matching = []
+    conn = aims.get_db_connection()
+    try:
+        for start in range(0, len(note_ids), 500):
+            ids = note_ids[start:start + 500]
+            matching.extend(row[0] for row in conn.execute(
+                f"SELECT n.id FROM notes n LEFT JOIN note_generations g ON g.note_id = n.id AND g.section = ? "
+                f"WHERE n.id IN ({', '.join('?' * len(ids))}) AND {condition}", (args.section, *ids, *params)).fetchall())
+    finally:
+        conn.close()
+    return matching
+
+def stream_candidates(aims, args, after_id, retry_ids):
+    # Earlier failures first, then keyset pages past the watermark; rows are re-checked against the filter.
+    # A failure can lie above the watermark (a note before it was still in flight), so pages skip retried ids.
+    condition, params = candidate_filter(aims, args)
+    retry_ids = sorted(retry_ids)
+    retried = set(retry_ids)
+    conn = aims.get_db_connection()
+    try:
+        for start in range(0, len(retry_ids), 500):
+            ids = retry_ids[start:start + 500]
+            sql = select_sql(aims, args, f"n.id IN ({', '.join('?' * len(ids))}) AND {condition}") + " ORDER BY n.id"
+            yield from [tuple(row) for row in conn.execute(sql, (args.section, *ids, *params)).fetchall()]
+        page_sql = select_sql(aims, args, f"n.id > ? AND {condition}") + " ORDER BY n.id LIMIT ?"
+        while True:
+            rows = conn.execute(page_sql, (args.section, after_id, *params, args.batch_size * 4)).fetchall()
+            if not rows:
+                return
+            yield from [tuple(row) for row in rows if row[0] not in retried]
+            after_id = rows[-1][0]
+    finally:
+        conn.close()
+
+def generate(aims, args, limiter, note_id, inputs):
+    # Returns the generated text, or None when the model produced nothing usable
+    for attempt in range(args.max_attempts):
+        limiter.acquire()
+        try:
+            return aims.SECTION_GENERATORS[args.section](*inputs, use_cache=not args.no_cache, priority=BATCH, note_id=note_id) or None
+        except ServiceUnavailableError as e:
+            if attempt + 1 >= args.max_attempts:
+                raise
+            print(f"Model unavailable ({e}); waiting {e.retry_after}s.", file=sys.stderr)
+            time.sleep(e.retry_after)
+
+def write_results(aims, args, results):
+    # results: [(row, generated_text)]. Returns (written, conflicts).
+    fields = aims.SECTION_INPUT_FIELDS[args.section]
+    target = f"{args.section}_text"
+    guard = " AND ".join(f"IFNULL({field}, '') = ?" for field in [*fields, target])
+    sql = f"UPDATE notes SET {target} = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND {guard}"
+    conn = aims.get_db_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        written = []
+        for row, text in results:
+            note_id, values = row[0], [value or "" for value in row[1:]]
+            if conn.execute(sql, (text, note_id, *values)).rowcount:
+                written.append((note_id, args.section, aims.generation_cache_key(args.section, *row[1:-1])))
+        aims.record_note_generations(conn, written)
+        conn.commit()
+        return len(written), len(results) - len(written)
+    finally:
+        conn.close()
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def main():
+    args = parse_args()
+    if args.database:
+        os.environ["NOTES_DATABASE_PATH"] = os.path.abspath(args.database) # Read by db.py at import time
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with app_output(args.verbose):
+        import app as aims
+        import db
+        aims.init_db()
+
+    selection = "+".join(name for name, chosen in [("missing", args.missing), ("stale", args.stale), ("untracked", args.include_untracked)] if chosen)
+    checkpoint = Checkpoint(args.checkpoint, f"{args.section}:{selection}:v{aims.PROMPT_VERSIONS[args.section]}")
+    if args.restart or not checkpoint.load():
+        checkpoint.save()
+    else:
+        print(f"Resuming from note {checkpoint.watermark} with {len(checkpoint.failed)} earlier failures to retry.", file=sys.stderr)
+
+    checkpoint.failed = matching_candidate_ids(aims, args, checkpoint.failed)
+    retrying = set(checkpoint.failed)
+    total = count_candidates(aims, args, checkpoint.watermark) + len([note_id for note_id in retrying if note_id <= checkpoint.watermark])
+    if args.limit:
+        total = min(total, args.limit)
+    print(f"{total} notes to {'regenerate' if args.stale else 'generate'} the {args.section} for "
+          f"(prompt version {aims.PROMPT_VERSIONS[args.section]}, {args.workers} workers"
+          f"{f', {args.rate:g}/s' if args.rate else ''}).", file=sys.stderr)
+    if args.dry_run or not total:
+        return
+
+    limiter = RateLimiter(args.rate)
+    # Earlier failures stay listed in the checkpoint until their retry finishes, so an interrupted run keeps them
+    submitted = [] # ids past the old watermark, in order; the watermark advances over finished ones
+    finished = set()
+    pending_results = []
+    processed = unsaved = 0
+    started = last_report = last_flush = time.monotonic()
+
+    def flush():
+        nonlocal unsaved, last_flush
+        if pending_results:
+            written, conflicts = write_results(aims, args, pending_results)
+            checkpoint.counts["written"] += written
+            checkpoint.counts["conflicts"] += conflicts
+            pending_results.clear()
+        while submitted and submitted[0] in finished:
+            checkpoint.watermark = max(checkpoint.watermark, submitted.pop(0))
+        checkpoint.save()
+        unsaved, last_flush = 0, time.monotonic()
+
+    def report(final=False):
+        elapsed = time.monotonic() - started
+        rate = processed / elapsed if elapsed else 0.0
+        eta = (total - processed) / rate if rate else 0
+        print(f"{'done' if final else 'progress'}: {processed}/{total} ({rate:.2f} notes/s, elapsed {format_duration(elapsed)}"
+              f"{'' if final else f', ETA {format_duration(eta)}'}) written={checkpoint.counts['written']} "
+              f"conflicts={checkpoint.counts['conflicts']} failed={len(checkpoint.failed)}", file=sys.stderr)
+
+    candidates = stream_candidates(aims, args, checkpoint.watermark, retrying)
+    if args.limit:
+        candidates = (row for _, row in zip(range(args.limit), candidates))
+    in_flight = {}
+    with app_output(args.verbose), concurrent.futures.ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="regenerate") as executor:
+        try:
+            while True:
+                # Keep the pool busy without reading the whole table into memory
+                for row in candidates:
+                    if row[0] not in retrying:
+                        submitted.append(row[0])
+                    in_flight[executor.submit(generate, aims, args, limiter, row[0], row[1:-1])] = row
+                    if len(in_flight) >= args.workers * 2:
+                        break
+                if not in_flight:
+                    break
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    row = in_flight.pop(future)
+                    processed += 1
+                    unsaved += 1
+                    try:
+                        text = future.result()
+                    except Exception as e:
+                        print(f"Note {row[0]}: generation failed ({type(e).__name__}: {e}).", file=sys.stderr)
+                        text = None
+                    if row[0] in retrying:
+                        checkpoint.failed.remove(row[0])
+                    if text:
+                        pending_results.append((row, text))
+                    else:
+                        checkpoint.failed.append(row[0])
+                        checkpoint.counts["failed"] += 1
+                    finished.add(row[0])
+                # Counted over finished notes, not successes, so a run where most generations fail still checkpoints
+                if unsaved >= args.batch_size or time.monotonic() - last_flush >= CHECKPOINT_INTERVAL_SECONDS:
+                    flush()
+                if time.monotonic() - last_report >= 5:
+                    report()
+                    last_report = time.monotonic()
+        except KeyboardInterrupt:
+            print("Interrupted; saving progress (re-run with the same --checkpoint to resume).", file=sys.stderr)
+            for future in in_flight:
+                future.cancel()
+            raise
+        finally:
+            # Whatever finished is written; unfinished ids stay above the watermark
+            flush()
+    report(final=True)
+    db.close_pool()
+
+if __name__ == "__main__":
+    main()
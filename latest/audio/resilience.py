@@ -0,0 +1,271 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from metrics import Counter, Gauge
+
+# Client-side protection for the model and speech APIs: an AIMD concurrency limiter with priority
+# classes, jittered exponential retry for retryable errors, and a circuit breaker that fails fast
+# while the service is down. One Guard per external service is shared by every caller.
+INTERACTIVE = 0 # A clinician is waiting on the response
+BACKGROUND = 1 # Speculative generation, queued transcription jobs
+BATCH = 2 # Offline bulk work (regeneration CLI)
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background", BATCH: "batch"}
+
+# Quota and server-side errors returned by the service: HTTP statuses (google.api_core exceptions carry them
+# as .code) and exception names worth retrying. Client-side timeouts are not retried: a TimeoutError from
+# operation.result(timeout=...) means a long-running recognition already used its whole budget, and running
+# it again would hold a slot for that long once more (on Python 3.11+ concurrent.futures.TimeoutError is
+# the built-in TimeoutError). api_core's RetryError means its own retries are already exhausted.
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_ERROR_NAMES = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+                         "BadGateway", "GatewayTimeout", "DeadlineExceeded", "BackendError"}
+# Not retried here, but still a sign the service can't be used: clients.LazyClient raises BackendUnavailableError
+# while the client can't be built, and it has its own retry backoff
+OUTAGE_ERROR_NAMES = {"BackendUnavailableError"}
+
+limiter_limit = Gauge("aims_limiter_concurrency_limit", "Current adaptive concurrency limit per service.")
+limiter_in_flight = Gauge("aims_limiter_in_flight", "Calls currently holding a concurrency slot.")
+limiter_queued = Gauge("aims_limiter_queued", "Calls waiting for a concurrency slot.")
+limiter_rejected = Counter("aims_limiter_rejected_total", "Calls shed after waiting too long for a slot.")
+call_retries = Counter("aims_call_retries_total", "Retries of failed calls to an external service.")
+breaker_state = Gauge("aims_circuit_breaker_open", "1 while a service's circuit breaker is open (or half-open), else 0.")
+breaker_rejected = Counter("aims_circuit_breaker_rejected_total", "Calls failed fast by an open circuit breaker.")
+
+class ServiceUnavailableError(RuntimeError):
+    # The call was not attempted; retry_after is a hint in seconds for the client
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, int(round(retry_after)))
+
+class CircuitOpenError(ServiceUnavailableError):
+    pass
+
+class OverloadedError(ServiceUnavailableError):
+    pass
+
+def is_retryable(error):
+    if isinstance(error, ServiceUnavailableError):
+        return False
+    if isinstance(error, TimeoutError):
+        return False
+    if isinstance(error, ConnectionError):
+        return True
+    code = getattr(error, "code", None)
+    if isinstance(code, int) and code in RETRYABLE_STATUS_CODES:
+        return True
+    return type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+def is_outage(error):
+    # Counts against the circuit breaker; other non-retryable errors mean the service answered a bad request
+    return is_retryable(error) or type(error).__name__ in OUTAGE_ERROR_NAMES
+
+class AIMDLimiter:
+    # Grows the limit by about one slot per limit's worth of successes and halves it on an
+    # overload signal (at most once per cooldown). Waiters are served strictly by priority, then FIFO.
+    def __init__(self, name, initial, minimum, maximum, decrease_cooldown=1.0):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_cooldown = decrease_cooldown
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.waiters = [] # heap of [priority, seq, event, granted]
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        limiter_limit.set(self.limit, service=name)
+
+    def acquire(self, priority, timeout):
+        with self.lock:
+            if self.in_flight < int(self.limit) and not self.waiters:
+                self.in_flight += 1
+                self._publish()
+                return
+            entry = [priority, next(self.sequence), threading.Event(), False]
+            heapq.heappush(self.waiters, entry)
+            self._publish()
+        entry[2].wait(timeout)
+        with self.lock:
+            if entry[3]:
+                return
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+            self._publish()
+        limiter_rejected.inc(service=self.name, priority=PRIORITY_NAMES.get(priority, str(priority)))
+        raise OverloadedError(f"{self.name} is overloaded; gave up after waiting {timeout:.0f}s for a slot.", retry_after=min(timeout, 30))
+
+    def release(self, outcome):
+        # outcome: "success", "overload" (retryable failure) or "error" (no signal about capacity)
+        with self.lock:
+            self.in_flight -= 1
+            if outcome == "success":
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            elif outcome == "overload" and time.monotonic() - self.last_decrease >= self.decrease_cooldown:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.last_decrease = time.monotonic()
+            while self.waiters and self.in_flight < int(self.limit):
+                entry = heapq.heappop(self.waiters)
+                entry[3] = True
+                self.in_flight += 1
+                entry[2].set()
+            self._publish()
+
+    def _publish(self):
+        limiter_limit.set(round(self.limit, 2), service=self.name)
+        limiter_in_flight.set(self.in_flight, service=self.name)
+        limiter_queued.set(len(self.waiters), service=self.name)
+
+    def status(self):
+        with self.lock:
+            return {"limit": round(self.limit, 2), "in_flight": self.in_flight, "queued": len(self.waiters)}
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive retryable failures; after reset_timeout a single
+    # probe call is let through (half-open) and its outcome closes or re-opens the circuit.
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+        breaker_state.set(0, service=name)
+
+    def before_call(self):
+        with self.lock:
+            if self.state == "open":
+                remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+                if remaining > 0:
+                    breaker_rejected.inc(service=self.name)
+                    raise CircuitOpenError(f"{self.name} is unavailable (circuit open); retry in {remaining:.0f}s.", retry_after=remaining)
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self.probe_in_flight:
+                    breaker_rejected.inc(service=self.name)
+                    raise CircuitOpenError(f"{self.name} is recovering (circuit half-open).", retry_after=1)
+                self.probe_in_flight = True
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+            self.probe_in_flight = False
+            breaker_state.set(0, service=self.name)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probe_in_flight = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"🔌 Circuit breaker for {self.name} opened after {self.failures} consecutive failures.")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                breaker_state.set(1, service=self.name)
+
+    def cancel(self):
+        # The call was abandoned (e.g. client disconnected) without telling us anything
+        with self.lock:
+            self.probe_in_flight = False
+
+    def status(self):
+        with self.lock:
+            status = {"state": self.state, "consecutive_failures": self.failures}
+            if self.state == "open":
+                status["retry_in_seconds"] = max(0, round(self.reset_timeout - (time.monotonic() - self.opened_at), 1))
+            return status
+
+class Guard:
+    def __init__(self, name, limiter, breaker, max_attempts=4, backoff_base=0.5, backoff_max=8.0, queue_timeouts=None):
+        self.name = name
+        self.limiter = limiter
+        self.breaker = breaker
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.queue_timeouts = queue_timeouts or {INTERACTIVE: 30, BACKGROUND: 120, BATCH: 600}
+
+    def _backoff(self, attempt):
+        # Full jitter: uniform over [0, min(cap, base * 2^attempt)]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _start(self, priority):
+        self.breaker.before_call()
+        try:
+            self.limiter.acquire(priority, self.queue_timeouts.get(priority, 60))
+        except BaseException:
+            self.breaker.cancel()
+            raise
+
+    def _record_outcome(self, error):
+        if is_outage(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success() # The service answered; the request itself was bad
+
+    def _failed(self, error, attempt):
+        # Records a failed attempt; returns True when it should be retried
+        retryable = is_retryable(error)
+        self.limiter.release("overload" if retryable else "error")
+        self._record_outcome(error)
+        if not retryable or attempt + 1 >= self.max_attempts:
+            return False
+        delay = self._backoff(attempt)
+        call_retries.inc(service=self.name)
+        print(f"🔁 {self.name} call failed ({type(error).__name__}: {error}); retry {attempt + 1} in {delay:.1f}s.")
+        time.sleep(delay)
+        return True
+
+    def call(self, fn, priority=INTERACTIVE):
+        attempt = 0
+        while True:
+            self._start(priority)
+            try:
+                result = fn()
+            except Exception as e:
+                if not self._failed(e, attempt):
+                    raise
+                attempt += 1
+                continue
+            except BaseException:
+                self.limiter.release("error")
+                self.breaker.cancel()
+                raise
+            self.limiter.release("success")
+            self.breaker.record_success()
+            return result
+
+    def stream(self, fn, priority=INTERACTIVE):
+        # Like call() for a generator; a failure is only retried if nothing has been yielded yet
+        attempt = 0
+        while True:
+            self._start(priority)
+            started = False
+            try:
+                for item in fn():
+                    started = True
+                    yield item
+            except Exception as e:
+                if started:
+                    self.limiter.release("error")
+                    self._record_outcome(e)
+                    raise
+                if not self._failed(e, attempt):
+                    raise
+                attempt += 1
+                continue
+            except BaseException:
+                self.limiter.release("error")
+                self.breaker.cancel()
+                raise
+            self.limiter.release("success")
+            self.breaker.record_success()
+            return
+
+    def status(self):
+        return {**self.limiter.status(), "circuit": self.breaker.status()}
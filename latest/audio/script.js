@@ -19,8 +19,15 @@ document.addEventListener('DOMContentLoaded', function() {
             console.warn("fetchNoteData called without noteId");
             return;
         }
+        // Only the section this page shows; the browser revalidates its cached copy with the note's ETag
+        const pageFields = {
+            'subjective.html': 'subjective_text', 'objective.html': 'objective_text', 'assessment.html': 'assessment_text',
+            'plan.html': 'plan_text', 'summary.html': 'summary_text'
+        };
+        const page = Object.keys(pageFields).find(name => pathname.includes(name));
+        const query = page ? `?fields=id,${pageFields[page]}` : '';
         try {
-            const response = await fetch(`http://127.0.0.1:5000/get_note_data/${noteId}`);
+            const response = await fetch(`http://127.0.0.1:5000/get_note_data/${noteId}${query}`);
             if (!response.ok) {
                 // If note not found (404), it might be a new note flow starting not from subjective.html
                 // or an invalid ID. For now, just log and let specific page handlers decide.
@@ -137,6 +144,56 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    // Streams a generated section over Server-Sent Events, calling onDelta with the text received so far.
+    // Resolves with the final (server-checked) text. Connection failures reject with streamUnavailable set.
+    function streamGeneratedSection(section, onDelta) {
+        return new Promise((resolve, reject) => {
+            const source = new EventSource(`http://127.0.0.1:5000/api/generate_${section}/${currentNoteId}/stream`);
+            let text = '';
+            let finished = false;
+            source.addEventListener('delta', event => {
+                text += JSON.parse(event.data).text;
+                onDelta(text);
+            });
+            source.addEventListener('done', event => {
+                finished = true;
+                source.close();
+                resolve(JSON.parse(event.data)[`${section}_text`]);
+            });
+            source.addEventListener('generation_error', event => {
+                finished = true;
+                source.close();
+                reject(new Error(JSON.parse(event.data).error));
+            });
+            source.onerror = () => {
+                if (finished) return;
+                source.close(); // Don't let EventSource reconnect and start a second generation
+                const error = new Error(`Streaming ${section} generation failed.`);
+                error.streamUnavailable = true;
+                reject(error);
+            };
+        });
+    }
+
+    // Generate a section, streaming when possible and falling back to the blocking JSON endpoint
+    async function generateSectionText(section, onDelta) {
+        try {
+            return await streamGeneratedSection(section, onDelta);
+        } catch (error) {
+            if (!error.streamUnavailable) throw error;
+            console.warn(`Streaming ${section} generation unavailable, using the blocking endpoint.`);
+        }
+        const response = await fetch(`http://127.0.0.1:5000/api/generate_${section}/${currentNoteId}`, {
+            method: 'GET',
+            headers: { 'Content-Type': 'application/json' }
+        });
+        const response_data = await response.json(); // Try to parse JSON regardless of response.ok for error messages
+        if (!response.ok) {
+            throw new Error(response_data.error || `Failed to generate ${section}. Status: ${response.status}`);
+        }
+        return response_data[`${section}_text`];
+    }
+
     initializeNote(); // Call after defining all functions it might use.
 
     // --- Subjective Page Specific Logic (includes Audio Recording) ---
@@ -170,30 +227,98 @@ document.addEventListener('DOMContentLoaded', function() {
             });
         }
 
+        // Poll a queued transcription job until it is done or failed (the server long-polls for us)
+        async function waitForTranscriptionJob(jobId) {
+            while (true) {
+                const response = await fetch(`http://127.0.0.1:5000/transcription_jobs/${jobId}?wait=25`);
+                const job = await response.json();
+                if (!response.ok) {
+                    throw new Error(job.error || `HTTP error! ${response.status}`);
+                }
+                if (job.status === 'done' || job.status === 'failed') {
+                    return job;
+                }
+                if(statusElement) statusElement.textContent = job.status === 'running' ? 'Transcribing audio...' : 'Waiting for a transcription worker...';
+            }
+        }
+
+        // Resumable upload: the recording goes up in chunks, each with a SHA-256 checksum. After a failed request
+        // the server is asked how far it got and only the rest is sent again. Resolves with the queued job.
+        const UPLOAD_MAX_RETRIES = 5;
+
+        async function chunkChecksum(chunk) {
+            if (!window.crypto || !crypto.subtle) return null; // Only available on secure origins (https, localhost)
+            const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', await chunk.arrayBuffer()));
+            return 'sha256 ' + btoa(String.fromCharCode(...digest));
+        }
+
+        async function uploadAudioResumable(audioData, fileName) {
+            const createResponse = await fetch('http://127.0.0.1:5000/uploads', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ size: audioData.size, filename: fileName, note_id: currentNoteId })
+            });
+            let upload = await createResponse.json();
+            if (!createResponse.ok) {
+                throw new Error(upload.error || `HTTP error! ${createResponse.status}`);
+            }
+
+            let failures = 0;
+            while (upload.status === 'receiving' && upload.offset < upload.size) {
+                const chunk = audioData.slice(upload.offset, Math.min(upload.offset + upload.chunk_size, upload.size));
+                if(statusElement) statusElement.textContent = `Uploading audio... ${Math.round(100 * upload.offset / upload.size)}%`;
+                try {
+                    const headers = { 'Upload-Offset': String(upload.offset), 'Content-Type': 'application/offset+octet-stream' };
+                    const checksum = await chunkChecksum(chunk);
+                    if (checksum) headers['Upload-Checksum'] = checksum;
+                    const response = await fetch(`http://127.0.0.1:5000${upload.upload_url}`, { method: 'PATCH', headers, body: chunk });
+                    const result = await response.json();
+                    if (response.ok || response.status === 409) { // 409: the server is at another offset; continue from there
+                        upload = result;
+                        failures = 0;
+                        continue;
+                    }
+                    if (response.status < 500 && result.offset === undefined) { // Not a checksum mismatch; resending won't help
+                        throw Object.assign(new Error(result.error || `HTTP error! ${response.status}`), { fatal: true });
+                    }
+                    console.warn('Upload chunk failed, retrying:', result.error);
+                } catch (error) {
+                    if (error.fatal || ++failures > UPLOAD_MAX_RETRIES) throw error;
+                    console.warn('Upload interrupted, resuming:', error);
+                    await new Promise(resolve => setTimeout(resolve, 500 * 2 ** failures));
+                    const statusResponse = await fetch(`http://127.0.0.1:5000${upload.upload_url}`).catch(() => null);
+                    if (statusResponse && statusResponse.ok) upload = await statusResponse.json();
+                    continue;
+                }
+                if (++failures > UPLOAD_MAX_RETRIES) throw new Error('Upload failed after several retries.');
+            }
+
+            if (!upload.job_id) {
+                // Every byte arrived but the hand-off to transcription failed; ask for it again
+                const completeResponse = await fetch(`http://127.0.0.1:5000${upload.upload_url}/complete`, { method: 'POST' });
+                upload = await completeResponse.json();
+                if (!completeResponse.ok || !upload.job_id) {
+                    throw new Error(upload.error || `HTTP error! ${completeResponse.status}`);
+                }
+            }
+            return upload;
+        }
+
         // **D. Refactor Transcription Logic: New function handleAudioTranscription**
         async function handleAudioTranscription(audioData, fileNameForFormData) {
             console.log('Audio data size being processed:', audioData.size, 'bytes; Name:', fileNameForFormData); // Log audio data size
-            const formData = new FormData();
-            formData.append('file', audioData, fileNameForFormData);
 
             if(statusElement) statusElement.textContent = 'Processing audio...';
             if(transcriptTextarea) transcriptTextarea.value = ''; // Clear previous transcript
 
             try {
-                const response = await fetch('http://127.0.0.1:5000/transcribe', {
-                    method: 'POST',
-                    body: formData
-                });
-
-                if (!response.ok) {
-                    const errorText = await response.text();
-                    throw new Error(`HTTP error! ${response.status} ${errorText}`);
-                }
-
-                const data = await response.json();
+                // The finished upload queues a transcription job; it runs in a server-side worker
+                const submitted = await uploadAudioResumable(audioData, fileNameForFormData);
+                console.log('Transcription job queued:', submitted.job_id);
+                const data = await waitForTranscriptionJob(submitted.job_id);
 
                 if (transcriptTextarea) {
-                    if (data && data.text) {
+                    if (data && data.status === 'done' && data.text) {
                         transcriptTextarea.value = data.text;
                         if(statusElement) statusElement.textContent = 'Transcription complete. You can edit.';
                     } else {
@@ -206,11 +331,77 @@ document.addEventListener('DOMContentLoaded', function() {
                 if (transcriptTextarea) transcriptTextarea.value = "[Transcription fetch error. Check console or type manually.]";
                 if(statusElement) statusElement.textContent = 'Transcription error.';
             } finally {
-                // Re-enable buttons
-                if(startButton) startButton.disabled = false;
-                if(stopButton) stopButton.disabled = true; // Stop should be disabled after processing
-                if(transcribeFileButton) transcribeFileButton.disabled = (audioFileInput && audioFileInput.files.length === 0); // Re-enable if a file is still selected
-                if(audioFileInput) audioFileInput.disabled = false; // Re-enable file input
+                resetTranscriptionControls();
+            }
+        }
+
+        function resetTranscriptionControls() {
+            // Re-enable buttons
+            if(startButton) startButton.disabled = false;
+            if(stopButton) stopButton.disabled = true; // Stop should be disabled after processing
+            if(transcribeFileButton) transcribeFileButton.disabled = (audioFileInput && audioFileInput.files.length === 0); // Re-enable if a file is still selected
+            if(audioFileInput) audioFileInput.disabled = false; // Re-enable file input
+        }
+
+        // Streaming transcription: chunks are sent while recording so the text is ready when it stops.
+        // Any streaming failure falls back to submitting the full recording as a transcription job.
+        const STREAM_CHUNK_MS = 1000;
+        let streamSession = null;
+
+        async function startStreamSession() {
+            try {
+                const response = await fetch('http://127.0.0.1:5000/stream_transcribe', { method: 'POST' });
+                if (!response.ok) {
+                    throw new Error(`HTTP error! ${response.status}`);
+                }
+                const data = await response.json();
+                return { id: data.stream_id, seq: 0, chain: Promise.resolve(), failed: false };
+            } catch (error) {
+                console.warn("Streaming transcription unavailable, the recording will be uploaded when it stops:", error);
+                return null;
+            }
+        }
+
+        function showStreamingTranscript(data) {
+            if (transcriptTextarea) transcriptTextarea.value = [data.text, data.interim].filter(Boolean).join(' ');
+        }
+
+        function sendStreamChunk(session, chunk) {
+            const seq = session.seq++;
+            // Chunks are chained so they reach the server in recording order
+            session.chain = session.chain.then(async () => {
+                if (session.failed) return;
+                try {
+                    const response = await fetch(`http://127.0.0.1:5000/stream_transcribe/${session.id}/chunk?seq=${seq}`, {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/octet-stream' },
+                        body: chunk
+                    });
+                    const data = await response.json();
+                    if (!response.ok || data.error) {
+                        throw new Error(data.error || `HTTP error! ${response.status}`);
+                    }
+                    showStreamingTranscript(data);
+                } catch (error) {
+                    console.warn("Streaming chunk failed, falling back to full upload:", error);
+                    session.failed = true;
+                }
+            });
+        }
+
+        async function finishStreamSession(session) {
+            await session.chain;
+            if (session.failed) return null;
+            try {
+                const response = await fetch(`http://127.0.0.1:5000/stream_transcribe/${session.id}/finish`, { method: 'POST' });
+                const data = await response.json();
+                if (!response.ok || data.error) {
+                    throw new Error(data.error || `HTTP error! ${response.status}`);
+                }
+                return data;
+            } catch (error) {
+                console.warn("Could not finalize streaming transcript, falling back to full upload:", error);
+                return null;
             }
         }
 
@@ -225,20 +416,37 @@ document.addEventListener('DOMContentLoaded', function() {
                 if(transcribeFileButton) transcribeFileButton.disabled = (audioFileInput && audioFileInput.files.length === 0);
                 return;
             }
-            navigator.mediaDevices.getUserMedia({ audio: true })
-                .then(stream => {
+            // The stream session must exist before the first chunk (which carries the WebM header) is produced
+            Promise.all([navigator.mediaDevices.getUserMedia({ audio: true }), startStreamSession()])
+                .then(([stream, session]) => {
+                    streamSession = session;
                     mediaRecorder = new MediaRecorder(stream);
-                    mediaRecorder.start();
                     audioChunks = [];
-                    mediaRecorder.ondataavailable = event => { audioChunks.push(event.data); };
+                    mediaRecorder.ondataavailable = event => {
+                        audioChunks.push(event.data);
+                        if (streamSession && event.data.size > 0) sendStreamChunk(streamSession, event.data);
+                    };
                     
                     // **E. Update mediaRecorder.onstop**
-                    mediaRecorder.onstop = () => {
+                    mediaRecorder.onstop = async () => {
                         const audioBlob = new Blob(audioChunks, { type: 'audio/webm' });
                         console.log('Live recording blob size:', audioBlob.size, 'bytes'); // Log blob size
                         audioChunks = []; // Clear chunks after creating blob
+                        const session = streamSession;
+                        streamSession = null;
+                        if (session) {
+                            if(statusElement) statusElement.textContent = 'Finalizing transcript...';
+                            const result = await finishStreamSession(session);
+                            if (result) {
+                                if(transcriptTextarea) transcriptTextarea.value = result.text;
+                                if(statusElement) statusElement.textContent = 'Transcription complete. You can edit.';
+                                resetTranscriptionControls();
+                                return;
+                            }
+                        }
                         handleAudioTranscription(audioBlob, 'live_recording.webm');
                     };
+                    mediaRecorder.start(STREAM_CHUNK_MS);
                 })
                 .catch(err => {
                     console.error("Error setting up recording:", err);
@@ -460,22 +668,10 @@ document.addEventListener('DOMContentLoaded', function() {
                 generateAssessmentButton.disabled = true;
 
                 try {
-                    const response = await fetch(`http://127.0.0.1:5000/api/generate_assessment/${currentNoteId}`, {
-                        method: 'GET',
-                        headers: { 'Content-Type': 'application/json' }
-                    });
-
-                    const response_data = await response.json(); // Try to parse JSON regardless of response.ok for error messages
-
-                    if (!response.ok) {
-                        throw new Error(response_data.error || `Failed to generate assessment. Status: ${response.status}`);
-                    }
-                    
-                    if (response_data.assessment_text) {
-                        assessmentTextarea.value = response_data.assessment_text;
+                    const assessmentText = await generateSectionText('assessment', partial => { assessmentTextarea.value = partial; });
+                    if (assessmentText) {
+                        assessmentTextarea.value = assessmentText;
                         // alert("Assessment generated successfully and populated."); // Optional: user feedback
-                    } else if (response_data.error) {
-                        alert(`Error generating assessment: ${response_data.error}`);
                     } else {
                         alert("Received an unexpected response from the server.");
                     }
@@ -554,22 +750,10 @@ document.addEventListener('DOMContentLoaded', function() {
                 if (summarizeButtonPlan) summarizeButtonPlan.disabled = true; // Disable next button too
 
                 try {
-                    const response = await fetch(`http://127.0.0.1:5000/api/generate_plan/${currentNoteId}`, {
-                        method: 'GET',
-                        headers: { 'Content-Type': 'application/json' }
-                    });
-
-                    const response_data = await response.json();
-
-                    if (!response.ok) {
-                        throw new Error(response_data.error || `Failed to generate plan. Status: ${response.status}`);
-                    }
-                    
-                    if (response_data.plan_text) {
-                        planTextarea.value = response_data.plan_text;
+                    const planText = await generateSectionText('plan', partial => { planTextarea.value = partial; });
+                    if (planText) {
+                        planTextarea.value = planText;
                         // alert("Plan generated successfully and populated."); // Optional
-                    } else if (response_data.error) {
-                        alert(`Error generating plan: ${response_data.error}`);
                     } else {
                         alert("Received an unexpected response from the server when generating plan.");
                     }
@@ -667,23 +851,11 @@ document.addEventListener('DOMContentLoaded', function() {
                 summaryDisplayArea.textContent = ''; // Clear previous summary
 
                 try {
-                    console.log(`Fetching summary from: http://127.0.0.1:5000/api/generate_summary/${currentNoteId}`);
-                    const response = await fetch(`http://127.0.0.1:5000/api/generate_summary/${currentNoteId}`, {
-                        method: 'GET',
-                        headers: {
-                            'Content-Type': 'application/json'
-                        }
-                    });
-
-                    const response_data = await response.json();
-                    console.log('Response from /api/generate_summary:', response_data);
-
-                    if (!response.ok) {
-                        throw new Error(response_data.error || `Failed to generate summary. Status: ${response.status}`);
-                    }
+                    console.log(`Streaming summary from: http://127.0.0.1:5000/api/generate_summary/${currentNoteId}/stream`);
+                    const summaryText = await generateSectionText('summary', partial => { summaryDisplayArea.textContent = partial; });
 
-                    if (response_data.summary_text) {
-                        summaryDisplayArea.textContent = response_data.summary_text;
+                    if (summaryText) {
+                        summaryDisplayArea.textContent = summaryText;
                     } else {
                         summaryDisplayArea.textContent = "Failed to generate summary. No text returned.";
                         alert("Failed to generate summary. No text returned from server.");
@@ -0,0 +1,70 @@
+import argparse
+import os
+
+# Production entry point for the Flask app, without the debug server.
+#
+# Two serving modes:
+#
+#   threaded  One OS thread per in-flight request (Werkzeug's threaded server). This is
+#             how `python app.py` serves, minus the debugger and reloader.
+#   gevent    Cooperative mode. The standard library is monkey-patched so sockets, sleeps,
+#             locks, queues, subprocesses and the thread pools in app.py yield to each
+#             other, and every request runs as a greenlet of a few kilobytes. A request
+#             waiting on Gemini, Speech-to-Text or a long-running recognition no longer
+#             pins an OS thread, so one process can hold hundreds of them. gRPC (used by
+#             the Google clients) is switched to its gevent-compatible mode as well.
+#             Needs `pip install gevent`.
+#
+#     python latest/audio/serve.py --mode gevent --port 5000 --max-connections 1000
+#     python latest/audio/serve.py --mode threaded
+#
+# SQLite calls stay synchronous in both modes; they are short (pooled WAL connections)
+# and hold the event loop only for the duration of one query. How many model and speech
+# calls actually run at once is still set by GEMINI_MAX_CONCURRENCY / SPEECH_MAX_CONCURRENCY;
+# requests beyond that wait in the priority queue without holding a thread.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Production entry point for the Flask app, without the debug server.")
+    parser.add_argument("--mode", choices=["threaded", "gevent"], default=os.environ.get("SERVER_MODE", "threaded"),
+                        help="serving mode (default: SERVER_MODE or threaded)")
+    parser.add_argument("--host", default=os.environ.get("SERVER_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("SERVER_PORT", "5000")))
+    parser.add_argument("--max-connections", type=int, default=int(os.environ.get("SERVER_MAX_CONNECTIONS", "1000")),
+                        help="gevent mode: concurrent connections (greenlets) before new ones wait")
+    return parser.parse_args()
+
+def enable_gevent():
+    # Must run before anything imports socket, threading or grpc
+    try:
+        from gevent import monkey
+    except ImportError:
+        raise SystemExit("gevent mode needs the gevent package: pip install gevent")
+    monkey.patch_all()
+    try:
+        import grpc.experimental.gevent as grpc_gevent
+    except ImportError:
+        return # No gRPC installed, so no Google clients to adapt (e.g. fake backends)
+    grpc_gevent.init_gevent()
+
+def main():
+    args = parse_args()
+    if args.mode == "gevent":
+        enable_gevent()
+
+    import app as aims
+    aims.init_db()
+    aims.start_background_services()
+    if not os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"):
+        print("⚠️ WARNING: GOOGLE_APPLICATION_CREDENTIALS environment variable not set.")
+
+    print(f"🚀 Serving on http://{args.host}:{args.port} ({args.mode} mode)")
+    if args.mode == "gevent":
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+        WSGIServer((args.host, args.port), aims.app, spawn=Pool(args.max_connections)).serve_forever()
+    else:
+        from werkzeug.serving import run_simple
+        run_simple(args.host, args.port, aims.app, threaded=True)
+
+if __name__ == "__main__":
+    main()
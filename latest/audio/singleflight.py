@@ -0,0 +1,75 @@
+import threading
+
+from metrics import Counter
+
+# In-process request coalescing: while a call for a key is in flight, later callers with the same key
+# wait for it and share its result instead of starting their own.
+singleflight_calls = Counter("aims_singleflight_calls_total", "Calls actually executed by a single-flight group.")
+singleflight_coalesced = Counter("aims_singleflight_coalesced_total", "Calls saved by joining an identical in-flight call.")
+
+class InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+    def wait(self, timeout=None):
+        # Returns the leader's result (re-raising its exception); None if it didn't finish in time
+        if not self.done.wait(timeout):
+            return None
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {} # key -> InFlightCall
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    def acquire(self, key):
+        # Returns (call, is_leader). The leader must call release() when done, followers call.wait().
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = InFlightCall()
+                self.stats["calls"] += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self.stats["coalesced"] += 1
+                leader = False
+        if leader:
+            singleflight_calls.inc(group=self.name)
+        else:
+            singleflight_coalesced.inc(group=self.name)
+        return call, leader
+
+    def release(self, key, call, result=None, error=None):
+        with self.lock:
+            if self.calls.get(key) is call:
+                del self.calls[key]
+        call.result = result
+        call.error = error
+        call.done.set()
+
+    def do(self, key, fn):
+        call, leader = self.acquire(key)
+        if not leader:
+            return call.wait()
+        try:
+            result = fn()
+        except Exception as e:
+            self.release(key, call, error=e)
+            raise
+        except BaseException:
+            self.release(key, call)
+            raise
+        self.release(key, call, result)
+        return result
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, "in_flight": len(self.calls)}
@@ -0,0 +1,254 @@
+import argparse
+import copy
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import threading
+import time
+from urllib.parse import quote, unquote
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Static asset pipeline for the pages under latest/.
+#
+# Every CSS, JS, image and font file gets a content-fingerprinted name (style.css ->
+# style.1a2b3c4d5e.css), and references to it in HTML attributes and CSS url()s are
+# rewritten to that name. Text assets are precompressed with gzip, and with brotli too
+# when the `brotli` package is installed. Fingerprinted files never change, so they are
+# served with a strong ETag and `Cache-Control: immutable`; HTML pages (and assets
+# requested by their plain names) are revalidated with their ETag on every load, which
+# costs a 304. The app builds the manifest in memory on first use. The same build can be
+# written to disk for a reverse proxy or CDN to serve instead of the app:
+#
+#     python latest/audio/static_assets.py --out /srv/aims-static
+
+STATIC_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # latest/
+FINGERPRINT_EXTENSIONS = {".css", ".js", ".json", ".svg", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".ico", ".woff", ".woff2"}
+COMPRESSIBLE_EXTENSIONS = {".html", ".css", ".js", ".json", ".svg"}
+EXCLUDED_DIRECTORIES = {"node_modules", "__pycache__"}
+# latest/audio/ holds the Flask app, its notes database and working files next to the pages; only its frontend scripts are public
+BACKEND_DIRECTORY = "audio"
+BACKEND_PUBLIC_EXTENSIONS = {".js", ".css"}
+MIN_COMPRESS_BYTES = 256 # Smaller bodies don't shrink enough to be worth a Content-Encoding
+FINGERPRINT_LENGTH = 10
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+RELOAD_CHECK_SECONDS = 1.0
+
+HTML_REFERENCE = re.compile(r'''(\b(?:href|src)\s*=\s*)(["'])(.*?)\2''', re.IGNORECASE | re.DOTALL)
+CSS_REFERENCE = re.compile(r'''(url\(\s*)(["']?)([^"')]*?)\2(\s*\))''', re.IGNORECASE)
+URL_SCHEME = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*:")
+
+class Asset:
+    def __init__(self, path, body, immutable):
+        self.path = path
+        self.immutable = immutable
+        self.digest = hashlib.sha256(body).hexdigest()
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type in ("application/javascript", "application/json", "image/svg+xml"):
+            content_type += "; charset=utf-8"
+        self.content_type = content_type
+        self.representations = {None: body} # Content-Encoding -> bytes
+        if os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS and len(body) >= MIN_COMPRESS_BYTES:
+            self.representations["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.representations["br"] = brotli.compress(body, quality=11)
+
+    def alias(self, path, immutable):
+        # The same content (and compressed bodies) under another URL
+        asset = copy.copy(self)
+        asset.path = path
+        asset.immutable = immutable
+        return asset
+
+    def etag(self, encoding):
+        # Strong ETag per representation: the compressed bodies are different byte sequences
+        return f'"{self.digest[:32]}{"-" + encoding if encoding else ""}"'
+
+    def negotiate(self, accept_encoding):
+        # Smallest representation the client accepts
+        accepted = parse_accept_encoding(accept_encoding)
+        candidates = [encoding for encoding in self.representations if encoding is None or encoding in accepted]
+        return min(candidates, key=lambda encoding: len(self.representations[encoding]))
+
+def parse_accept_encoding(header):
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding and quality > 0:
+            accepted.add(coding.lower())
+    if "*" in accepted:
+        accepted.update({"gzip", "br"})
+    return accepted
+
+def etag_matches(if_none_match, etag):
+    # Weak comparison, as If-None-Match requires
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def fingerprinted_name(path, digest):
+    stem, extension = posixpath.splitext(path)
+    return f"{stem}.{digest[:FINGERPRINT_LENGTH]}{extension}"
+
+def rewrite_references(text, pattern, base_dir, renamed):
+    # Points relative (and root-relative) references at the fingerprinted names; everything else is left alone
+    def replace(match):
+        reference = match.group(3)
+        if not reference or URL_SCHEME.match(reference) or reference.startswith(("//", "#")):
+            return match.group(0)
+        path, suffix = re.match(r"([^?#]*)(.*)", reference, re.DOTALL).groups()
+        target = posixpath.normpath(unquote(path).lstrip("/") if path.startswith("/") else posixpath.join(base_dir, unquote(path)))
+        if target not in renamed:
+            return match.group(0)
+        new_reference = posixpath.join(posixpath.dirname(path), quote(posixpath.basename(renamed[target])))
+        return match.group(0).replace(reference, new_reference + suffix, 1)
+    return pattern.sub(replace, text)
+
+def is_public_path(path):
+    # Pages and frontend assets only: the app serves nothing else from latest/, whether or not the pipeline is on
+    parts = path.split("/")
+    if any(not part or part in EXCLUDED_DIRECTORIES or part.startswith(".") for part in parts):
+        return False
+    extension = posixpath.splitext(path)[1].lower()
+    if parts[0] == BACKEND_DIRECTORY:
+        return extension in BACKEND_PUBLIC_EXTENSIONS
+    return extension == ".html" or extension in FINGERPRINT_EXTENSIONS
+
+def scan_sources(root):
+    # Relative POSIX path -> absolute path of every file the pipeline handles
+    sources = {}
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories[:] = [name for name in subdirectories if name not in EXCLUDED_DIRECTORIES and not name.startswith(".")]
+        for filename in filenames:
+            full_path = os.path.join(directory, filename)
+            path = os.path.relpath(full_path, root).replace(os.sep, "/")
+            if is_public_path(path):
+                sources[path] = full_path
+    return sources
+
+def source_signature(sources):
+    signature = []
+    for path, full_path in sorted(sources.items()):
+        stat = os.stat(full_path)
+        signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return signature
+
+class AssetManifest:
+    # URL path (relative to latest/) -> Asset. Fingerprinted assets are immutable; HTML pages and the
+    # plain asset names (for old links and hand-typed URLs) serve the current content and must revalidate.
+    def __init__(self, root):
+        self.root = root
+        self.sources = scan_sources(root)
+        self.signature = source_signature(self.sources)
+        self.assets = {}
+        self.renamed = {} # plain path -> fingerprinted path
+        started = time.perf_counter()
+        # Stylesheets reference images and fonts, HTML references everything, so those are built last
+        order = {".css": 1, ".html": 2}
+        for path in sorted(self.sources, key=lambda path: (order.get(posixpath.splitext(path)[1].lower(), 0), path)):
+            with open(self.sources[path], "rb") as f:
+                body = f.read()
+            extension = posixpath.splitext(path)[1].lower()
+            if extension in (".css", ".html"):
+                text = body.decode("utf-8", errors="surrogateescape")
+                if extension == ".html":
+                    text = rewrite_references(text, HTML_REFERENCE, posixpath.dirname(path), self.renamed)
+                text = rewrite_references(text, CSS_REFERENCE, posixpath.dirname(path), self.renamed) # Inline <style> blocks too
+                body = text.encode("utf-8", errors="surrogateescape")
+            if extension == ".html":
+                self.assets[path] = Asset(path, body, immutable=False)
+                continue
+            asset = Asset(path, body, immutable=False)
+            hashed_path = fingerprinted_name(path, asset.digest)
+            self.renamed[path] = hashed_path
+            self.assets[path] = asset
+            self.assets[hashed_path] = asset.alias(hashed_path, immutable=True)
+        self.build_seconds = time.perf_counter() - started
+
+    def write(self, out_dir):
+        # Fingerprinted assets and rewritten pages, each with its precompressed siblings (.gz, .br)
+        suffixes = {None: "", "gzip": ".gz", "br": ".br"}
+        written = 0
+        for path, asset in self.assets.items():
+            if path in self.renamed: # Plain names are only an in-app fallback
+                continue
+            for encoding, body in asset.representations.items():
+                target = os.path.join(out_dir, *path.split("/")) + suffixes[encoding]
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, "wb") as f:
+                    f.write(body)
+                written += 1
+        return written
+
+class StaticAssets:
+    # Builds the manifest lazily; with auto_reload (debug mode) it is rebuilt when a source file changes
+    def __init__(self, root=STATIC_ROOT, auto_reload=False):
+        self.root = root
+        self.auto_reload = auto_reload
+        self.manifest = None
+        self.last_check = 0.0
+        self.lock = threading.Lock()
+
+    def current(self):
+        manifest = self.manifest
+        if manifest is not None and not (self.auto_reload and time.monotonic() - self.last_check >= RELOAD_CHECK_SECONDS):
+            return manifest
+        with self.lock:
+            if self.manifest is None:
+                self.manifest = AssetManifest(self.root)
+                print(f"📦 Built static asset manifest: {len(self.manifest.renamed)} fingerprinted assets in {self.manifest.build_seconds * 1000:.0f} ms"
+                      f"{'' if brotli else ' (brotli not installed, gzip only)'}.")
+            elif self.auto_reload and time.monotonic() - self.last_check >= RELOAD_CHECK_SECONDS:
+                self.last_check = time.monotonic()
+                if source_signature(scan_sources(self.root)) != self.manifest.signature:
+                    self.manifest = AssetManifest(self.root)
+                    print("📦 Static assets changed; rebuilt the manifest.")
+            return self.manifest
+
+    def get(self, path):
+        return self.current().assets.get(path)
+
+def asset_response(asset, request):
+    from flask import Response
+    encoding = asset.negotiate(request.headers.get("Accept-Encoding"))
+    etag = asset.etag(encoding)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if asset.immutable else REVALIDATE_CACHE_CONTROL,
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(asset.representations[encoding], status=200, headers=headers, content_type=asset.content_type)
+
+def main():
+    parser = argparse.ArgumentParser(description="Static asset pipeline for the pages under latest/.")
+    parser.add_argument("--out", required=True, help="directory to write the fingerprinted, precompressed assets to")
+    parser.add_argument("--root", default=STATIC_ROOT, help="directory holding the pages (default: latest/)")
+    args = parser.parse_args()
+    manifest = AssetManifest(args.root)
+    written = manifest.write(args.out)
+    print(f"Wrote {written} files ({len(manifest.renamed)} fingerprinted assets) to {args.out} in {manifest.build_seconds:.2f}s"
+          f"{'' if brotli else '; install brotli for .br variants'}.")
+
+if __name__ == "__main__":
+    main()